@@ -0,0 +1,244 @@
+"""
+ウォーターマーク処理のベンチマーク。
+
+合成した画像セット（静止画・透過画像・アニメーション）に対して process_images を実行し、
+ケースごとの処理時間・ピークRSS・出力サイズをJSONで出力する。
+
+使い方:
+    python benchmarks/bench_watermark.py --output bench.json
+    python benchmarks/bench_watermark.py --quick --compare bench.json --threshold 0.15
+"""
+import argparse
+import json
+import multiprocessing
+import platform
+import resource
+import statistics
+import sys
+import tempfile
+import time
+from datetime import datetime, timezone
+from pathlib import Path
+
+SRC_DIR = Path(__file__).resolve().parent.parent / "src"
+sys.path.insert(0, str(SRC_DIR))
+
+import numpy as np  # type: ignore  # noqa: E402
+from PIL import Image  # type: ignore  # noqa: E402
+
+STILL_SIZES = {
+    "thumb": (160, 120),
+    "hd": (1280, 720),
+    "fhd": (1920, 1080),
+    "4k": (3840, 2160),
+    "8k": (7680, 4320),
+}
+STILL_FORMATS = [".jpg", ".png", ".webp", ".bmp"]
+QUICK_SIZES = ["thumb", "hd"]
+
+# (拡張子, サイズ名, フレーム数)
+ANIMATION_CASES = [
+    (".gif", "qvga", 10),
+    (".gif", "qvga", 100),
+    (".gif", "qvga", 500),
+    (".gif", "hd", 10),
+    (".png", "qvga", 10),
+    (".png", "qvga", 100),
+]
+ANIMATION_SIZES = {"qvga": (320, 240), "hd": (1280, 720)}
+
+# ベンチマーク用の合成画像を生成する関数
+def make_still(size: tuple, seed: int, alpha=False) -> Image.Image:
+    width, height = size
+    rng = np.random.default_rng(seed)
+    x = np.linspace(0, 255, width, dtype=np.float32)
+    y = np.linspace(0, 255, height, dtype=np.float32)[:, None]
+    noise = rng.integers(0, 32, (height, width), dtype=np.uint8)
+    image = np.empty((height, width, 4 if alpha else 3), np.uint8)
+    image[..., 0] = (x + y) / 2
+    image[..., 1] = x[::-1] * 0.8 + noise
+    image[..., 2] = y * 0.5 + noise
+    if alpha:
+        # 左半分を段階的に透過、一部は完全に透過させる
+        image[..., 3] = np.clip(x * 2, 0, 255)
+        image[: height // 4, : width // 4, 3] = 0
+    return Image.fromarray(image, "RGBA" if alpha else "RGB")
+
+def make_animation(path: Path, size: tuple, frames: int, seed: int):
+    width, height = size
+    base = np.asarray(make_still(size, seed))
+    images = []
+    for index in range(frames):
+        frame = np.roll(base, index * 4, axis=1).copy()
+        top = (index * 3) % max(1, height - 32)
+        frame[top:top + 32, 10:42] = 255
+        images.append(Image.fromarray(frame))
+    images[0].save(path, save_all=True, append_images=images[1:], duration=40, loop=0)
+
+def make_watermark(path: Path):
+    logo = np.zeros((512, 512, 4), np.uint8)
+    logo[192:320, 64:448] = [255, 255, 255, 255]
+    logo[224:288, 96:416] = [30, 30, 30, 255]
+    Image.fromarray(logo, "RGBA").save(path)
+
+def build_corpus(corpus_dir: Path, quick=False) -> list[dict]:
+    """
+    ベンチマーク用の画像を生成し、ケースの一覧を返す。生成済みのファイルは再利用する。
+    """
+    corpus_dir.mkdir(parents=True, exist_ok=True)
+    cases = []
+    sizes = QUICK_SIZES if quick else list(STILL_SIZES)
+
+    for seed, size_name in enumerate(sizes):
+        for ext in STILL_FORMATS:
+            cases.append({"name": f"still-{size_name}{ext}", "path": corpus_dir / f"still-{size_name}{ext}",
+                          "make": ("still", STILL_SIZES[size_name], seed, False)})
+        for ext in [".png", ".webp"]:
+            cases.append({"name": f"rgba-{size_name}{ext}", "path": corpus_dir / f"rgba-{size_name}{ext}",
+                          "make": ("still", STILL_SIZES[size_name], seed, True)})
+
+    for seed, (ext, size_name, frames) in enumerate(ANIMATION_CASES):
+        if quick and frames > 10:
+            continue
+        name = f"anim-{size_name}-{frames}f{ext}"
+        cases.append({"name": name, "path": corpus_dir / name,
+                      "make": ("animation", ANIMATION_SIZES[size_name], seed, frames)})
+
+    for case in cases:
+        if case["path"].exists():
+            continue
+        kind, size, seed, extra = case["make"]
+        if kind == "still":
+            image = make_still(size, seed, alpha=extra)
+            if case["path"].suffix in [".jpg", ".bmp"]:
+                image = image.convert("RGB")
+            image.save(case["path"])
+        else:
+            make_animation(case["path"], size, extra, seed)
+
+    watermark_path = corpus_dir / "watermark.png"
+    if not watermark_path.exists():
+        make_watermark(watermark_path)
+    return [{"name": case["name"], "path": str(case["path"])} for case in cases]
+
+def _max_rss_mb() -> float:
+    """
+    このプロセスのピークRSS（MB）を返す。
+    Linuxではru_maxrssがfork元（ベンチマークの親プロセス）のピークを引き継ぐため、
+    exec後のアドレス空間だけを対象とする/proc/self/statusのVmHWMを使う。
+    """
+    try:
+        with open("/proc/self/status") as status:
+            for line in status:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    rss = resource.getrusage(resource.RUSAGE_SELF).ru_maxrss
+    # LinuxはKB、macOSはバイト単位
+    return rss / (1024 * 1024) if sys.platform == "darwin" else rss / 1024
+
+def run_case(case_path: str, watermark_path: str, repeat: int, transparency: float, compositor: str) -> dict:
+    """
+    1ケースを新しいプロセス内で実行し、計測結果を返す。
+    """
+    from utils.watermark_processor import process_images
+
+    rss_before = _max_rss_mb()
+    timings = []
+    output_bytes = 0
+    with tempfile.TemporaryDirectory() as output_dir:
+        for _ in range(repeat):
+            started = time.perf_counter()
+            output_path = process_images(Path(case_path), Path(watermark_path), Path(output_dir), transparency, compositor)
+            timings.append((time.perf_counter() - started) * 1000)
+            output_bytes = output_path.stat().st_size
+    return {
+        "wall_ms_median": round(statistics.median(timings), 2),
+        "wall_ms_min": round(min(timings), 2),
+        "peak_rss_mb": round(_max_rss_mb(), 1),
+        "peak_rss_delta_mb": round(_max_rss_mb() - rss_before, 1),
+        "input_bytes": Path(case_path).stat().st_size,
+        "output_bytes": output_bytes,
+    }
+
+def run_benchmarks(cases: list[dict], watermark_path: Path, repeat: int, transparency: float, compositor: str, only=None) -> dict:
+    # RSSをケースごとに分けるため、1ケースごとにプロセスを作り直す
+    context = multiprocessing.get_context("spawn")
+    results = {}
+    for case in cases:
+        if only and only not in case["name"]:
+            continue
+        with context.Pool(processes=1, maxtasksperchild=1) as pool:
+            result = pool.apply(run_case, (case["path"], str(watermark_path), repeat, transparency, compositor))
+        results[case["name"]] = result
+        print(f"{case['name']:<28} {result['wall_ms_median']:>10.1f} ms  "
+              f"{result['peak_rss_mb']:>8.1f} MB  {result['output_bytes']:>10} B", flush=True)
+    return results
+
+def compare_results(baseline: dict, current: dict, threshold: float) -> list[str]:
+    """
+    baselineに対して処理時間がthreshold（割合）を超えて悪化したケースを返す。
+    """
+    regressions = []
+    for name, result in current["results"].items():
+        previous = baseline.get("results", {}).get(name)
+        if not previous:
+            continue
+        for metric in ["wall_ms_median", "peak_rss_mb", "output_bytes"]:
+            before, after = previous.get(metric), result.get(metric)
+            if not before or after is None:
+                continue
+            change = (after - before) / before
+            print(f"{name:<28} {metric:<16} {before:>12} -> {after:>12} ({change:+.1%})")
+            if change > threshold:
+                regressions.append(f"{name} {metric} {change:+.1%}")
+    return regressions
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Benchmark the watermark pipeline.")
+    parser.add_argument("--corpus-dir", type=Path, default=Path(__file__).resolve().parent / ".corpus")
+    parser.add_argument("--output", type=Path, help="write results as JSON to this file")
+    parser.add_argument("--quick", action="store_true", help="small sizes and short animations only")
+    parser.add_argument("--repeat", type=int, default=3)
+    parser.add_argument("--transparency", type=float, default=0.15)
+    parser.add_argument("--compositor", default="numpy")
+    parser.add_argument("--only", help="run only cases whose name contains this string")
+    parser.add_argument("--compare", type=Path, help="baseline JSON to compare against")
+    parser.add_argument("--threshold", type=float, default=0.10, help="allowed relative regression")
+    args = parser.parse_args(argv)
+
+    cases = build_corpus(args.corpus_dir, quick=args.quick)
+    results = run_benchmarks(cases, args.corpus_dir / "watermark.png", args.repeat,
+                             args.transparency, args.compositor, args.only)
+    report = {
+        "meta": {
+            "timestamp": datetime.now(timezone.utc).isoformat(),
+            "python": platform.python_version(),
+            "platform": platform.platform(),
+            "pillow": Image.__version__,
+            "numpy": np.__version__,
+            "repeat": args.repeat,
+            "transparency": args.transparency,
+            "compositor": args.compositor,
+        },
+        "results": results,
+    }
+
+    if args.output:
+        args.output.write_text(json.dumps(report, indent=4, sort_keys=True) + "\n")
+        print(f"Results written to {args.output}")
+
+    if args.compare:
+        baseline = json.loads(args.compare.read_text())
+        regressions = compare_results(baseline, report, args.threshold)
+        if regressions:
+            print("Regressions over threshold:")
+            for regression in regressions:
+                print(f"  {regression}")
+            return 1
+        print("No regressions over threshold.")
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
@@ -0,0 +1,315 @@
+"""
+Botのメッセージ処理（on_message）の負荷試験。
+
+Discordに接続せず、Message/Attachment/チャンネルの代わりになる簡易オブジェクトを使って
+on_messageを指定したレートで呼び出し、返信までの時間（p50/p95/p99）・スループット・ピークメモリを計測する。
+
+使い方:
+    python benchmarks/loadtest_bot.py --rate 20 --duration 30 --guilds 5
+    python benchmarks/loadtest_bot.py --rate 50 --messages 500 --skew 0.8 --mix jpg=5,png=3,gif=2 --output load.json
+"""
+import argparse
+import asyncio
+import json
+import os
+import random
+import sys
+import tempfile
+import time
+from pathlib import Path
+
+BENCH_DIR = Path(__file__).resolve().parent
+sys.path.insert(0, str(BENCH_DIR))
+
+from bench_watermark import make_animation, make_still, make_watermark, _max_rss_mb  # noqa: E402
+
+# 画像の種類ごとのサイズ
+IMAGE_SIZES = {"small": (640, 480), "hd": (1280, 720), "fhd": (1920, 1080)}
+
+# 混雑時の返信（bot.reply_busyと同じ文言）
+BUSY_REPLY = "The bot is busy right now"
+
+class FakeAttachment:
+    def __init__(self, filename: str, data: bytes):
+        self.filename = filename
+        self.size = len(data)
+        self._data = data
+
+    async def read(self) -> bytes:
+        return self._data
+
+class FakeGuild:
+    def __init__(self, guild_id: int, filesize_limit=25 * 1024 * 1024):
+        self.id = guild_id
+        self.name = f"guild-{guild_id}"
+        self.filesize_limit = filesize_limit
+
+class FakeAuthor:
+    bot = False
+
+class FakeChannel:
+    """
+    send()の呼び出しを記録する。返信をメッセージごとに数えるため、メッセージごとに作成する
+    （同じチャンネルのメッセージは同じidを持つ）。
+    """
+    def __init__(self, channel_id: int, guild: FakeGuild):
+        self.id = channel_id
+        self.guild = guild
+        self.sent = []
+
+    async def send(self, content=None, file=None, files=None):
+        files = files or ([file] if file else [])
+        self.sent.append({"time": time.perf_counter(), "content": content, "files": len(files)})
+
+class FakeMessage:
+    def __init__(self, message_id: int, channel: FakeChannel, attachments: list):
+        self.id = message_id
+        self.content = ""
+        self.author = FakeAuthor()
+        self.guild = channel.guild
+        self.channel = channel
+        self.attachments = attachments
+        self.reactions = []
+
+    async def add_reaction(self, emoji):
+        self.reactions.append(emoji)
+
+# 負荷試験用の画像を生成する関数
+def build_images(corpus_dir: Path, size_name: str) -> tuple[dict, Path]:
+    """
+    形式ごとの画像データとウォーターマークのパスを返す。
+    """
+    corpus_dir.mkdir(parents=True, exist_ok=True)
+    size = IMAGE_SIZES[size_name]
+    paths = {
+        "jpg": corpus_dir / f"load-{size_name}.jpg",
+        "png": corpus_dir / f"load-{size_name}.png",
+        "webp": corpus_dir / f"load-{size_name}.webp",
+        "gif": corpus_dir / "load-anim.gif",
+    }
+    if not paths["jpg"].exists():
+        make_still(size, 1).save(paths["jpg"])
+    if not paths["png"].exists():
+        make_still(size, 2, alpha=True).save(paths["png"])
+    if not paths["webp"].exists():
+        make_still(size, 3).save(paths["webp"])
+    if not paths["gif"].exists():
+        make_animation(paths["gif"], (320, 240), 20, 4)
+    watermark_path = corpus_dir / "watermark.png"
+    if not watermark_path.exists():
+        make_watermark(watermark_path)
+    return {kind: path.read_bytes() for kind, path in paths.items()}, watermark_path
+
+def parse_mix(text: str) -> list[tuple[str, float]]:
+    mix = []
+    for part in text.split(","):
+        kind, _, weight = part.partition("=")
+        mix.append((kind.strip(), float(weight or 1)))
+    return mix
+
+def percentile(values: list, q: float) -> float:
+    if not values:
+        return 0.0
+    ordered = sorted(values)
+    index = min(len(ordered) - 1, max(0, round(q * (len(ordered) - 1))))
+    return ordered[index]
+
+def summarize(latencies: list) -> dict:
+    return {
+        "count": len(latencies),
+        "p50_ms": percentile(latencies, 0.50) * 1000,
+        "p95_ms": percentile(latencies, 0.95) * 1000,
+        "p99_ms": percentile(latencies, 0.99) * 1000,
+        "max_ms": max(latencies, default=0.0) * 1000,
+    }
+
+# プロセスのピークRSS（MB、/proc/<pid>/statusのVmHWM）を返す関数。読めない場合はNone
+def process_peak_rss_mb(pid: int):
+    try:
+        with open(f"/proc/{pid}/status") as status:
+            for line in status:
+                if line.startswith("VmHWM:"):
+                    return int(line.split()[1]) / 1024
+    except OSError:
+        pass
+    return None
+
+# 画像処理のワーカープロセスのPID一覧（プロセスプールを使わない場合は空）
+def worker_pids(job_runner) -> list:
+    """
+    ワーカーはforkserver/spawnで起動するため、RUSAGE_CHILDRENには含まれない。
+    レンダーワーカー（RENDER_MODE=queue）はBotとは別に起動するため対象外。
+    """
+    if getattr(job_runner, "mode", None) != "process" or hasattr(job_runner, "queue"):
+        return []
+    executor = getattr(job_runner, "_executor", None)
+    return list(getattr(executor, "_processes", None) or {})
+
+# 動いているワーカーのピークRSSをpeaks（PID→MB）に記録する関数
+def record_worker_rss(job_runner, peaks: dict):
+    for pid in worker_pids(job_runner):
+        peak = process_peak_rss_mb(pid)
+        if peak is not None:
+            peaks[pid] = max(peaks.get(pid, 0.0), peak)
+
+# 試験中に定期的にワーカーのピークRSSを記録する関数（ワーカーが終了・入れ替わる前に読み取る）
+async def sample_worker_rss(job_runner, peaks: dict, interval=0.2):
+    while True:
+        record_worker_rss(job_runner, peaks)
+        await asyncio.sleep(interval)
+
+async def run_load(bot_module, args, images: dict, watermark_path: Path) -> dict:
+    rng = random.Random(args.seed)
+    mix = parse_mix(args.mix)
+    kinds = [kind for kind, _ in mix]
+    weights = [weight for _, weight in mix]
+    extensions = {"jpg": ".jpg", "png": ".png", "webp": ".webp", "gif": ".gif"}
+
+    # サーバー・チャンネルを作成し、ウォーターマークを設定する
+    watermark = bot_module.watermark_store.add(watermark_path.read_bytes(), watermark_path.name)
+    channels = []
+    for guild_index in range(args.guilds):
+        guild = FakeGuild(100000 + guild_index)
+        for channel_index in range(args.channels):
+            channel_id = guild.id * 100 + channel_index
+            bot_module.config_loader.set_channel_settings(
+                guild.id, channel_id, {"active_watermark": str(watermark), "transparency": 30}
+            )
+            channels.append((guild, channel_id))
+
+    total = args.messages or int(args.rate * args.duration)
+    results = []
+
+    async def handle(message: FakeMessage, guild_index: int):
+        started = time.perf_counter()
+        await bot_module.on_message(message)
+        finished = time.perf_counter()
+        replies = message.channel.sent
+        results.append({
+            "guild": guild_index,
+            "latency": finished - started,
+            "images": len(message.attachments),
+            "delivered": sum(reply["files"] for reply in replies),
+            "shed": any(reply["content"] and reply["content"].startswith(BUSY_REPLY) for reply in replies),
+        })
+
+    worker_peaks = {}
+    sampler = asyncio.create_task(sample_worker_rss(bot_module.job_runner, worker_peaks))
+    tasks = []
+    started = time.perf_counter()
+    next_arrival = started
+    for index in range(total):
+        # 到着間隔（--poissonの場合は指数分布）
+        interval = rng.expovariate(args.rate) if args.poisson else 1.0 / args.rate
+        next_arrival += interval
+        delay = next_arrival - time.perf_counter()
+        if delay > 0:
+            await asyncio.sleep(delay)
+
+        # --skewの割合のメッセージは最初のサーバーから投稿する（1つのサーバーが集中的に投稿する状況）
+        if args.guilds > 1 and rng.random() < args.skew:
+            guild_index = 0
+        else:
+            guild_index = rng.randrange(args.guilds)
+        guild, channel_id = channels[guild_index * args.channels + rng.randrange(args.channels)]
+        attachments = []
+        for image_index in range(args.images_per_message):
+            kind = rng.choices(kinds, weights)[0]
+            # 出力キャッシュが有効でも再利用されないよう、末尾に異なるバイトを付ける
+            data = images[kind] + index.to_bytes(4, "big") + image_index.to_bytes(2, "big")
+            attachments.append(FakeAttachment(f"img{index}-{image_index}{extensions[kind]}", data))
+        message = FakeMessage(index, FakeChannel(channel_id, guild), attachments)
+        tasks.append(asyncio.create_task(handle(message, guild_index)))
+
+    await asyncio.gather(*tasks)
+    elapsed = time.perf_counter() - started
+    sampler.cancel()
+    record_worker_rss(bot_module.job_runner, worker_peaks)
+
+    latencies = [result["latency"] for result in results if not result["shed"]]
+    delivered = sum(result["delivered"] for result in results)
+    report = {
+        "messages": len(results),
+        "images": sum(result["images"] for result in results),
+        "delivered_images": delivered,
+        "shed_messages": sum(result["shed"] for result in results),
+        "elapsed_s": elapsed,
+        "throughput_images_per_s": delivered / elapsed if elapsed else 0.0,
+        "throughput_messages_per_s": len(results) / elapsed if elapsed else 0.0,
+        "latency": summarize(latencies),
+        # ワーカー1プロセスあたりのピークRSSの最大値（ワーカーのRSSを読めない場合はNone）
+        "peak_worker_rss_mb": max(worker_peaks.values()) if worker_peaks else None,
+        "worker_processes": len(worker_peaks),
+        "per_guild": {},
+    }
+    for guild_index in range(args.guilds):
+        guild_latencies = [r["latency"] for r in results if r["guild"] == guild_index and not r["shed"]]
+        if guild_latencies:
+            report["per_guild"][guild_index] = summarize(guild_latencies)
+    return report
+
+def print_report(report: dict):
+    latency = report["latency"]
+    print(
+        f"{report['messages']} messages ({report['images']} images) in {report['elapsed_s']:.1f}s: "
+        f"{report['throughput_images_per_s']:.1f} images/s delivered, {report['shed_messages']} messages shed"
+    )
+    print(
+        f"latency p50={latency['p50_ms']:.0f}ms p95={latency['p95_ms']:.0f}ms "
+        f"p99={latency['p99_ms']:.0f}ms max={latency['max_ms']:.0f}ms"
+    )
+    if report["peak_worker_rss_mb"] is None:
+        workers = "n/a"
+    else:
+        workers = f"{report['peak_worker_rss_mb']:.0f} MB per process ({report['worker_processes']} worker(s))"
+    print(f"peak RSS: bot {report['peak_rss_mb']:.0f} MB, workers {workers}")
+    if len(report["per_guild"]) > 1:
+        for guild_index, guild in sorted(report["per_guild"].items()):
+            print(f"  guild {guild_index}: n={guild['count']} p50={guild['p50_ms']:.0f}ms p95={guild['p95_ms']:.0f}ms")
+
+def main(argv=None) -> int:
+    parser = argparse.ArgumentParser(description="Drive the bot's on_message with fake Discord messages.")
+    parser.add_argument("--rate", type=float, default=10.0, help="messages per second")
+    parser.add_argument("--duration", type=float, default=10.0, help="seconds to generate load (ignored with --messages)")
+    parser.add_argument("--messages", type=int, help="total number of messages")
+    parser.add_argument("--poisson", action="store_true", help="exponentially distributed arrivals instead of a constant rate")
+    parser.add_argument("--guilds", type=int, default=3)
+    parser.add_argument("--channels", type=int, default=2, help="channels per guild")
+    parser.add_argument("--skew", type=float, default=0.0, help="share of messages sent from the first guild")
+    parser.add_argument("--images-per-message", type=int, default=1)
+    parser.add_argument("--mix", default="jpg=5,png=3,webp=1,gif=1", help="image mix as kind=weight")
+    parser.add_argument("--size", default="hd", choices=sorted(IMAGE_SIZES))
+    parser.add_argument("--seed", type=int, default=0)
+    parser.add_argument("--output", type=Path, help="write the report as JSON")
+    args = parser.parse_args(argv)
+
+    # Botを読み込む前に、試験用のデータディレクトリを設定する（.envの値より優先）
+    work_dir = Path(tempfile.mkdtemp(prefix="wm-load-"))
+    os.environ["BASE_DIR"] = str(work_dir / "data")
+    os.environ.setdefault("DISCORD_TOKEN", "load-test")
+    os.environ.setdefault("OUTPUT_CACHE_MB", "0")
+    os.environ.setdefault("METRICS_ENABLED", "true")
+
+    images, watermark_path = build_images(BENCH_DIR / ".corpus", args.size)
+
+    import bot as bot_module  # noqa: E402
+
+    # コマンド処理はDiscordへの接続が必要なため無効にする
+    async def ignore_commands(message):
+        return None
+    bot_module.bot.process_commands = ignore_commands
+
+    try:
+        report = asyncio.run(run_load(bot_module, args, images, watermark_path))
+    finally:
+        bot_module.job_runner.shutdown()
+
+    report["peak_rss_mb"] = _max_rss_mb()
+    report["config"] = vars(args) | {"output": str(args.output) if args.output else None}
+    print_report(report)
+    if args.output:
+        args.output.write_text(json.dumps(report, indent=2))
+    return 0
+
+if __name__ == "__main__":
+    sys.exit(main())
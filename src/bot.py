@@ -1,3 +1,6 @@
+import time
+STARTED_AT = time.perf_counter()  # 起動時間の計測用
+
 import discord # type: ignore
 import shutil  # ファイル削除用
 import logging
@@ -5,9 +8,19 @@ import asyncio
 from pathlib import Path
 from discord.ext import commands # type: ignore
 from discord import app_commands # type: ignore
-from PIL import Image # type: ignore
 from utils.config_loader import load_env, ensure_base_dir, ConfigLoader
-from utils.watermark_processor import process_images
+from io import BytesIO
+from utils.image_jobs import process_image_bytes, process_image_bytes_timed, init_worker, detect_format
+from utils.image_formats import SUPPORTED_EXTENSIONS, get_output_file_name
+from utils.command_sync import sync_if_changed
+from utils.watermark_store import WatermarkStore
+from utils.output_cache import OutputCache
+from utils.job_runner import ImageJobRunner, QueueJobRunner
+from utils.job_queue import SQLiteJobQueue
+from utils.scheduler import FairScheduler, SchedulerBusy
+from utils.resource_guard import ResourceLimitExceeded, plan_image_bytes, slot_cost
+from utils.janitor import Janitor, guild_storage_usage
+from utils.metrics import MetricsRegistry, timed
 
 # create watermark class
 class Watermark(commands.Cog):
@@ -34,7 +47,152 @@ PREFIX = env["COMMAND_PREFIX"]
 BASE_DIR = ensure_base_dir(env["BASE_DIR"])
 
 # Initialize ConfigLoader
-config_loader = ConfigLoader(BASE_DIR)
+config_loader = ConfigLoader(BASE_DIR, backend=env["SETTINGS_BACKEND"])
+
+# エラーログの保存先と、旧バージョンが使っていた一時ディレクトリ
+ERROR_FILES_DIR = Path("/data/logs/error_files")
+LEGACY_TEMP_DIR = Path("/data/temp")
+
+# 画像処理用のワーカープール（画像処理モジュールは最初のジョブで読み込む。
+# オーバーレイキャッシュの上限はinit_workerで設定する）
+# RENDER_MODE=queueの場合は、別プロセスのレンダーワーカー（render_worker.py）にジョブを渡す
+if env["RENDER_MODE"] == "queue":
+    job_queue = SQLiteJobQueue(
+        Path(env["JOB_QUEUE_DIR"] or BASE_DIR / "queue"),
+        lease_seconds=env["JOB_LEASE_SECONDS"],
+        max_attempts=env["JOB_MAX_ATTEMPTS"],
+    )
+    # 前回の起動時に登録され、受け取られないまま残ったジョブを削除
+    job_queue.purge(env["JOB_RESULT_TIMEOUT"])
+    job_runner = QueueJobRunner(
+        job_queue,
+        max_inflight=env["MAX_INFLIGHT_JOBS"],
+        result_timeout=env["JOB_RESULT_TIMEOUT"],
+    )
+elif env["RENDER_MODE"] == "local":
+    job_runner = ImageJobRunner(
+        mode=env["WORKER_MODE"],
+        max_workers=env["WORKER_COUNT"],
+        max_inflight=env["MAX_INFLIGHT_JOBS"],
+        initializer=init_worker,
+        initargs=(env["OVERLAY_CACHE_MB"] * 1024 * 1024,),
+    )
+else:
+    raise ValueError(f"Unknown render mode: {env['RENDER_MODE']}")
+
+# サーバーごとの重み・キュー上限（オーナーが/wm_priorityで設定した値。未設定ならNone）
+def get_guild_limits(server_id):
+    guild_settings = config_loader.get_guild_settings(server_id)
+    return guild_settings.get("scheduler_weight"), guild_settings.get("queue_cap")
+
+# サーバー間で公平にジョブを実行するスケジューラー（同時実行数はジョブランナーと同じ）
+scheduler = FairScheduler(
+    capacity=job_runner.max_inflight,
+    queue_cap=env["SCHED_QUEUE_CAP"],
+    max_wait=env["SCHED_MAX_WAIT"],
+    limits=get_guild_limits,
+)
+
+# 1ジョブあたりのメモリ・処理量の上限と、処理中のジョブ全体のメモリの上限（0で無効）
+JOB_MEMORY_BUDGET = env["JOB_MEMORY_BUDGET_MB"] * 1024 * 1024
+JOB_PIXEL_BUDGET = env["JOB_PIXEL_BUDGET_MP"] * 1000 * 1000
+RENDER_MEMORY_BUDGET = env["RENDER_MEMORY_BUDGET_MB"] * 1024 * 1024
+
+# 処理済み画像のキャッシュ（OUTPUT_CACHE_MB=0で無効）
+output_cache = None
+if env["OUTPUT_CACHE_MB"] > 0:
+    output_cache = OutputCache(
+        Path(env["OUTPUT_CACHE_DIR"] or BASE_DIR / "cache" / "outputs"),
+        max_bytes=env["OUTPUT_CACHE_MB"] * 1024 * 1024,
+    )
+
+# メトリクス（METRICS_ENABLEDが有効な場合のみ記録）
+metrics = MetricsRegistry(enabled=env["METRICS_ENABLED"])
+metrics.register_gauge("watermark_jobs_queued", lambda: job_runner.queued)
+metrics.register_gauge("watermark_jobs_inflight", lambda: job_runner.inflight)
+if env["RENDER_MODE"] == "queue":
+    metrics.register_gauge("watermark_render_queue_depth", lambda: job_queue.stats()["queued"])
+metrics.register_gauge("watermark_scheduler_waiting", lambda: scheduler.stats()["waiting"])
+metrics.register_gauge("watermark_scheduler_admitted", lambda: scheduler.stats()["admitted"])
+metrics.register_gauge("watermark_scheduler_running_cost", lambda: scheduler.running_cost)
+
+# アップロードされたウォーターマークの保存先（内容のハッシュで重複を排除し、大きすぎる画像はデコードする前に拒否する）
+watermark_store = WatermarkStore(
+    BASE_DIR / "watermarks",
+    memory_budget=JOB_MEMORY_BUDGET,
+    max_pixels=env["WATERMARK_MAX_MP"] * 1000 * 1000,
+)
+
+# チャンネルで使わなくなったウォーターマークを解放する関数
+def release_watermark(watermark_path):
+    """
+    ストアのファイルは参照数を減らし、0になったら削除する。
+    ストア導入前にチャンネルごとに保存されたファイルはそのまま削除する。
+    """
+    if watermark_store.contains(watermark_path):
+        watermark_store.release(watermark_path)
+    else:
+        Path(watermark_path).unlink(missing_ok=True)
+
+# サーバーごとのウォーターマークの容量の上限（0で無効）
+GUILD_QUOTA_BYTES = int(env["GUILD_QUOTA_MB"] * 1024 * 1024)
+
+# サーバーのウォーターマークの使用容量を求める関数（channel_idのウォーターマークをnew_pathに置き換えた場合）
+def guild_watermark_usage(server_id, channel_id, new_path) -> int:
+    channels = [
+        (server_id, other_channel_id, settings)
+        for other_channel_id, settings in config_loader.load_server_settings(server_id)["channels"].items()
+        if str(other_channel_id) != str(channel_id)
+    ]
+    channels.append((server_id, channel_id, {"active_watermark": str(new_path)}))
+    return guild_storage_usage(channels).get(str(server_id), 0)
+
+# 一時ファイル・参照されていないウォーターマーク・大きくなったログを少しずつ削除するジャニター
+janitor = Janitor(
+    data_dirs=[BASE_DIR] + [Path(path) for path in (env["OUTPUT_CACHE_DIR"], env["JOB_QUEUE_DIR"]) if path],
+    temp_dirs=[LEGACY_TEMP_DIR],
+    log_dirs=[ERROR_FILES_DIR],
+    watermark_store=watermark_store,
+    list_channels=config_loader.iter_channel_settings,
+    output_cache=output_cache,
+    temp_max_age=env["TEMP_FILE_MAX_AGE"],
+    log_max_bytes=int(env["LOG_MAX_MB"] * 1024 * 1024),
+    quota_bytes=env["DATA_QUOTA_MB"] * 1024 * 1024,
+    guild_quota_bytes=GUILD_QUOTA_BYTES,
+    batch_size=env["JANITOR_BATCH_SIZE"],
+)
+metrics.register_gauge(
+    "watermark_data_bytes", lambda: janitor.last_report.total_bytes if janitor.last_report else 0
+)
+
+# ジャニターを定期的に実行する関数
+async def run_janitor(interval: float):
+    while True:
+        try:
+            report = await janitor.run_pass()
+        except Exception as e:
+            logging.error(f"Janitor pass failed: {e}")
+        else:
+            for reason, size in report.reclaimed.items():
+                metrics.inc("watermark_janitor_reclaimed_bytes_total", size, reason=reason)
+            logging.info(f"Janitor: {report.summary()}")
+            for server_id, usage in report.guilds_over_quota:
+                logging.warning(
+                    f"Server {server_id} uses {usage / 1024 / 1024:.1f} MB for watermarks "
+                    f"(quota {GUILD_QUOTA_BYTES / 1024 / 1024:.1f} MB)"
+                )
+        if env["RENDER_MODE"] == "queue":
+            # 受け取られないまま残ったジョブを削除（待っている側がタイムアウトした後のものだけを対象にする）
+            try:
+                purged = await asyncio.to_thread(job_queue.purge, env["JOB_RESULT_TIMEOUT"] * 2)
+            except Exception as e:
+                logging.error(f"Job queue purge failed: {e}")
+            else:
+                if purged:
+                    logging.info(f"Purged {purged} abandoned render jobs")
+        await asyncio.sleep(interval)
+
+janitor_task = None
 
 # Initialize logger
 logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
@@ -45,17 +203,35 @@ intents.messages = True       # メッセージ関連Intentを有効化
 intents.message_content = True  # メッセージ内容Intentを有効化
 intents.guilds = True  # サーバー情報の取得を有効化
 
-# lock instance
-lock = asyncio.Lock()
-
 # bot insntance
 bot = commands.Bot(command_prefix=PREFIX, intents=intents)
 
 @bot.event
-async def on_ready():
+async def setup_hook():
+    """
+    ログイン前に一度だけ実行される初期化処理（再接続時は実行されない）。
+    """
+    if metrics.enabled:
+        await metrics.start_http_server(env["METRICS_HOST"], env["METRICS_PORT"])
     bot.tree.add_command(Watermark(bot).watermark_group)
-    await bot.tree.sync()
-    print("Watermark commands synced!")
+    # 不要なファイルの削除を開始（JANITOR_INTERVAL=0で無効）
+    global janitor_task
+    if env["JANITOR_INTERVAL"] > 0:
+        janitor_task = asyncio.create_task(run_janitor(env["JANITOR_INTERVAL"]))
+    # コマンド定義が前回から変わった場合のみ同期する（tree.sync()は時間がかかり、レート制限もある）
+    if await sync_if_changed(bot.tree, BASE_DIR / "command_tree.sha256"):
+        print("Watermark commands synced!")
+
+startup_logged = False
+
+@bot.event
+async def on_ready():
+    global startup_logged
+    if not startup_logged:
+        startup_logged = True
+        startup_seconds = time.perf_counter() - STARTED_AT
+        metrics.observe("watermark_startup_seconds", startup_seconds)
+        logging.info(f"Ready in {startup_seconds:.2f}s")
 
 @bot.event
 async def on_guild_join(guild):
@@ -103,21 +279,31 @@ async def upload_watermark(ctx):
     server_id = ctx.guild.id
     channel_id = ctx.channel.id
 
-    # 保存パスの生成
-    channel_dir = config_loader.get_server_dir(server_id) / str(channel_id)
-    channel_dir.mkdir(parents=True, exist_ok=True)
-    watermark_path = channel_dir / attachment.filename
+    # 新しいウォーターマークを保存（同じ画像は他のチャンネルと共有し、デコード済みの画素も保存する）
+    try:
+        watermark_path = await asyncio.to_thread(watermark_store.add, await attachment.read(), attachment.filename)
+    except ResourceLimitExceeded as e:
+        await ctx.send(f"{e} Please upload a smaller image.")
+        return
+    except Exception as e:
+        await ctx.send(f"Failed to read the watermark image: {e}")
+        return
 
-    # 既存のウォーターマークを削除
+    # サーバーのウォーターマークの合計容量が上限を超える場合は取り消す
+    if GUILD_QUOTA_BYTES:
+        usage = await asyncio.to_thread(guild_watermark_usage, server_id, channel_id, watermark_path)
+        if usage > GUILD_QUOTA_BYTES:
+            await asyncio.to_thread(release_watermark, watermark_path)
+            await ctx.send(
+                f"This server's watermark storage quota would be exceeded ({usage / 1024 / 1024:.1f} MB of "
+                f"{GUILD_QUOTA_BYTES / 1024 / 1024:.1f} MB). Clear watermarks that are no longer needed with `/wm_clear`."
+            )
+            return
+
+    # 既存のウォーターマークを解放
     channel_settings = config_loader.get_channel_settings(server_id, channel_id)
     if "active_watermark" in channel_settings:
-        try:
-            Path(channel_settings["active_watermark"]).unlink()
-        except FileNotFoundError:
-            pass
-
-    # 新しいウォーターマークを保存
-    await attachment.save(watermark_path)
+        await asyncio.to_thread(release_watermark, channel_settings["active_watermark"])
 
     # 設定を更新
     config_loader.set_channel_settings(server_id, channel_id, {"active_watermark": str(watermark_path)})
@@ -180,16 +366,91 @@ async def clear_watermark(ctx):
     server_id = ctx.guild.id
     channel_id = ctx.channel.id
 
+    # ウォーターマークを解放（他のチャンネルで使われていなければ削除）
+    active_watermark = config_loader.get_channel_settings(server_id, channel_id).get("active_watermark")
+    if active_watermark:
+        await asyncio.to_thread(release_watermark, active_watermark)
+
     # 設定をクリア
     config_loader.delete_channel_settings(server_id, channel_id)
     await ctx.send("Active watermark has been cleared.")
 
-# Pillowがサポートする拡張子一覧
-supported_extensions = list(Image.registered_extensions().keys())
+@bot.command(aliases=['wm_stats'])
+@commands.is_owner()
+async def show_metrics(ctx):
+    """
+    処理時間などのメトリクスを表示する（Botオーナー専用）
+    """
+    stats = scheduler.stats()
+    busiest = sorted(stats["guilds"].items(), key=lambda item: -item[1]["admitted"])[:5]
+    queue_lines = [
+        f"scheduler running={stats['running_cost']}/{stats['capacity']} waiting={stats['waiting']} shed={stats['shed_total']}",
+        *[
+            f"  guild {guild_id}: admitted={guild['admitted']} waiting={guild['waiting']} running={guild['running']} "
+            f"weight={guild['weight']} cap={guild['queue_cap']}"
+            for guild_id, guild in busiest
+        ],
+    ]
+    if janitor.last_report is not None:
+        queue_lines.append(f"janitor: {janitor.last_report.summary()}")
+    summary = "\n".join(queue_lines) + "\n" + metrics.summary()
+    await ctx.send(f"```\n{summary[:1900]}\n```")
+
+# サーバーの処理の優先度を設定するコマンド
+@bot.command(aliases=['wm_priority'])
+@commands.is_owner()
+async def set_guild_priority(ctx, weight: int = None, queue_cap: int = None, server_id: int = None):
+    """
+    サーバーの重み（ラウンドロビンで割り当てる実行枠の比率）とキューの上限を設定する（Botオーナー専用）。
+    引数を省略すると既定値に戻す。server_idを省略すると現在のサーバーが対象。
+    """
+    if (weight is not None and weight < 1) or (queue_cap is not None and queue_cap < 1):
+        await ctx.send("Weight and queue cap must be positive integers. Example: `/wm_priority 2 64`.")
+        return
+    server_id = server_id or ctx.guild.id
+    config_loader.set_guild_settings(server_id, {"scheduler_weight": weight, "queue_cap": queue_cap})
+    scheduler.reload_limits(server_id)
+    await ctx.send(
+        f"Scheduling for server {server_id}: weight={weight or scheduler.default_weight}, "
+        f"queue cap={queue_cap or scheduler.queue_cap}."
+    )
 
-import asyncio
+# サーバーごとの出力容量の上限を設定するコマンド
+@bot.command(aliases=['wm_budget'])
+async def set_upload_budget(ctx, megabytes: float = None):
+    """
+    出力画像1枚あたりの容量の上限（MB）を設定する。省略するとサーバーのアップロード上限に戻す。
+    """
+    server_id = ctx.guild.id
+    if megabytes is not None and megabytes <= 0:
+        await ctx.send("Invalid budget. Please provide a size in MB greater than 0. Example: `/wm_budget 8`.")
+        return
 
-lock = asyncio.Lock()  # ロックを作成
+    try:
+        config_loader.set_guild_settings(server_id, {"upload_budget_mb": megabytes})
+    except Exception as e:
+        await ctx.send(f"An error occurred while setting the upload budget: {e}")
+        return
+
+    limit_mb = ctx.guild.filesize_limit / (1024 * 1024)
+    if megabytes is None:
+        await ctx.send(f"Upload budget has been reset to the server limit ({limit_mb:.0f} MB).")
+    else:
+        await ctx.send(f"Upload budget has been set to {min(megabytes, limit_mb):g} MB for this server.")
+
+# 出力画像1枚あたりの容量の上限（バイト）を取得する関数
+def get_upload_budget(guild) -> int:
+    """
+    サーバー設定、UPLOAD_BUDGET_MB、サーバーのアップロード上限の順に参照する。
+    サーバーのアップロード上限を超える値は上限に切り詰める。
+    """
+    budget_mb = config_loader.get_guild_settings(guild.id).get("upload_budget_mb") or env["UPLOAD_BUDGET_MB"]
+    if budget_mb:
+        return min(int(budget_mb * 1024 * 1024), guild.filesize_limit)
+    return guild.filesize_limit
+
+# Pillowがサポートする拡張子一覧（静的な表。Pillowのプラグインは読み込まない）
+supported_extensions = SUPPORTED_EXTENSIONS
 
 # 透過度を確認する関数
 async def set_transparency(server_id, channel_id, transparency):
@@ -201,6 +462,188 @@ async def set_transparency(server_id, channel_id, transparency):
     except Exception as e:
         logging.error(f"Failed to set transparency: {e}")
 
+# 1メッセージに添付できるファイル数の上限（Discordの制限）
+MAX_FILES_PER_MESSAGE = 10
+
+# 送信するファイルをDiscordの上限に合わせて分割する関数
+def split_upload_batches(files: list, max_files: int, max_bytes: int) -> list[list]:
+    """
+    (BytesIO, ファイル名)のリストを、ファイル数と合計サイズの上限を超えないように分割する。
+    単体で上限を超えるファイルはそのファイルだけのバッチにする。
+    """
+    batches = []
+    current = []
+    current_bytes = 0
+    for output, output_file_name in files:
+        size = output.getbuffer().nbytes
+        if current and (len(current) >= max_files or current_bytes + size > max_bytes):
+            batches.append(current)
+            current = []
+            current_bytes = 0
+        current.append((output, output_file_name))
+        current_bytes += size
+    if current:
+        batches.append(current)
+    return batches
+
+# 添付ファイルのエラーを記録し、返信用のメッセージを返す関数
+def describe_attachment_error(attachment, error: BaseException, error_files_dir: Path) -> str:
+    file_name = getattr(attachment, "filename", attachment)
+    if isinstance(error, SchedulerBusy):
+        # 待ち時間の上限を超えた場合（混雑によるもので、エラーログには記録しない）
+        metrics.inc("watermark_jobs_shed_total", reason=error.reason)
+        return f"The bot is busy right now, please try again later ({file_name})."
+    if isinstance(error, ResourceLimitExceeded):
+        # 大きすぎる画像（エラーログには記録しない）
+        metrics.inc("watermark_jobs_rejected_total", reason="resource_limit")
+        return f"Skipped {file_name}: {error}"
+    error_log_path = error_files_dir / "error_log.txt"
+    if isinstance(error, FileNotFoundError):
+        metrics.inc("watermark_errors_total", type="FileNotFoundError")
+        with open(error_log_path, "a") as log_file:
+            log_file.write(f"FileNotFoundError: {error}\n")
+        return f"File not found error ({file_name}): {error}"
+
+    metrics.inc("watermark_errors_total", type=type(error).__name__)
+    with open(error_log_path, "a") as log_file:
+        log_file.write(f"Unexpected error: {error}\n")
+    return f"An error occurred ({file_name}): {error}"
+
+# 添付ファイル1件にウォーターマークを適用する関数
+async def process_attachment(attachment, admission, active_watermark, transparency, byte_budget=0) -> tuple[BytesIO, str]:
+    """
+    添付ファイルを読み込んで処理し、(BytesIO, 出力ファイル名)を返す。
+    """
+    extension = Path(attachment.filename).suffix.lower()
+    timings = {} if metrics.enabled else None
+
+    # 添付ファイルを読み込み
+    with timed(timings, "download"):
+        image_data = await attachment.read()
+    metrics.inc("watermark_bytes_total", len(image_data), direction="in")
+
+    logging.info(f"Processing attachment {attachment.filename} ({len(image_data)} bytes) with overlay {active_watermark}")
+
+    # デコード前にヘッダーから必要なメモリを見積もる（上限を超える静止画は縮小、アニメーションは拒否）
+    with timed(timings, "inspect"):
+        estimate = await asyncio.to_thread(
+            plan_image_bytes, image_data, attachment.filename,
+            JOB_MEMORY_BUDGET, JOB_PIXEL_BUDGET, env["MAX_OUTPUT_DIMENSION"],
+        )
+    if estimate.downscaled:
+        metrics.inc("watermark_jobs_downscaled_total")
+        logging.info(
+            f"Downscaling {attachment.filename} from {estimate.header.size} to {estimate.output_size} "
+            f"to fit the memory budget (estimated {estimate.memory_bytes / 1024 / 1024:.0f} MB)"
+        )
+
+    # 同じ画像・ウォーターマーク・透過度の処理結果があれば再利用
+    cache_key = None
+    cached_output = None
+    if output_cache is not None:
+        cache_key = await asyncio.to_thread(
+            output_cache.make_key, image_data, Path(active_watermark), transparency, extension,
+            (estimate.max_dimension, byte_budget, env["ENCODE_PROFILE"]),
+        )
+        cached_output = await asyncio.to_thread(output_cache.get, cache_key)
+        metrics.inc("watermark_output_cache_total", result="hit" if cached_output is not None else "miss")
+
+    if cached_output is not None:
+        output = BytesIO(cached_output)
+        # 容量調整で形式が変わっている場合があるため、保存済みデータの形式から拡張子を決める
+        image_format = await asyncio.to_thread(detect_format, cached_output)
+        output_file_name = get_output_file_name(attachment.filename, transparency, image_format)
+    else:
+        # ウォーターマークを適用（ワーカーで実行）
+        job_args = dict(
+            image_data=image_data,
+            file_name=attachment.filename,
+            overlay_image_path=Path(active_watermark),
+            transparency=transparency,  # デフォルトの透過率
+            compositor=env["COMPOSITOR"],
+            max_dimension=estimate.max_dimension,
+            tile_pixels=env["TILE_THRESHOLD_PIXELS"],
+            byte_budget=byte_budget,
+            encode_profile=env["ENCODE_PROFILE"],
+            memory_budget=JOB_MEMORY_BUDGET,
+            pixel_budget=JOB_PIXEL_BUDGET,
+        )
+        # サーバー間で公平に実行枠を割り当てる（メモリを多く使うジョブは複数の枠を使う）
+        queued_at = time.perf_counter()
+        async with admission.slot(slot_cost(estimate.memory_bytes, RENDER_MEMORY_BUDGET, scheduler.capacity)):
+            if timings is not None:
+                timings["queue"] = time.perf_counter() - queued_at
+            if metrics.enabled:
+                output, output_file_name, job_timings, cache_counts = await job_runner.run(process_image_bytes_timed, **job_args)
+                timings.update(job_timings)
+                # オーバーレイキャッシュはワーカーごとに持つため、ジョブごとの回数を集計する
+                for result, count in (("hit", cache_counts.get("hits", 0)), ("miss", cache_counts.get("misses", 0))):
+                    if count:
+                        metrics.inc("watermark_overlay_cache_total", count, result=result)
+            else:
+                output, output_file_name = await job_runner.run(process_image_bytes, **job_args)
+
+        if cache_key is not None:
+            await asyncio.to_thread(output_cache.put, cache_key, output.getvalue())
+    metrics.inc("watermark_bytes_total", output.getbuffer().nbytes, direction="out")
+
+    if timings is not None:
+        metrics.observe_stages(timings)
+    metrics.inc("watermark_jobs_total")
+    return output, output_file_name
+
+# 混雑時に受け付けなかったことを通知する関数
+async def reply_busy(message):
+    try:
+        await message.add_reaction("⏳")
+    except discord.HTTPException:
+        pass
+    await message.channel.send("The bot is busy right now. Please try again later.")
+
+# 1メッセージ分の添付ファイルを処理して返信する関数
+async def process_message_attachments(message, targets, error_messages, admission, active_watermark, transparency):
+    # 必要なディレクトリを定義
+    error_files_dir = ERROR_FILES_DIR
+
+    try:
+        error_files_dir.mkdir(parents=True, exist_ok=True)  # エラー用ディレクトリ
+    except Exception as dir_error:
+        logging.error(f"Failed to create directories: {dir_error}")
+        return
+
+    # 出力画像1枚あたりの容量の上限
+    byte_budget = get_upload_budget(message.guild)
+
+    # 対応形式の添付ファイルを並列に処理
+    results = await asyncio.gather(
+        *(process_attachment(attachment, admission, active_watermark, transparency, byte_budget) for attachment in targets),
+        return_exceptions=True,
+    )
+
+    processed = []
+    for attachment, result in zip(targets, results):
+        if isinstance(result, BaseException):
+            error_messages.append(describe_attachment_error(attachment, result, error_files_dir))
+        else:
+            processed.append(result)
+
+    # 処理後の画像を1つのメッセージにまとめて送信（上限を超える場合のみ分割）
+    for batch in split_upload_batches(processed, MAX_FILES_PER_MESSAGE, message.guild.filesize_limit):
+        timings = {} if metrics.enabled else None
+        try:
+            with timed(timings, "upload"):
+                await message.channel.send(
+                    files=[discord.File(output, filename=output_file_name) for output, output_file_name in batch]
+                )
+            if timings is not None:
+                metrics.observe_stages(timings)
+        except Exception as e:
+            file_names = ", ".join(output_file_name for _, output_file_name in batch)
+            error_messages.append(describe_attachment_error(file_names, e, error_files_dir))
+
+    if error_messages:
+        await message.channel.send("\n".join(error_messages)[:2000])
+
 @bot.event
 async def on_message(message):
     """
@@ -227,8 +670,14 @@ async def on_message(message):
     server_id = message.guild.id
     channel_id = message.channel.id
 
+    # 段階ごとの処理時間（計測無効時はNone）
+    timings = {} if metrics.enabled else None
+
     # チャンネル設定を取得
-    channel_settings = config_loader.get_channel_settings(server_id, channel_id)
+    with timed(timings, "settings"):
+        channel_settings = config_loader.get_channel_settings(server_id, channel_id)
+    if timings is not None:
+        metrics.observe_stages(timings)
     transparency = channel_settings.get("transparency", 15)  / 100  # 透過率を0.0~1.0に変換
 
     # チャンネルごとのウォーターマークを取得
@@ -240,80 +689,36 @@ async def on_message(message):
         # await bot.process_commands(message)
         return
 
-    async with lock:  # ロックを取得して処理を直列化
-        # 必要なディレクトリを定義
-        temp_dir = Path("/data/temp")
-        error_files_dir = Path("/data/logs/error_files")
-
-        try:
-            temp_dir.mkdir(parents=True, exist_ok=True)  # 一時ディレクトリ
-            error_files_dir.mkdir(parents=True, exist_ok=True)  # エラー用ディレクトリ
-
-            # ディレクトリ作成成功のログ
-            logging.info(f"Temp directory created or exists: {temp_dir.resolve()}")
-            logging.info(f"Error files directory created or exists: {error_files_dir.resolve()}")
-        except Exception as dir_error:
-            logging.error(f"Failed to create directories: {dir_error}")
-            return
-
-        # 添付ファイルを保存してウォーターマーク処理
-        for attachment in message.attachments:
-            # 添付ファイルの拡張子を取得
-            extension = Path(attachment.filename).suffix.lower()
+    # 対応形式の添付ファイルを振り分け
+    error_messages = []
+    targets = []
+    for attachment in message.attachments:
+        # 添付ファイルの拡張子を取得
+        extension = Path(attachment.filename).suffix.lower()
+        if extension not in supported_extensions:
+            error_messages.append(f"Unsupported file type: {attachment.filename}")
+        else:
+            targets.append(attachment)
 
-            if extension not in supported_extensions:
-                await message.channel.send(f"Unsupported file type: {attachment.filename}")
-                continue
-
-            try:
-                # 一時的な保存パス
-                input_path = temp_dir / attachment.filename
-                output_file_name = f"{attachment.filename.split('.')[0]}_{str(int(transparency*100))}％{extension}" # 一時的に保存する出力先
-                output_path = temp_dir / output_file_name
-
-                # 添付ファイルを保存
-                await attachment.save(input_path)
-
-                # 保存後に存在確認とログ出力
-                if input_path.exists():
-                    logging.info(f"File exists and is accessible: {input_path.resolve()}")
-                else:
-                    logging.error(f"File is not accessible: {input_path.resolve()}")
-                    raise FileNotFoundError(f"File was not saved: {input_path}")
-
-                logging.info(f"Base image path passed to process_images: {input_path}")
-                logging.info(f"Overlay image path passed to process_images: {Path(active_watermark)}")
-
-                # ウォーターマークを適用
-                process_images(
-                    base_image_path=input_path,
-                    overlay_image_path=Path(active_watermark),
-                    output_folder=temp_dir,
-                    transparency=transparency,  # デフォルトの透過率
-                )
-
-                # 処理後の画像を送信
-                await message.channel.send(file=discord.File(str(output_path)))
-
-                # 正常に処理できたら一時ファイルを削除
-                input_path.unlink(missing_ok=True)  # 元の添付ファイル
-                output_path.unlink(missing_ok=True)  # 処理後のファイル
-
-            except FileNotFoundError as fnf_error:
-                await message.channel.send(f"File not found error: {fnf_error}")
-                error_log_path = error_files_dir / "error_log.txt"
-                with open(error_log_path, "a") as log_file:
-                    log_file.write(f"FileNotFoundError: {fnf_error}\n")
-
-            except Exception as e:
-                await message.channel.send(f"An error occurred: {e}")
-                error_log_path = error_files_dir / "error_log.txt"
-                with open(error_log_path, "a") as log_file:
-                    log_file.write(f"Unexpected error: {e}\n")
+    try:
+        # サーバーごとのキューの上限を超える場合は受け付けない
+        with scheduler.admit(server_id, len(targets)) as admission:
+            async with job_runner.channel_slot(channel_id):  # 同じチャンネル内では投稿順に処理
+                await process_message_attachments(message, targets, error_messages, admission, active_watermark, transparency)
+    except SchedulerBusy as busy:
+        metrics.inc("watermark_jobs_shed_total", len(targets), reason=busy.reason)
+        await reply_busy(message)
 
     # 他のコマンドが処理されるようにする
     await bot.process_commands(message)
 
 # Run the bot
+def main():
+    try:
+        bot.run(TOKEN)
+    finally:
+        job_runner.shutdown()
+
+# 通常はmain.pyから起動する（直接起動するとワーカープロセスがこのファイルの初期化処理を実行する）
 if __name__ == "__main__":
-    bot.run(TOKEN)
+    main()
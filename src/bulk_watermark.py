@@ -0,0 +1,216 @@
+"""
+フォルダ内の画像をまとめてウォーターマーク処理するコマンドラインツール。
+
+チャンネルに設定済みのウォーターマーク、または指定したウォーターマークを使い、
+全CPUコアで並列に処理する。出力済みのファイルは再実行時にスキップする。
+
+使い方:
+    python src/bulk_watermark.py archive/ --output out/ --server-id 123 --channel-id 456
+    python src/bulk_watermark.py "archive/**/*.jpg" --output out/ --watermark logo.png --transparency 30
+"""
+import argparse
+import glob
+import os
+import sys
+import time
+from concurrent.futures import FIRST_COMPLETED, ProcessPoolExecutor, wait
+from pathlib import Path
+from utils.config_loader import load_env, ConfigLoader
+from utils.image_formats import SUPPORTED_EXTENSIONS, get_output_file_name
+
+# 進捗を表示する間隔（秒）
+PROGRESS_INTERVAL = 1.0
+
+# ワーカーごとに同時に投入するファイル数
+FILES_PER_WORKER = 4
+
+# 入力ファイルを列挙する関数
+def find_inputs(source: str) -> tuple[Path, list[Path]]:
+    """
+    ディレクトリなら配下の対応形式のファイルを再帰的に、それ以外はglobとして展開する。
+    (相対パスの基準となるディレクトリ, ファイル一覧)を返す。
+    """
+    path = Path(source)
+    if path.is_dir():
+        files = [p for p in path.rglob("*") if p.is_file() and p.suffix.lower() in SUPPORTED_EXTENSIONS]
+        return path, sorted(files)
+    files = [Path(p) for p in glob.glob(source, recursive=True)]
+    files = [p for p in files if p.is_file() and p.suffix.lower() in SUPPORTED_EXTENSIONS]
+    root = Path(os.path.commonpath([str(p.parent) for p in files])) if files else Path(".")
+    return root, sorted(files)
+
+# 1ファイルを処理する関数（ワーカープロセスで実行）
+def render_file(input_path: Path, output_path: Path, overlay_image_path: Path, transparency: float, options: dict) -> tuple[int, int]:
+    """
+    出力は一時ファイルに書き込んでから置き換えるため、中断しても不完全なファイルは残らない。
+    (入力サイズ, 出力サイズ)を返す。
+    """
+    from utils.watermark_processor import process_image_bytes
+
+    image_data = input_path.read_bytes()
+    output, _ = process_image_bytes(image_data, input_path.name, overlay_image_path, transparency, **options)
+    output_path.parent.mkdir(parents=True, exist_ok=True)
+    temp_path = output_path.with_name(f".{output_path.name}.{os.getpid()}.tmp")
+    temp_path.write_bytes(output.getbuffer())
+    os.replace(temp_path, output_path)
+    return len(image_data), output.getbuffer().nbytes
+
+# チャンネル設定からウォーターマークと透過度を取得する関数
+def resolve_channel_watermark(server_id: int, channel_id: int) -> tuple[Path, int]:
+    env = load_env()
+    config_loader = ConfigLoader(env["BASE_DIR"], backend=env["SETTINGS_BACKEND"])
+    channel_settings = config_loader.get_channel_settings(server_id, channel_id)
+    active_watermark = channel_settings.get("active_watermark")
+    if not active_watermark:
+        raise SystemExit(f"No active watermark is set for channel {channel_id} in server {server_id}.")
+    return Path(active_watermark), channel_settings.get("transparency", 15)
+
+def format_duration(seconds: float) -> str:
+    minutes, seconds = divmod(int(seconds), 60)
+    hours, minutes = divmod(minutes, 60)
+    return f"{hours}h{minutes:02d}m{seconds:02d}s" if hours else f"{minutes}m{seconds:02d}s"
+
+class Progress:
+    """
+    処理件数・スループット・残り時間を一定間隔で標準エラー出力に表示する。
+    """
+    def __init__(self, total: int):
+        self.total = total
+        self.done = 0
+        self.failed = 0
+        self.bytes_in = 0
+        self.bytes_out = 0
+        self.started = time.perf_counter()
+        self._last_report = 0.0
+        self._tty = sys.stderr.isatty()
+
+    def update(self, bytes_in=0, bytes_out=0, failed=False):
+        self.done += 1
+        self.failed += failed
+        self.bytes_in += bytes_in
+        self.bytes_out += bytes_out
+        now = time.perf_counter()
+        if now - self._last_report >= PROGRESS_INTERVAL or self.done == self.total:
+            self._last_report = now
+            self.report(now)
+
+    def report(self, now: float):
+        elapsed = max(now - self.started, 1e-9)
+        rate = self.done / elapsed
+        eta = (self.total - self.done) / rate if rate else 0
+        line = (
+            f"[{self.done}/{self.total}] {rate:.1f} files/s, "
+            f"{self.bytes_in / elapsed / 1e6:.1f} MB/s in, failed {self.failed}, eta {format_duration(eta)}"
+        )
+        print(f"\r{line}" if self._tty else line, end="" if self._tty else "\n", file=sys.stderr, flush=True)
+
+def main():
+    env = load_env()
+    parser = argparse.ArgumentParser(description="Apply a watermark to every image in a directory or glob.")
+    parser.add_argument("input", help="input directory (processed recursively) or glob pattern")
+    parser.add_argument("--output", required=True, type=Path, help="output directory (the input tree is mirrored)")
+    parser.add_argument("--server-id", type=int, help="use the watermark configured for this server/channel")
+    parser.add_argument("--channel-id", type=int)
+    parser.add_argument("--watermark", type=Path, help="watermark image (instead of a channel's setting)")
+    parser.add_argument("--transparency", type=int, help="transparency in percent, 1-100 (default: channel setting or 15)")
+    parser.add_argument("--workers", type=int, default=os.cpu_count() or 1, help="worker processes (default: all cores)")
+    parser.add_argument("--compositor", default=env["COMPOSITOR"], choices=("numpy", "pillow"))
+    parser.add_argument("--max-dimension", type=int, default=env["MAX_OUTPUT_DIMENSION"])
+    parser.add_argument("--encode-profile", default=env["ENCODE_PROFILE"], choices=("balanced", "fast"))
+    parser.add_argument("--overwrite", action="store_true", help="reprocess files whose output already exists")
+    args = parser.parse_args()
+
+    if args.watermark:
+        overlay_image_path, transparency = args.watermark, 15
+    elif args.server_id and args.channel_id:
+        overlay_image_path, transparency = resolve_channel_watermark(args.server_id, args.channel_id)
+    else:
+        parser.error("either --watermark or both --server-id and --channel-id are required")
+    if args.transparency is not None:
+        transparency = args.transparency
+    if not (1 <= transparency <= 100):
+        parser.error("--transparency must be between 1 and 100")
+    if not overlay_image_path.exists():
+        parser.error(f"watermark not found: {overlay_image_path}")
+
+    root, inputs = find_inputs(args.input)
+    # 出力済みのファイルはスキップする（再開時）
+    jobs = []
+    skipped = 0
+    for input_path in inputs:
+        relative = input_path.relative_to(root)
+        output_path = args.output / relative.parent / get_output_file_name(input_path.name, transparency / 100)
+        if output_path.exists() and not args.overwrite:
+            skipped += 1
+            continue
+        jobs.append((input_path, output_path))
+
+    print(
+        f"{len(inputs)} images found, {skipped} already processed, {len(jobs)} to process "
+        f"with {args.workers} workers (watermark {overlay_image_path}, transparency {transparency}%)",
+        file=sys.stderr,
+    )
+    options = {
+        "compositor": args.compositor,
+        "max_dimension": args.max_dimension,
+        "tile_pixels": env["TILE_THRESHOLD_PIXELS"],
+        "encode_profile": args.encode_profile,
+        "memory_budget": env["JOB_MEMORY_BUDGET_MB"] * 1024 * 1024,
+        "pixel_budget": env["JOB_PIXEL_BUDGET_MP"] * 1000 * 1000,
+    }
+
+    from utils.watermark_processor import init_worker
+    progress = Progress(len(jobs))
+    failures = []
+    pending = {}
+    job_iter = iter(jobs)
+    with ProcessPoolExecutor(
+        max_workers=args.workers, initializer=init_worker, initargs=(env["OVERLAY_CACHE_MB"] * 1024 * 1024,)
+    ) as executor:
+        try:
+            while True:
+                # 全ファイルを一度に投入せず、ワーカー数に応じた件数だけ処理中にする
+                while len(pending) < args.workers * FILES_PER_WORKER:
+                    job = next(job_iter, None)
+                    if job is None:
+                        break
+                    input_path, output_path = job
+                    future = executor.submit(
+                        render_file, input_path, output_path, overlay_image_path, transparency / 100, options
+                    )
+                    pending[future] = input_path
+                if not pending:
+                    break
+                done, _ = wait(pending, return_when=FIRST_COMPLETED)
+                for future in done:
+                    input_path = pending.pop(future)
+                    try:
+                        bytes_in, bytes_out = future.result()
+                        progress.update(bytes_in, bytes_out)
+                    except Exception as e:
+                        failures.append((input_path, e))
+                        progress.update(failed=True)
+        except KeyboardInterrupt:
+            executor.shutdown(wait=False, cancel_futures=True)
+            print("\nInterrupted; rerun the same command to resume.", file=sys.stderr)
+            raise SystemExit(130)
+
+    elapsed = time.perf_counter() - progress.started
+    succeeded = progress.done - progress.failed
+    if progress._tty and jobs:
+        print(file=sys.stderr)
+    print(
+        f"Processed {succeeded} images in {format_duration(elapsed)} "
+        f"({succeeded / max(elapsed, 1e-9):.1f} images/s, {progress.bytes_in / max(elapsed, 1e-9) / 1e6:.1f} MB/s in, "
+        f"{progress.bytes_in / 1e6:.1f} MB -> {progress.bytes_out / 1e6:.1f} MB); "
+        f"{skipped} skipped, {len(failures)} failed.",
+        file=sys.stderr,
+    )
+    for input_path, error in failures[:20]:
+        print(f"  failed: {input_path}: {error}", file=sys.stderr)
+    if len(failures) > 20:
+        print(f"  ... and {len(failures) - 20} more", file=sys.stderr)
+    raise SystemExit(1 if failures else 0)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,7 @@
+# Botの起動スクリプト
+# プロセスモードの画像処理ワーカーは起動時に__main__のスクリプトを読み込み直すため、
+# 初期化処理（設定・SQLite・キャッシュの走査・discord.py）を持つbot.pyではなくこのスクリプトから起動する。
+# ワーカーが読み込むのは画像処理モジュールだけになる（init_worker）。
+if __name__ == "__main__":
+    import bot
+    bot.main()
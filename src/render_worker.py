@@ -0,0 +1,117 @@
+import argparse
+import logging
+import multiprocessing
+import os
+import signal
+import threading
+from pathlib import Path
+from utils.config_loader import load_env, ensure_base_dir
+from utils.job_queue import SQLiteJobQueue
+
+# ジョブが無いときの待機時間（秒）
+IDLE_POLL_SECONDS = 0.1
+
+# 処理中のジョブのリースを延長する間隔（リース期間に対する割合）
+HEARTBEAT_RATIO = 0.3
+
+# 終了を要求されたかどうか（SIGTERM/SIGINTで設定）
+stop_event = threading.Event()
+
+def _request_stop(signum, frame):
+    stop_event.set()
+
+# 処理中にリースを延長し続けるスレッド
+def _keep_lease(queue: SQLiteJobQueue, job_id: int, worker_id: str, done: threading.Event):
+    while not done.wait(queue.lease_seconds * HEARTBEAT_RATIO):
+        if not queue.heartbeat(job_id, worker_id):
+            return
+
+# ワーカープロセスの本体
+def worker_main(queue_dir: str, lease_seconds: int, max_attempts: int, overlay_cache_bytes: int):
+    """
+    キューからジョブを取得してwatermark_processorで処理し、結果をキューに書き戻す。
+    """
+    signal.signal(signal.SIGTERM, _request_stop)
+    signal.signal(signal.SIGINT, signal.SIG_IGN)  # 終了は親プロセスから通知する
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+
+    from utils.watermark_processor import init_worker, process_image_bytes_timed
+    init_worker(overlay_cache_bytes)
+
+    worker_id = f"{os.uname().nodename}:{os.getpid()}"
+    queue = SQLiteJobQueue(Path(queue_dir), lease_seconds=lease_seconds, max_attempts=max_attempts)
+    logging.info(f"Render worker {worker_id} started")
+
+    while not stop_event.is_set():
+        job = queue.claim(worker_id)
+        if job is None:
+            stop_event.wait(IDLE_POLL_SECONDS)
+            continue
+
+        done = threading.Event()
+        heartbeat = threading.Thread(target=_keep_lease, args=(queue, job.id, worker_id, done), daemon=True)
+        heartbeat.start()
+        try:
+            kwargs = dict(job.payload["kwargs"])
+            kwargs["overlay_image_path"] = Path(kwargs["overlay_image_path"])
+            output, output_file_name, timings, cache_counts = process_image_bytes_timed(job.read_input(), **kwargs)
+            queue.complete(
+                job.id, worker_id, output.getvalue(),
+                {"file_name": output_file_name, "timings": timings, "overlay_cache": cache_counts},
+            )
+        except Exception as e:
+            logging.error(f"Render job {job.id} failed: {e}")
+            queue.fail(job.id, worker_id, f"{type(e).__name__}: {e}")
+        finally:
+            done.set()
+            heartbeat.join()
+
+    queue.close()
+
+# ワーカープロセスを起動し、異常終了したものを再起動する
+def supervise(worker_count: int, worker_args: tuple, restart_delay=1.0):
+    context = multiprocessing.get_context("spawn")
+    workers = {}
+
+    def start(slot):
+        process = context.Process(target=worker_main, args=worker_args, name=f"render-worker-{slot}")
+        process.start()
+        workers[slot] = process
+
+    for slot in range(worker_count):
+        start(slot)
+
+    while not stop_event.is_set():
+        for slot, process in list(workers.items()):
+            if not process.is_alive():
+                # 処理中だったジョブはリースの期限切れ後に再配信される
+                logging.warning(f"Render worker {process.name} exited with code {process.exitcode}; restarting")
+                stop_event.wait(restart_delay)
+                start(slot)
+        stop_event.wait(1.0)
+
+    for process in workers.values():
+        process.terminate()
+    for process in workers.values():
+        process.join()
+
+def main():
+    env = load_env()
+    parser = argparse.ArgumentParser(description="Render watermark jobs queued by the bot (RENDER_MODE=queue).")
+    parser.add_argument("--workers", type=int, default=env["RENDER_WORKERS"], help="number of worker processes")
+    args = parser.parse_args()
+
+    logging.basicConfig(level=logging.INFO, format='%(asctime)s - %(levelname)s - %(message)s')
+    signal.signal(signal.SIGTERM, _request_stop)
+    signal.signal(signal.SIGINT, _request_stop)
+
+    queue_dir = Path(env["JOB_QUEUE_DIR"] or ensure_base_dir(env["BASE_DIR"]) / "queue")
+    # キューのテーブルを作成してからワーカーを起動する
+    SQLiteJobQueue(queue_dir).close()
+    worker_args = (
+        str(queue_dir), env["JOB_LEASE_SECONDS"], env["JOB_MAX_ATTEMPTS"], env["OVERLAY_CACHE_MB"] * 1024 * 1024,
+    )
+    supervise(args.workers or os.cpu_count() or 1, worker_args)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,214 @@
+import struct
+import zlib
+from io import BytesIO
+import numpy as np  # type: ignore
+from PIL import Image, GifImagePlugin  # type: ignore
+
+# GIFのフレーム処理方法（Graphic Control Extension）
+GIF_DISPOSAL_NONE = 1
+GIF_DISPOSAL_BACKGROUND = 2
+
+# 透過に使うパレットインデックス（実際の色は0〜254に割り当てる）
+GIF_TRANSPARENT_INDEX = 255
+
+# 共有パレットで許容する平均誤差（1チャンネルあたり）。超えるフレームはローカルパレットを使う
+GLOBAL_PALETTE_MAX_ERROR = 8.0
+
+class GifStreamWriter:
+    """
+    RGBAフレームを1枚ずつGIFとして書き出す。
+    - 直前に表示された内容から変化した矩形だけを出力し、変化していない画素は透過にする。
+    - 最初のフレームから作った共有パレットを使い、誤差が大きいフレームだけローカルパレットを使う。
+    - 次のフレームで透明になる画素がある場合は、直前のフレームをキャンバス全体で出力して背景に戻す（残像防止）。
+    保持するのは表示中のキャンバスと直前の1フレームのみ。
+    """
+    def __init__(self, fp, size: tuple, loop=None, max_palette_error=GLOBAL_PALETTE_MAX_ERROR):
+        self.fp = fp
+        self.size = size
+        self.loop = loop
+        self.max_palette_error = max_palette_error
+        self.frame_count = 0
+        self.local_palette_frames = 0
+        width, height = size
+        self._canvas = np.zeros((height, width, 4), np.uint8)
+        self._pending = None
+        self._header_written = False
+        self._palette = None
+        self._palette_image = None
+        self._palette_colors = None
+        self._palette_size = 0
+
+    def _write_header(self, palette=None):
+        width, height = self.size
+        if palette is None:
+            self.fp.write(b"GIF89a" + struct.pack("<HHBBB", width, height, 0, 0, 0))
+        else:
+            # グローバルカラーテーブル（256色）付きのヘッダー。背景色は透過インデックス
+            self.fp.write(b"GIF89a" + struct.pack("<HHBBB", width, height, 0xF7, GIF_TRANSPARENT_INDEX, 0))
+            self.fp.write(bytes(palette))
+        if self.loop is not None:
+            self.fp.write(b"!\xff\x0bNETSCAPE2.0\x03\x01" + struct.pack("<H", self.loop) + b"\x00")
+        self._header_written = True
+
+    def _build_global_palette(self, pixels: np.ndarray):
+        rgb_image = Image.fromarray(np.ascontiguousarray(pixels[..., :3]), "RGB")
+        palette = rgb_image.convert("P", palette=Image.Palette.ADAPTIVE, colors=255).getpalette()[:765]
+        self._palette_size = len(palette) // 3
+        # 未使用のエントリは色0の複製で埋める（変換時に選ばれても色0として扱える）
+        palette = palette + palette[:3] * (256 - self._palette_size)
+        self._palette = palette
+        self._palette_image = Image.new("P", (1, 1))
+        self._palette_image.putpalette(palette)
+        self._palette_colors = np.array(palette, dtype=np.int16).reshape(256, 3)
+        self._write_header(palette)
+
+    @staticmethod
+    def _local_palette(rgb_image: Image.Image):
+        paletted = rgb_image.convert("P", palette=Image.Palette.ADAPTIVE, colors=255)
+        palette = paletted.getpalette()[:765]
+        return np.array(paletted), palette + [0] * (768 - len(palette))
+
+    def _map_colors(self, rgb: np.ndarray, opaque: np.ndarray):
+        """
+        共有パレットで色を割り当てる。誤差が大きい場合はローカルパレットを作る。
+        (インデックス配列, ローカルパレットまたはNone)を返す。
+        """
+        rgb_image = Image.fromarray(np.ascontiguousarray(rgb), "RGB")
+        indices = np.array(rgb_image.quantize(palette=self._palette_image, dither=Image.Dither.NONE))
+        indices[indices >= self._palette_size] = 0
+        if opaque.any():
+            error = np.abs(self._palette_colors[indices[opaque]] - rgb[opaque]).mean()
+            if error > self.max_palette_error:
+                self.local_palette_frames += 1
+                return self._local_palette(rgb_image)
+        return indices, None
+
+    def _flush(self, clear: bool):
+        pixels, duration = self._pending
+        self._pending = None
+        if self._palette is None:
+            self._build_global_palette(pixels)
+
+        width, height = self.size
+        # RGBAの4バイトを1つの整数として比較する
+        changed = pixels.view(np.uint32)[..., 0] != self._canvas.view(np.uint32)[..., 0]
+        if clear:
+            box = (0, 0, width, height)
+        else:
+            rows = np.flatnonzero(changed.any(axis=1))
+            if rows.size:
+                cols = np.flatnonzero(changed.any(axis=0))
+                box = (int(cols[0]), int(rows[0]), int(cols[-1]) + 1, int(rows[-1]) + 1)
+            else:
+                # 変化がないフレームは1画素の透過フレームとして表示時間だけ確保する
+                box = (0, 0, 1, 1)
+
+        left, top, right, bottom = box
+        region = pixels[top:bottom, left:right]
+        transparent = ~changed[top:bottom, left:right] | (region[..., 3] == 0)
+        indices, local_palette = self._map_colors(region[..., :3], ~transparent)
+        indices[transparent] = GIF_TRANSPARENT_INDEX
+
+        paletted = Image.fromarray(indices.astype(np.uint8), "P")
+        paletted.putpalette(local_palette or self._palette)
+        params = {
+            "duration": duration,
+            "disposal": GIF_DISPOSAL_BACKGROUND if clear else GIF_DISPOSAL_NONE,
+            "transparency": GIF_TRANSPARENT_INDEX,
+            "include_color_table": local_palette is not None,
+        }
+        for chunk in GifImagePlugin.getdata(paletted, offset=(left, top), **params):
+            self.fp.write(chunk)
+
+        if clear:
+            self._canvas = np.zeros_like(pixels)
+        else:
+            self._canvas = pixels
+
+    def write_frame(self, frame: Image.Image, duration: int, disposal=None):
+        """
+        フレームを追加する。disposalは出力側で決めるため、元画像の値は使わない。
+        """
+        pixels = np.array(frame.convert("RGBA"))
+        # 完全に透過した画素の色は比較に影響しないよう0にそろえる
+        pixels[pixels[..., 3] == 0] = 0
+
+        if self._pending is not None:
+            previous = self._pending[0]
+            # このフレームで透明になる画素があれば、直前のフレームを背景に戻す
+            clear = bool(np.any((pixels[..., 3] == 0) & (previous[..., 3] != 0)))
+            self._flush(clear)
+
+        self._pending = (pixels, duration)
+        self.frame_count += 1
+
+    def close(self):
+        if self._pending is not None:
+            self._flush(False)
+        if not self._header_written:
+            self._write_header()
+        self.fp.write(b";")
+
+class ApngStreamWriter:
+    """
+    RGBAフレームを1枚ずつAPNGとして書き出す。
+    各フレームはキャンバス全体をSOURCEブレンドで置き換えるため、残像は発生しない。
+    """
+    def __init__(self, fp, size: tuple, num_frames: int, loop=0, compress_level=6):
+        self.fp = fp
+        self.size = size
+        self.num_frames = num_frames
+        self.loop = loop or 0
+        self.compress_level = compress_level
+        self.frame_count = 0
+        self._sequence = 0
+
+        self.fp.write(b"\x89PNG\r\n\x1a\n")
+
+    def _write_chunk(self, chunk_type: bytes, data: bytes):
+        self.fp.write(struct.pack(">I", len(data)) + chunk_type + data)
+        self.fp.write(struct.pack(">I", zlib.crc32(chunk_type + data) & 0xFFFFFFFF))
+
+    @staticmethod
+    def _read_chunks(png_data: bytes):
+        offset = 8
+        while offset < len(png_data):
+            length, chunk_type = struct.unpack(">I4s", png_data[offset:offset + 8])
+            yield chunk_type, png_data[offset + 8:offset + 8 + length]
+            offset += length + 12
+
+    def _next_sequence(self) -> int:
+        sequence = self._sequence
+        self._sequence += 1
+        return sequence
+
+    def write_frame(self, frame: Image.Image, duration: int, disposal=None):
+        encoded = BytesIO()
+        frame.convert("RGBA").save(encoded, format="PNG", compress_level=self.compress_level)
+
+        width, height = self.size
+        frame_control = struct.pack(
+            ">IIIIIHHBB",
+            self._next_sequence(), width, height, 0, 0,
+            min(int(duration), 0xFFFF), 1000,
+            0,  # dispose_op: NONE
+            0,  # blend_op: SOURCE
+        )
+
+        for chunk_type, data in self._read_chunks(encoded.getvalue()):
+            if chunk_type == b"IHDR" and self.frame_count == 0:
+                self._write_chunk(b"IHDR", data)
+                self._write_chunk(b"acTL", struct.pack(">II", self.num_frames, self.loop))
+                self._write_chunk(b"fcTL", frame_control)
+            elif chunk_type == b"IDAT":
+                if self.frame_count == 0:
+                    self._write_chunk(b"IDAT", data)
+                else:
+                    if frame_control is not None:
+                        self._write_chunk(b"fcTL", frame_control)
+                        frame_control = None
+                    self._write_chunk(b"fdAT", struct.pack(">I", self._next_sequence()) + data)
+        self.frame_count += 1
+
+    def close(self):
+        self._write_chunk(b"IEND", b"")
@@ -0,0 +1,31 @@
+import hashlib
+import json
+from pathlib import Path
+
+# コマンド定義のハッシュを計算する関数
+def command_tree_hash(tree) -> str:
+    """
+    アプリケーションコマンドの定義（Discordへ送信する内容）からハッシュを作る。
+    """
+    payload = sorted((command.to_dict(tree) for command in tree.get_commands()), key=lambda c: c["name"])
+    return hashlib.sha256(json.dumps(payload, sort_keys=True).encode()).hexdigest()
+
+# コマンド定義が変わった場合のみ同期する関数
+async def sync_if_changed(tree, state_path: Path) -> bool:
+    """
+    前回同期したハッシュをstate_pathに保存し、変化が無ければtree.sync()を省略する。
+    同期した場合はTrueを返す。
+    """
+    state_path = Path(state_path)
+    digest = command_tree_hash(tree)
+    try:
+        if state_path.read_text().strip() == digest:
+            return False
+    except FileNotFoundError:
+        pass
+
+    await tree.sync()
+    temp_path = state_path.with_suffix(".tmp")
+    temp_path.write_text(digest)
+    temp_path.replace(state_path)
+    return True
@@ -0,0 +1,174 @@
+import numpy as np  # type: ignore
+from PIL import Image  # type: ignore
+
+# Pillow(AlphaComposite.c)と同じ固定小数点精度
+PRECISION_BITS = 7
+
+# ウォーターマークの空でない領域を探すタイルの一辺（px）
+REGION_TILE_SIZE = 64
+
+# 255での除算を近似するシフト演算（Pillowと同じ丸め）
+def _div255(values: np.ndarray) -> np.ndarray:
+    return ((values >> 8) + values) >> 8
+
+class PreparedOverlay:
+    """
+    リサイズ・透過度適用済みのウォーターマーク（RGBAのuint8配列）。
+    - bbox: アルファが0でない範囲（全て透明ならNone）
+    - regions: アルファが0でないタイルを横方向に連結した矩形の一覧
+    合成処理はregionsの範囲だけを対象にする。
+    """
+    def __init__(self, pixels: np.ndarray, tile_size=REGION_TILE_SIZE):
+        self.pixels = pixels
+        height, width = pixels.shape[:2]
+        self.size = (width, height)
+        self.nbytes = pixels.nbytes
+        self.bbox = self._find_bbox(pixels[..., 3])
+        self.regions = self._find_regions(pixels[..., 3], tile_size, self.bbox) if self.bbox else []
+        self._grayscale = None
+
+    @classmethod
+    def from_image(cls, image: Image.Image) -> "PreparedOverlay":
+        pixels = np.array(image.convert("RGBA"))
+        # キャッシュで共有されるため書き換えを禁止する
+        pixels.flags.writeable = False
+        return cls(pixels)
+
+    @staticmethod
+    def _find_bbox(alpha: np.ndarray):
+        rows = np.flatnonzero(alpha.any(axis=1))
+        if rows.size == 0:
+            return None
+        cols = np.flatnonzero(alpha.any(axis=0))
+        return (int(cols[0]), int(rows[0]), int(cols[-1]) + 1, int(rows[-1]) + 1)
+
+    @staticmethod
+    def _find_regions(alpha: np.ndarray, tile_size: int, bbox: tuple) -> list[tuple]:
+        """
+        アルファが0でないタイルを行ごとに横方向へ連結し、bboxの範囲に切り詰めて返す。
+        """
+        height, width = alpha.shape
+        bbox_left, bbox_top, bbox_right, bbox_bottom = bbox
+        rows = -(-height // tile_size)
+        cols = -(-width // tile_size)
+        padded = np.zeros((rows * tile_size, cols * tile_size), dtype=bool)
+        padded[:height, :width] = alpha != 0
+        occupied = padded.reshape(rows, tile_size, cols, tile_size).any(axis=(1, 3))
+
+        regions = []
+        for row in range(rows):
+            top = max(row * tile_size, bbox_top)
+            bottom = min((row + 1) * tile_size, bbox_bottom)
+            edges = np.flatnonzero(np.diff(np.concatenate(([0], occupied[row].view(np.int8), [0]))))
+            for start, end in zip(edges[::2], edges[1::2]):
+                left = max(int(start) * tile_size, bbox_left)
+                right = min(int(end) * tile_size, bbox_right)
+                regions.append((left, top, right, bottom))
+        return regions
+
+    @property
+    def is_grayscale(self) -> bool:
+        """
+        アルファが0でない画素のRGBが全て等しい（無彩色のウォーターマーク）かどうか。
+        """
+        if self._grayscale is None:
+            red, green, blue, alpha = (self.pixels[..., channel] for channel in range(4))
+            self._grayscale = bool((((red == green) & (green == blue)) | (alpha == 0)).all())
+        return self._grayscale
+
+    def crop(self, box: tuple) -> "PreparedOverlay":
+        left, top, right, bottom = box
+        return PreparedOverlay(self.pixels[top:bottom, left:right])
+
+    def region_image(self, box: tuple) -> Image.Image:
+        left, top, right, bottom = box
+        return Image.fromarray(np.ascontiguousarray(self.pixels[top:bottom, left:right]), "RGBA")
+
+# ImageまたはPreparedOverlayをPreparedOverlayとして扱う関数
+def as_prepared(overlay) -> PreparedOverlay:
+    if isinstance(overlay, PreparedOverlay):
+        return overlay
+    return PreparedOverlay.from_image(overlay)
+
+class NumpyCompositor:
+    """
+    準備済みウォーターマークを複数フレーム（N×H×W×4のuint8配列）へまとめて合成する。
+    - 計算はPillowのImage.alpha_compositeと同じ整数演算で、結果は一致する。
+    - 元画像で完全に透過している画素にはウォーターマークを適用しない。
+    - ウォーターマークの空でない領域だけを、chunk_pixelsごとに行を区切って処理する。
+    """
+    def __init__(self, prepared_overlay, chunk_pixels=1 << 20):
+        self.overlay = as_prepared(prepared_overlay)
+        self.size = self.overlay.size
+        self.chunk_pixels = chunk_pixels
+
+    def composite(self, frames: np.ndarray) -> np.ndarray:
+        """
+        framesをその場で書き換えて返す。単一フレーム（H×W×4）も受け付ける。
+        """
+        stack = frames[np.newaxis] if frames.ndim == 3 else frames
+        count, height, width, _ = stack.shape
+        if (width, height) != self.size:
+            raise ValueError(f"Frame size {(width, height)} does not match overlay size {self.size}")
+
+        for left, top, right, bottom in self.overlay.regions:
+            rows = max(1, self.chunk_pixels // max(1, count * (right - left)))
+            for chunk_top in range(top, bottom, rows):
+                chunk_bottom = min(chunk_top + rows, bottom)
+                self._composite_block(
+                    stack[:, chunk_top:chunk_bottom, left:right],
+                    self.overlay.pixels[chunk_top:chunk_bottom, left:right],
+                )
+        return frames
+
+    @staticmethod
+    def _composite_block(block: np.ndarray, overlay_block: np.ndarray):
+        src_alpha = overlay_block[..., 3].astype(np.uint32)
+        dst_alpha = block[..., 3].astype(np.uint32)
+        # ウォーターマークが不透明かつ元画像が完全透過でない画素のみ合成する
+        active = (src_alpha != 0) & (dst_alpha != 0)
+        if not active.any():
+            return
+
+        blend = dst_alpha * (255 - src_alpha)
+        out_alpha255 = src_alpha * 255 + blend
+        coef1 = (src_alpha * (255 * 255 << PRECISION_BITS)) // np.maximum(out_alpha255, 1)
+        coef2 = (255 << PRECISION_BITS) - coef1
+
+        src_rgb = overlay_block[..., :3].astype(np.uint32)
+        dst_rgb = block[..., :3].astype(np.uint32)
+        mixed = src_rgb * coef1[..., np.newaxis] + dst_rgb * coef2[..., np.newaxis]
+        mixed = _div255(mixed + (0x80 << PRECISION_BITS)) >> PRECISION_BITS
+        out_alpha = _div255(out_alpha255 + 0x80)
+
+        block[..., :3] = np.where(active[..., np.newaxis], mixed, dst_rgb)
+        block[..., 3] = np.where(active, out_alpha, dst_alpha)
+
+class OpaqueCompositor:
+    """
+    不透明な画像（RGBのH×W×3またはLのH×W配列）へ準備済みウォーターマークを直接合成する。
+    - 元画像のアルファが常に255の場合のImage.alpha_compositeと同じ整数演算で、RGBAに変換して合成した結果と一致する。
+    - アルファのマスク処理や出力アルファの計算が不要なため、NumpyCompositorより演算が少ない。
+    Lの場合はウォーターマークのR成分を使う（無彩色のウォーターマークのみ対象）。
+    """
+    def __init__(self, prepared_overlay):
+        self.overlay = as_prepared(prepared_overlay)
+
+    def composite(self, block: np.ndarray, box: tuple) -> np.ndarray:
+        """
+        block（元画像のboxの範囲の画素）をその場で書き換えて返す。
+        """
+        left, top, right, bottom = box
+        overlay_block = self.overlay.pixels[top:bottom, left:right]
+        # 元画像のアルファが255の場合、Pillowの係数はウォーターマークのアルファだけで決まる
+        coef1 = overlay_block[..., 3].astype(np.uint32) << PRECISION_BITS
+        coef2 = (255 << PRECISION_BITS) - coef1
+        if block.ndim == 3:
+            src = overlay_block[..., :3].astype(np.uint32)
+            coef1 = coef1[..., np.newaxis]
+            coef2 = coef2[..., np.newaxis]
+        else:
+            src = overlay_block[..., 0].astype(np.uint32)
+        mixed = src * coef1 + block.astype(np.uint32) * coef2
+        block[...] = _div255(mixed + (0x80 << PRECISION_BITS)) >> PRECISION_BITS
+        return block
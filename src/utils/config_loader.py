@@ -1,11 +1,25 @@
 import json, os
 from pathlib import Path
 from dotenv import load_dotenv # type: ignore
+from utils.settings_store import SQLiteSettingsStore
 
 class ConfigLoader:
-    def __init__(self, base_dir="data"):
+    """
+    サーバー・チャンネルごとの設定を管理する。
+    backend="sqlite"（デフォルト）ではBASE_DIR/settings.dbに保存し、
+    初回起動時に既存のsettings.jsonを取り込む。"json"では従来通りファイルに保存する。
+    """
+    def __init__(self, base_dir="data", backend="sqlite"):
         self.base_dir = Path(base_dir)
         self.base_dir.mkdir(exist_ok=True)
+        self.store = None
+        if backend == "sqlite":
+            self.store = SQLiteSettingsStore(self.base_dir / "settings.db")
+            migrated = self.store.migrate_json_tree(self.base_dir)
+            if migrated:
+                print(f"Migrated {migrated} channel settings from settings.json files.")
+        elif backend != "json":
+            raise ValueError(f"Unknown settings backend: {backend}")
 
     def get_server_dir(self, server_id):
         server_dir = self.base_dir / str(server_id)
@@ -17,6 +31,8 @@ class ConfigLoader:
         return server_dir / "settings.json"
 
     def load_server_settings(self, server_id):
+        if self.store is not None:
+            return self.store.get_server(server_id)
         settings_file = self.get_settings_file(server_id)
         if not settings_file.exists():
             return {"channels": {}}
@@ -24,11 +40,16 @@ class ConfigLoader:
             return json.load(f)
 
     def save_server_settings(self, server_id, settings):
+        if self.store is not None:
+            self.store.replace_server(server_id, settings)
+            return
         settings_file = self.get_settings_file(server_id)
         with open(settings_file, "w") as f:
             json.dump(settings, f, indent=4)
 
     def get_channel_settings(self, server_id, channel_id):
+        if self.store is not None:
+            return self.store.get_channel(server_id, channel_id)
         server_settings = self.load_server_settings(server_id)
         return server_settings["channels"].get(str(channel_id), {})
 
@@ -36,6 +57,10 @@ class ConfigLoader:
         """
         チャンネル設定を保存。既存の設定がある場合は上書きせず追記。
         """
+        if self.store is not None:
+            self.store.update_channel(server_id, channel_id, settings)
+            return
+
         server_settings = self.load_server_settings(server_id)
         channel_settings = server_settings["channels"].get(str(channel_id), {})
 
@@ -48,7 +73,45 @@ class ConfigLoader:
         # 保存
         self.save_server_settings(server_id, server_settings)
 
+    def iter_channel_settings(self):
+        """
+        全サーバー・チャンネルの(server_id, channel_id, 設定)の一覧。
+        """
+        if self.store is not None:
+            return self.store.iter_channels()
+        channels = []
+        for settings_file in self.base_dir.glob("*/settings.json"):
+            with open(settings_file, "r") as f:
+                server_settings = json.load(f)
+            for channel_id, settings in server_settings.get("channels", {}).items():
+                channels.append((settings_file.parent.name, channel_id, settings))
+        return channels
+
+    def get_guild_settings(self, server_id):
+        """
+        サーバー単位の設定を取得。jsonバックエンドではsettings.jsonの"server"に保存する。
+        """
+        if self.store is not None:
+            return self.store.get_guild(server_id)
+        return self.load_server_settings(server_id).get("server", {})
+
+    def set_guild_settings(self, server_id, settings):
+        """
+        サーバー単位の設定を更新。値がNoneのキーは削除する。
+        """
+        if self.store is not None:
+            self.store.update_guild(server_id, settings)
+            return
+        server_settings = self.load_server_settings(server_id)
+        guild_settings = server_settings.get("server", {})
+        guild_settings.update(settings)
+        server_settings["server"] = {name: value for name, value in guild_settings.items() if value is not None}
+        self.save_server_settings(server_id, server_settings)
+
     def delete_channel_settings(self, server_id, channel_id):
+        if self.store is not None:
+            self.store.delete_channel(server_id, channel_id)
+            return
         server_settings = self.load_server_settings(server_id)
         if str(channel_id) in server_settings["channels"]:
             del server_settings["channels"][str(channel_id)]
@@ -77,6 +140,39 @@ def load_env():
         "DISCORD_TOKEN": os.getenv("DISCORD_TOKEN"),
         "COMMAND_PREFIX": os.getenv("COMMAND_PREFIX", "/"),
         "BASE_DIR": os.getenv("BASE_DIR", "data/src"),
+        "SETTINGS_BACKEND": os.getenv("SETTINGS_BACKEND", "sqlite"),
+        "OVERLAY_CACHE_MB": int(os.getenv("OVERLAY_CACHE_MB", "64")),
+        "OUTPUT_CACHE_DIR": os.getenv("OUTPUT_CACHE_DIR"),
+        "OUTPUT_CACHE_MB": int(os.getenv("OUTPUT_CACHE_MB", "512")),
+        "MAX_OUTPUT_DIMENSION": int(os.getenv("MAX_OUTPUT_DIMENSION", "0")),
+        "TILE_THRESHOLD_PIXELS": int(os.getenv("TILE_THRESHOLD_PIXELS", "16000000")),
+        "COMPOSITOR": os.getenv("COMPOSITOR", "numpy"),
+        "ENCODE_PROFILE": os.getenv("ENCODE_PROFILE", "balanced"),
+        "UPLOAD_BUDGET_MB": float(os.getenv("UPLOAD_BUDGET_MB", "0")),
+        "JOB_MEMORY_BUDGET_MB": int(os.getenv("JOB_MEMORY_BUDGET_MB", "1024")),
+        "JOB_PIXEL_BUDGET_MP": int(os.getenv("JOB_PIXEL_BUDGET_MP", "1000")),
+        "WATERMARK_MAX_MP": int(os.getenv("WATERMARK_MAX_MP", "16")),
+        "RENDER_MEMORY_BUDGET_MB": int(os.getenv("RENDER_MEMORY_BUDGET_MB", "0")),
+        "METRICS_ENABLED": os.getenv("METRICS_ENABLED", "false").lower() in ("1", "true", "yes"),
+        "METRICS_HOST": os.getenv("METRICS_HOST", "127.0.0.1"),
+        "METRICS_PORT": int(os.getenv("METRICS_PORT", "9108")),
+        "WORKER_MODE": os.getenv("WORKER_MODE", "process"),
+        "WORKER_COUNT": int(os.getenv("WORKER_COUNT", "0")) or None,
+        "MAX_INFLIGHT_JOBS": int(os.getenv("MAX_INFLIGHT_JOBS", "0")) or None,
+        "SCHED_QUEUE_CAP": int(os.getenv("SCHED_QUEUE_CAP", "32")),
+        "SCHED_MAX_WAIT": float(os.getenv("SCHED_MAX_WAIT", "120")),
+        "RENDER_MODE": os.getenv("RENDER_MODE", "local"),
+        "RENDER_WORKERS": int(os.getenv("RENDER_WORKERS", "0")) or None,
+        "JOB_QUEUE_DIR": os.getenv("JOB_QUEUE_DIR"),
+        "JOB_LEASE_SECONDS": int(os.getenv("JOB_LEASE_SECONDS", "60")),
+        "JOB_MAX_ATTEMPTS": int(os.getenv("JOB_MAX_ATTEMPTS", "3")),
+        "JOB_RESULT_TIMEOUT": int(os.getenv("JOB_RESULT_TIMEOUT", "300")),
+        "JANITOR_INTERVAL": int(os.getenv("JANITOR_INTERVAL", "3600")),
+        "JANITOR_BATCH_SIZE": int(os.getenv("JANITOR_BATCH_SIZE", "500")),
+        "TEMP_FILE_MAX_AGE": int(os.getenv("TEMP_FILE_MAX_AGE", "3600")),
+        "LOG_MAX_MB": float(os.getenv("LOG_MAX_MB", "10")),
+        "DATA_QUOTA_MB": int(os.getenv("DATA_QUOTA_MB", "0")),
+        "GUILD_QUOTA_MB": float(os.getenv("GUILD_QUOTA_MB", "0")),
     }
 
 def ensure_base_dir(base_dir):
@@ -0,0 +1,40 @@
+from pathlib import Path
+
+# 拡張子と画像形式の対応表（Pillowのregistered_extensions()と同じ内容）
+# registered_extensions()は呼び出すと全プラグインを読み込むため、起動時の判定には静的な表を使う
+EXTENSION_FORMATS = {
+    ".apng": "PNG", ".avif": "AVIF", ".avifs": "AVIF", ".blp": "BLP", ".bmp": "BMP",
+    ".bufr": "BUFR", ".bw": "SGI", ".cur": "CUR", ".dcx": "DCX", ".dds": "DDS", ".dib": "DIB",
+    ".emf": "WMF", ".eps": "EPS", ".fit": "FITS", ".fits": "FITS", ".flc": "FLI", ".fli": "FLI",
+    ".ftc": "FTEX", ".ftu": "FTEX", ".gbr": "GBR", ".gif": "GIF", ".grib": "GRIB", ".h5": "HDF5",
+    ".hdf": "HDF5", ".icb": "TGA", ".icns": "ICNS", ".ico": "ICO", ".iim": "IPTC", ".im": "IM",
+    ".j2c": "JPEG2000", ".j2k": "JPEG2000", ".jfif": "JPEG", ".jp2": "JPEG2000",
+    ".jpc": "JPEG2000", ".jpe": "JPEG", ".jpeg": "JPEG", ".jpf": "JPEG2000", ".jpg": "JPEG",
+    ".jpx": "JPEG2000", ".mpeg": "MPEG", ".mpg": "MPEG", ".mpo": "MPO", ".msp": "MSP",
+    ".palm": "PALM", ".pbm": "PPM", ".pcd": "PCD", ".pcx": "PCX", ".pdf": "PDF", ".pfm": "PPM",
+    ".pgm": "PPM", ".png": "PNG", ".pnm": "PPM", ".ppm": "PPM", ".ps": "EPS", ".psd": "PSD",
+    ".pxr": "PIXAR", ".qoi": "QOI", ".ras": "SUN", ".rgb": "SGI", ".rgba": "SGI", ".sgi": "SGI",
+    ".tga": "TGA", ".tif": "TIFF", ".tiff": "TIFF", ".vda": "TGA", ".vst": "TGA", ".webp": "WEBP",
+    ".wmf": "WMF", ".xbm": "XBM", ".xpm": "XPM",
+}
+
+# 形式ごとの出力拡張子（容量調整で形式を変換した場合に使用）
+FORMAT_EXTENSIONS = {"JPEG": ".jpg", "PNG": ".png", "WEBP": ".webp", "GIF": ".gif"}
+
+# 処理対象とする拡張子
+SUPPORTED_EXTENSIONS = frozenset(EXTENSION_FORMATS)
+
+# 拡張子から画像形式を返す関数（対応していない場合はNone）
+def format_for_extension(ext: str):
+    return EXTENSION_FORMATS.get(ext.lower())
+
+# 出力ファイル名を生成する関数
+def get_output_file_name(file_name: str, transparency: float, image_format=None) -> str:
+    """
+    image_formatが元の拡張子と異なる形式の場合（容量調整で変換した場合）は拡張子を置き換える。
+    """
+    path = Path(file_name)
+    ext = path.suffix.lower()
+    if image_format and format_for_extension(ext) != image_format:
+        ext = FORMAT_EXTENSIONS.get(image_format, ext)
+    return f"{path.stem}_{int(transparency * 100)}％{ext}"
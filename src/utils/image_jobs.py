@@ -0,0 +1,24 @@
+# 画像処理モジュール（NumPy・Pillow）の読み込みを最初のジョブまで遅らせるためのラッパー
+# Bot本体はこのモジュールの関数だけを参照し、watermark_processorを直接importしない
+
+def _processor():
+    from utils import watermark_processor
+    return watermark_processor
+
+# ワーカーの初期化関数（ワーカー起動時に画像処理モジュールを読み込む）
+def init_worker(overlay_cache_bytes: int):
+    _processor().init_worker(overlay_cache_bytes)
+
+def process_image_bytes(*args, **kwargs):
+    return _processor().process_image_bytes(*args, **kwargs)
+
+def process_image_bytes_timed(*args, **kwargs):
+    return _processor().process_image_bytes_timed(*args, **kwargs)
+
+# 保存済みの出力データから画像形式を判定する関数（ヘッダーのみ読み込む）
+def detect_format(data: bytes):
+    from io import BytesIO
+    from PIL import Image  # type: ignore
+    with Image.open(BytesIO(data)) as image:
+        return image.format
+
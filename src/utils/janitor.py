@@ -0,0 +1,249 @@
+import asyncio
+import os
+import time
+from pathlib import Path
+from utils.watermark_store import raster_path
+
+# ログをローテーションした際の1世代前のファイル名の接尾辞
+ROTATED_SUFFIX = ".1"
+
+# ウォーターマークのファイルサイズを返す関数（ストアのファイルはデコード済みの画素を含む）
+def watermark_bytes(watermark_path) -> int:
+    total = 0
+    for path in {Path(watermark_path), raster_path(watermark_path)}:
+        try:
+            total += path.stat().st_size
+        except OSError:
+            pass
+    return total
+
+# サーバーごとのウォーターマークの使用容量を求める関数
+def guild_storage_usage(channels) -> dict:
+    """
+    channelsには(server_id, channel_id, settings)の一覧を渡す。
+    同じサーバーの複数のチャンネルで共有しているファイルは1回だけ数える。
+    """
+    paths = {}
+    for server_id, _, settings in channels:
+        active_watermark = settings.get("active_watermark")
+        if active_watermark:
+            paths.setdefault(str(server_id), set()).add(os.path.abspath(active_watermark))
+    return {server_id: sum(watermark_bytes(path) for path in server_paths) for server_id, server_paths in paths.items()}
+
+class SweepReport:
+    """
+    1回の走査の結果（理由ごとの削除したファイル数・バイト数、走査したファイルの合計サイズなど）。
+    """
+    def __init__(self):
+        self.started_at = time.time()
+        self.finished_at = None
+        self.scanned = 0
+        self.total_bytes = 0
+        self.removed = {}
+        self.reclaimed = {}
+        self.guild_usage = {}
+        self.guilds_over_quota = []
+
+    def record(self, reason: str, size: int, files=1):
+        self.removed[reason] = self.removed.get(reason, 0) + files
+        self.reclaimed[reason] = self.reclaimed.get(reason, 0) + size
+
+    @property
+    def reclaimed_bytes(self) -> int:
+        return sum(self.reclaimed.values())
+
+    def summary(self) -> str:
+        details = ", ".join(
+            f"{reason} {self.removed[reason]} files/{self.reclaimed[reason] / 1024 / 1024:.1f} MB"
+            for reason in sorted(self.reclaimed)
+        )
+        line = (
+            f"scanned {self.scanned} files ({self.total_bytes / 1024 / 1024:.1f} MB in use), "
+            f"reclaimed {self.reclaimed_bytes / 1024 / 1024:.1f} MB"
+        )
+        if details:
+            line += f" ({details})"
+        if self.guilds_over_quota:
+            line += f", {len(self.guilds_over_quota)} server(s) over quota"
+        return line
+
+class Janitor:
+    """
+    データディレクトリを少しずつ走査し、不要なファイルの削除と容量の上限の確認を行う。
+    - 一時ファイル: temp_max_age秒以上更新されていない*.tmpと、一時ディレクトリ（temp_dirs）内のファイル
+    - ウォーターマーク: ストアのインデックスに無いファイルと、どのチャンネルからも参照されていない旧形式の
+      <サーバーID>/<チャンネルID>/のファイル（temp_max_age秒以上更新されていないもの）
+    - ログ（log_dirs内）: log_max_bytesを超えたファイルは1世代だけ残してローテーションする
+    - 全体の使用量がquota_bytesを超える場合は、出力キャッシュ、ログの古い世代の順に削除する
+    - サーバーごとのウォーターマークの使用量がguild_quota_bytesを超えるサーバーを報告する
+    ディレクトリはos.scandirで少しずつ読み、1回のstep()ではbatch_size件までしか処理しない。
+    """
+    def __init__(self, data_dirs, temp_dirs=(), log_dirs=(), watermark_store=None, list_channels=None,
+                 output_cache=None, temp_max_age=3600, log_max_bytes=10 * 1024 * 1024, quota_bytes=0,
+                 guild_quota_bytes=0, batch_size=500):
+        self.roots = (
+            [("temp", Path(path)) for path in temp_dirs]
+            + [("logs", Path(path)) for path in log_dirs]
+            + [("data", Path(path)) for path in data_dirs]
+        )
+        self.legacy_roots = {os.path.abspath(path) for path in data_dirs}
+        self.watermark_store = watermark_store
+        self.list_channels = list_channels
+        self.output_cache = output_cache
+        self.temp_max_age = temp_max_age
+        self.log_max_bytes = log_max_bytes
+        self.quota_bytes = quota_bytes
+        self.guild_quota_bytes = guild_quota_bytes
+        self.batch_size = batch_size
+        self.report = None
+        self.last_report = None
+        self._entries = None
+        self._referenced = set()
+        self._log_backups = []
+
+    def begin(self):
+        """
+        走査を開始する。参照中のウォーターマークは開始時点の設定から求める。
+        """
+        self.report = SweepReport()
+        self._entries = self._walk()
+        self._log_backups = []
+        channels = self.list_channels() if self.list_channels is not None else []
+        self._referenced = {
+            os.path.abspath(settings["active_watermark"])
+            for _, _, settings in channels if settings.get("active_watermark")
+        }
+
+    def step(self) -> bool:
+        """
+        最大batch_size件のファイルを処理する。走査が終わった場合はTrueを返す。
+        """
+        now = time.time()
+        for _ in range(self.batch_size):
+            item = next(self._entries, None)
+            if item is None:
+                return True
+            kind, entry = item
+            try:
+                self._check(kind, entry, now)
+            except OSError:
+                # 走査中に削除されたファイルなど
+                pass
+        return False
+
+    def finish(self) -> SweepReport:
+        """
+        容量の上限を確認して走査を終える。
+        """
+        report = self.report
+        if self.list_channels is not None:
+            report.guild_usage = guild_storage_usage(self.list_channels())
+            if self.guild_quota_bytes:
+                report.guilds_over_quota = sorted(
+                    (server_id, usage) for server_id, usage in report.guild_usage.items()
+                    if usage > self.guild_quota_bytes
+                )
+
+        excess = report.total_bytes - self.quota_bytes if self.quota_bytes else 0
+        if excess > 0 and self.output_cache is not None:
+            entries = self.output_cache.stats()["entries"]
+            freed = self.output_cache.trim(excess)
+            if freed:
+                report.record("quota", freed, entries - self.output_cache.stats()["entries"])
+                report.total_bytes -= freed
+                excess -= freed
+        for path, size in self._log_backups:
+            if excess <= 0:
+                break
+            Path(path).unlink(missing_ok=True)
+            report.record("quota", size)
+            report.total_bytes -= size
+            excess -= size
+
+        report.finished_at = time.time()
+        self.last_report = report
+        self.report = None
+        self._entries = None
+        return report
+
+    async def run_pass(self, pause=0.01) -> SweepReport:
+        """
+        1回分の走査を行う。ファイル操作はスレッドで実行し、バッチの間はイベントループに制御を返す。
+        """
+        await asyncio.to_thread(self.begin)
+        while not await asyncio.to_thread(self.step):
+            await asyncio.sleep(pause)
+        return await asyncio.to_thread(self.finish)
+
+    def _walk(self):
+        """
+        (種類, os.DirEntry)を順に返すジェネレーター。
+        他のルートの配下にあるルートは、そのルートの種類として1回だけ走査する。
+        """
+        root_paths = {os.path.abspath(root) for _, root in self.roots}
+        for kind, root in self.roots:
+            stack = [os.path.abspath(root)]
+            while stack:
+                directory = stack.pop()
+                try:
+                    iterator = os.scandir(directory)
+                except OSError:
+                    continue
+                with iterator:
+                    for entry in iterator:
+                        if entry.is_dir(follow_symlinks=False):
+                            if entry.path not in root_paths:
+                                stack.append(entry.path)
+                        elif entry.is_file(follow_symlinks=False):
+                            yield kind, entry
+
+    def _check(self, kind: str, entry: os.DirEntry, now: float):
+        stat = entry.stat(follow_symlinks=False)
+        age = now - stat.st_mtime
+        self.report.scanned += 1
+
+        if kind == "temp" or entry.name.endswith(".tmp"):
+            if age >= self.temp_max_age:
+                os.unlink(entry.path)
+                self.report.record("temp", stat.st_size)
+                return
+        elif kind == "logs":
+            if entry.name.endswith(ROTATED_SUFFIX):
+                self._log_backups.append((entry.path, stat.st_size))
+            elif stat.st_size > self.log_max_bytes:
+                self._rotate_log(entry.path, stat.st_size)
+        elif self.watermark_store is not None and Path(entry.path).parent == self.watermark_store.root.absolute():
+            freed = self.watermark_store.remove_orphan(entry.name, self.temp_max_age)
+            if freed:
+                self.report.record("watermarks", freed)
+                return
+        elif self._is_legacy_watermark(entry.path) and age >= self.temp_max_age:
+            if os.path.abspath(entry.path) not in self._referenced:
+                os.unlink(entry.path)
+                self.report.record("watermarks", stat.st_size)
+                return
+
+        self.report.total_bytes += stat.st_size
+
+    def _rotate_log(self, path: str, size: int):
+        backup = path + ROTATED_SUFFIX
+        try:
+            previous = os.stat(backup).st_size
+        except FileNotFoundError:
+            previous = 0
+        os.replace(path, backup)
+        if previous:
+            self.report.record("logs", previous)
+        self._log_backups.append((backup, size))
+
+    def _is_legacy_watermark(self, path: str) -> bool:
+        """
+        旧形式でチャンネルごとに保存されたウォーターマーク（<データディレクトリ>/<サーバーID>/<チャンネルID>/<ファイル名>）かどうか。
+        """
+        channel_dir = os.path.dirname(path)
+        server_dir = os.path.dirname(channel_dir)
+        return (
+            os.path.dirname(server_dir) in self.legacy_roots
+            and os.path.basename(channel_dir).isdigit()
+            and os.path.basename(server_dir).isdigit()
+        )
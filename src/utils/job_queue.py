@@ -0,0 +1,208 @@
+import json
+import os
+import sqlite3
+import threading
+import time
+import uuid
+from pathlib import Path
+
+# ジョブの状態
+JOB_QUEUED = "queued"
+JOB_LEASED = "leased"
+JOB_DONE = "done"
+JOB_FAILED = "failed"
+
+class QueuedJob:
+    """
+    ワーカーが取得したジョブ。入力画像はスプールディレクトリのファイルから読み込む。
+    """
+    def __init__(self, job_id: int, payload: dict, input_path: Path, attempts: int):
+        self.id = job_id
+        self.payload = payload
+        self.input_path = input_path
+        self.attempts = attempts
+
+    def read_input(self) -> bytes:
+        return self.input_path.read_bytes()
+
+class SQLiteJobQueue:
+    """
+    ローカルのSQLite（WALモード）とスプールディレクトリを使った画像処理ジョブのキュー。
+    - 入力・出力の画像データはファイルとして保存し、DBにはパスだけを記録する。
+    - ワーカーはリース（lease_seconds）付きでジョブを取得する。期限が切れたジョブは
+      他のワーカーに再配信される（少なくとも1回の配信。ワーカーが落ちても失われない）。
+    - max_attempts回配信しても完了しないジョブは失敗として扱う。
+    - 結果を受け取った側がack()するまで、ジョブと出力ファイルは残る。
+    """
+    def __init__(self, queue_dir: Path, lease_seconds=60, max_attempts=3):
+        self.queue_dir = Path(queue_dir)
+        self.spool_dir = self.queue_dir / "spool"
+        self.spool_dir.mkdir(parents=True, exist_ok=True)
+        self.lease_seconds = lease_seconds
+        self.max_attempts = max_attempts
+        self._lock = threading.Lock()
+        self._conn = sqlite3.connect(str(self.queue_dir / "jobs.db"), timeout=30, check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        with self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS jobs ("
+                " id INTEGER PRIMARY KEY AUTOINCREMENT,"
+                " payload TEXT NOT NULL,"
+                " input_path TEXT NOT NULL,"
+                " status TEXT NOT NULL,"
+                " attempts INTEGER NOT NULL DEFAULT 0,"
+                " worker TEXT,"
+                " lease_until REAL,"
+                " output_path TEXT,"
+                " result TEXT,"
+                " error TEXT,"
+                " created_at REAL NOT NULL,"
+                " updated_at REAL NOT NULL)"
+            )
+            self._conn.execute("CREATE INDEX IF NOT EXISTS jobs_status ON jobs (status, id)")
+
+    def _write_spool(self, data: bytes, suffix: str) -> Path:
+        path = self.spool_dir / f"{uuid.uuid4().hex}{suffix}"
+        temp_path = path.with_suffix(".tmp")
+        temp_path.write_bytes(data)
+        os.replace(temp_path, path)
+        return path
+
+    def enqueue(self, payload: dict, image_data: bytes) -> int:
+        """
+        ジョブを登録してIDを返す。payloadはJSONに変換できる値のみ。
+        """
+        input_path = self._write_spool(image_data, ".in")
+        now = time.time()
+        with self._lock, self._conn:
+            cursor = self._conn.execute(
+                "INSERT INTO jobs (payload, input_path, status, created_at, updated_at) VALUES (?, ?, ?, ?, ?)",
+                (json.dumps(payload), str(input_path), JOB_QUEUED, now, now),
+            )
+            return cursor.lastrowid
+
+    def claim(self, worker_id: str):
+        """
+        最も古い待機中のジョブ（またはリース切れのジョブ）を取得する。無ければNone。
+        """
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute("BEGIN IMMEDIATE")
+            while True:
+                row = self._conn.execute(
+                    "SELECT id, payload, input_path, attempts FROM jobs"
+                    " WHERE status = ? OR (status = ? AND lease_until < ?)"
+                    " ORDER BY id LIMIT 1",
+                    (JOB_QUEUED, JOB_LEASED, now),
+                ).fetchone()
+                if row is None:
+                    return None
+                job_id, payload, input_path, attempts = row
+                if attempts >= self.max_attempts:
+                    # 処理中にワーカーが落ち続けるジョブは失敗として扱う
+                    self._conn.execute(
+                        "UPDATE jobs SET status = ?, error = ?, worker = NULL, updated_at = ? WHERE id = ?",
+                        (JOB_FAILED, f"Job was abandoned after {attempts} attempts", now, job_id),
+                    )
+                    continue
+                self._conn.execute(
+                    "UPDATE jobs SET status = ?, attempts = attempts + 1, worker = ?, lease_until = ?, updated_at = ?"
+                    " WHERE id = ?",
+                    (JOB_LEASED, worker_id, now + self.lease_seconds, now, job_id),
+                )
+                return QueuedJob(job_id, json.loads(payload), Path(input_path), attempts + 1)
+
+    def heartbeat(self, job_id: int, worker_id: str) -> bool:
+        """
+        リースを延長する。他のワーカーに再配信済みの場合はFalseを返す。
+        """
+        now = time.time()
+        with self._lock, self._conn:
+            cursor = self._conn.execute(
+                "UPDATE jobs SET lease_until = ?, updated_at = ? WHERE id = ? AND status = ? AND worker = ?",
+                (now + self.lease_seconds, now, job_id, JOB_LEASED, worker_id),
+            )
+            return cursor.rowcount == 1
+
+    def complete(self, job_id: int, worker_id: str, output_data: bytes, result: dict) -> bool:
+        """
+        処理結果を保存する。既に他のワーカーが完了していた場合は破棄してFalseを返す。
+        """
+        output_path = self._write_spool(output_data, ".out")
+        now = time.time()
+        with self._lock, self._conn:
+            cursor = self._conn.execute(
+                "UPDATE jobs SET status = ?, output_path = ?, result = ?, lease_until = NULL, updated_at = ?"
+                " WHERE id = ? AND status IN (?, ?)",
+                (JOB_DONE, str(output_path), json.dumps(result), now, job_id, JOB_QUEUED, JOB_LEASED),
+            )
+        if cursor.rowcount == 0:
+            output_path.unlink(missing_ok=True)
+            return False
+        return True
+
+    def fail(self, job_id: int, worker_id: str, error: str):
+        """
+        処理中に例外が発生したジョブを失敗として記録する（同じ入力では再試行しない）。
+        """
+        now = time.time()
+        with self._lock, self._conn:
+            self._conn.execute(
+                "UPDATE jobs SET status = ?, error = ?, lease_until = NULL, updated_at = ?"
+                " WHERE id = ? AND status IN (?, ?)",
+                (JOB_FAILED, error, now, job_id, JOB_QUEUED, JOB_LEASED),
+            )
+
+    def poll(self, job_id: int):
+        """
+        (状態, 出力データ, 結果, エラー)を返す。完了していない場合は出力データ・結果はNone。
+        """
+        with self._lock:
+            row = self._conn.execute(
+                "SELECT status, output_path, result, error FROM jobs WHERE id = ?", (job_id,)
+            ).fetchone()
+        if row is None:
+            raise KeyError(f"Unknown job: {job_id}")
+        status, output_path, result, error = row
+        if status == JOB_DONE:
+            return status, Path(output_path).read_bytes(), json.loads(result), None
+        return status, None, None, error
+
+    def ack(self, job_id: int):
+        """
+        結果を受け取ったジョブを削除する（未完了のジョブは取り消しになる）。
+        """
+        with self._lock, self._conn:
+            row = self._conn.execute(
+                "SELECT input_path, output_path FROM jobs WHERE id = ?", (job_id,)
+            ).fetchone()
+            self._conn.execute("DELETE FROM jobs WHERE id = ?", (job_id,))
+        if row is not None:
+            for path in row:
+                if path:
+                    Path(path).unlink(missing_ok=True)
+
+    def purge(self, max_age_seconds: float) -> int:
+        """
+        受け取り手がいなくなった古いジョブ（Botの再起動前に登録されたものなど）を削除する。
+        """
+        cutoff = time.time() - max_age_seconds
+        with self._lock:
+            job_ids = [row[0] for row in self._conn.execute(
+                "SELECT id FROM jobs WHERE created_at < ?", (cutoff,)
+            ).fetchall()]
+        for job_id in job_ids:
+            self.ack(job_id)
+        return len(job_ids)
+
+    def stats(self) -> dict:
+        with self._lock:
+            rows = self._conn.execute("SELECT status, COUNT(*) FROM jobs GROUP BY status").fetchall()
+        counts = {JOB_QUEUED: 0, JOB_LEASED: 0, JOB_DONE: 0, JOB_FAILED: 0}
+        counts.update(dict(rows))
+        return counts
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
@@ -0,0 +1,161 @@
+import asyncio
+import contextlib
+import functools
+import multiprocessing
+import os
+from io import BytesIO
+from concurrent.futures import ProcessPoolExecutor, ThreadPoolExecutor
+from utils.resource_guard import ResourceLimitExceeded
+
+# レンダーワーカーで発生した例外のうち、同じ型で送出し直すもの（ユーザーへのメッセージをローカル実行時とそろえる）
+REMOTE_ERROR_TYPES = {"ResourceLimitExceeded": ResourceLimitExceeded}
+
+# キューに記録されたエラー（"<例外の型名>: <メッセージ>"）を例外に戻す関数
+def remote_error(error: str) -> Exception:
+    type_name, separator, message = error.partition(": ")
+    if separator and type_name in REMOTE_ERROR_TYPES:
+        return REMOTE_ERROR_TYPES[type_name](message)
+    return RuntimeError(error)
+
+class ImageJobRunner:
+    """
+    画像処理をイベントループの外（プロセスプールまたはスレッドプール）で実行する。
+    - 同時実行数はmax_inflightで制限する。
+    - 同じチャンネルの処理はchannel_slotで直列化し、投稿順に返信する。
+    プロセスプールはforkserver（使えない環境ではspawn）で起動する。イベントループのスレッドが
+    動いている状態でforkするとロックを持ったまま複製されデッドロックする恐れがあるため。
+    ワーカーは起動時に__main__のスクリプトを読み込み直すため、起動スクリプトは軽く保つ（Botはmain.pyから起動する）。
+    """
+    def __init__(self, mode="process", max_workers=None, max_inflight=None, initializer=None, initargs=()):
+        if mode not in ("process", "thread"):
+            raise ValueError(f"Unknown worker mode: {mode}")
+        self.mode = mode
+        self.max_workers = max_workers or os.cpu_count() or 1
+        self.max_inflight = max_inflight or self.max_workers
+        self.initializer = initializer
+        self.initargs = initargs
+        self.inflight = 0
+        self.queued = 0
+        self._executor = None
+        self._semaphore = asyncio.Semaphore(self.max_inflight)
+        self._channel_locks = {}
+
+    @property
+    def executor(self):
+        # 最初のジョブまでワーカーの起動を遅らせる
+        if self._executor is None:
+            if self.mode == "process":
+                self._executor = ProcessPoolExecutor(
+                    max_workers=self.max_workers, mp_context=multiprocessing.get_context(self.start_method()),
+                    initializer=self.initializer, initargs=self.initargs,
+                )
+            else:
+                if self.initializer is not None:
+                    self.initializer(*self.initargs)
+                self._executor = ThreadPoolExecutor(
+                    max_workers=self.max_workers, thread_name_prefix="watermark"
+                )
+        return self._executor
+
+    @staticmethod
+    def start_method() -> str:
+        return "forkserver" if "forkserver" in multiprocessing.get_all_start_methods() else "spawn"
+
+    @contextlib.asynccontextmanager
+    async def channel_slot(self, channel_key):
+        """
+        チャンネル単位のロック。asyncio.Lockは待機順に取得されるため投稿順が保たれる。
+        """
+        entry = self._channel_locks.setdefault(channel_key, [asyncio.Lock(), 0])
+        entry[1] += 1
+        try:
+            async with entry[0]:
+                yield
+        finally:
+            entry[1] -= 1
+            if entry[1] == 0:
+                self._channel_locks.pop(channel_key, None)
+
+    async def run(self, func, *args, **kwargs):
+        """
+        funcをワーカーで実行し、結果を返す。
+        """
+        self.queued += 1
+        try:
+            await self._semaphore.acquire()
+        finally:
+            self.queued -= 1
+        self.inflight += 1
+        try:
+            loop = asyncio.get_running_loop()
+            return await loop.run_in_executor(self.executor, functools.partial(func, *args, **kwargs))
+        finally:
+            self.inflight -= 1
+            self._semaphore.release()
+
+    def shutdown(self, wait=True):
+        if self._executor is not None:
+            self._executor.shutdown(wait=wait, cancel_futures=True)
+            self._executor = None
+
+class QueueJobRunner(ImageJobRunner):
+    """
+    画像処理を別プロセスのレンダーワーカー（render_worker.py）に委譲する。
+    ジョブはSQLiteJobQueueに登録し、完了するまでポーリングして結果を受け取る。
+    channel_slotと同時実行数の制限はImageJobRunnerと共通。
+    """
+    # ワーカーで実行できる関数（関数名で指定する）
+    JOB_FUNCTIONS = ("process_image_bytes", "process_image_bytes_timed")
+
+    def __init__(self, queue, max_inflight=None, result_timeout=300, poll_interval=0.05, max_poll_interval=0.5):
+        super().__init__(mode="thread", max_workers=1, max_inflight=max_inflight or 64)
+        self.queue = queue
+        self.result_timeout = result_timeout
+        self.poll_interval = poll_interval
+        self.max_poll_interval = max_poll_interval
+
+    async def run(self, func, image_data: bytes, **kwargs):
+        """
+        funcと同じ結果（process_image_bytes_timedの場合はtimingsとキャッシュの回数を含む）を返す。
+        """
+        if func.__name__ not in self.JOB_FUNCTIONS:
+            raise ValueError(f"Function cannot be run by render workers: {func.__name__}")
+        payload = {
+            "kwargs": {key: str(value) if hasattr(value, "__fspath__") else value for key, value in kwargs.items()},
+        }
+
+        self.queued += 1
+        try:
+            await self._semaphore.acquire()
+        finally:
+            self.queued -= 1
+        self.inflight += 1
+        job_id = None
+        try:
+            job_id = await asyncio.to_thread(self.queue.enqueue, payload, image_data)
+            loop = asyncio.get_running_loop()
+            deadline = loop.time() + self.result_timeout
+            interval = self.poll_interval
+            while True:
+                status, output_data, result, error = await asyncio.to_thread(self.queue.poll, job_id)
+                if output_data is not None:
+                    break
+                if error is not None:
+                    raise remote_error(error)
+                if loop.time() > deadline:
+                    raise TimeoutError(f"Render job {job_id} did not finish within {self.result_timeout}s ({status})")
+                await asyncio.sleep(interval)
+                interval = min(interval * 2, self.max_poll_interval)
+        finally:
+            if job_id is not None:
+                await asyncio.to_thread(self.queue.ack, job_id)
+            self.inflight -= 1
+            self._semaphore.release()
+
+        output = BytesIO(output_data)
+        if func.__name__ == "process_image_bytes_timed":
+            return output, result["file_name"], result["timings"], result.get("overlay_cache", {})
+        return output, result["file_name"]
+
+    def shutdown(self, wait=True):
+        self.queue.close()
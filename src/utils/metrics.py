@@ -0,0 +1,174 @@
+import asyncio
+import bisect
+import contextlib
+import threading
+import time
+
+# 処理段階ごとの所要時間（秒）のバケット
+DEFAULT_BUCKETS = (0.005, 0.01, 0.025, 0.05, 0.1, 0.25, 0.5, 1.0, 2.5, 5.0, 10.0, 30.0)
+
+# 処理時間を計測してtimingsに加算するコンテキストマネージャー
+@contextlib.contextmanager
+def timed(timings, stage: str):
+    """
+    timingsがNoneの場合は何もしない（計測無効時のオーバーヘッドを抑える）。
+    """
+    if timings is None:
+        yield
+        return
+    started = time.perf_counter()
+    try:
+        yield
+    finally:
+        timings[stage] = timings.get(stage, 0.0) + time.perf_counter() - started
+
+def _format_labels(labels: tuple) -> str:
+    if not labels:
+        return ""
+    return "{" + ",".join(f'{key}="{value}"' for key, value in labels) + "}"
+
+class Histogram:
+    def __init__(self, buckets=DEFAULT_BUCKETS):
+        self.buckets = tuple(buckets)
+        self.counts = [0] * (len(self.buckets) + 1)
+        self.sum = 0.0
+        self.count = 0
+
+    def observe(self, value: float):
+        self.counts[bisect.bisect_left(self.buckets, value)] += 1
+        self.sum += value
+        self.count += 1
+
+    def quantile(self, q: float) -> float:
+        """
+        バケットの上限値から分位点を概算する。
+        """
+        if self.count == 0:
+            return 0.0
+        target = q * self.count
+        cumulative = 0
+        for index, count in enumerate(self.counts):
+            cumulative += count
+            if cumulative >= target:
+                return self.buckets[index] if index < len(self.buckets) else float("inf")
+        return float("inf")
+
+class MetricsRegistry:
+    """
+    ヒストグラム・カウンター・ゲージを保持し、Prometheusのテキスト形式で出力する。
+    enabled=Falseの場合、記録系のメソッドは何もしない。
+    """
+    def __init__(self, enabled=False):
+        self.enabled = enabled
+        self._lock = threading.Lock()
+        self._histograms = {}
+        self._counters = {}
+        self._gauges = {}
+        self._server = None
+
+    def observe(self, name: str, value: float, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            histogram = self._histograms.get(key)
+            if histogram is None:
+                histogram = self._histograms[key] = Histogram()
+            histogram.observe(value)
+
+    def observe_stages(self, timings: dict):
+        for stage, seconds in timings.items():
+            self.observe("watermark_stage_seconds", seconds, stage=stage)
+
+    def inc(self, name: str, value=1, **labels):
+        if not self.enabled:
+            return
+        key = (name, tuple(sorted(labels.items())))
+        with self._lock:
+            self._counters[key] = self._counters.get(key, 0) + value
+
+    def register_gauge(self, name: str, callback):
+        """
+        出力時にcallback()を呼び出して値を取得するゲージを登録する。
+        """
+        self._gauges[name] = callback
+
+    def render_prometheus(self) -> str:
+        lines = []
+        with self._lock:
+            histograms = sorted(self._histograms.items())
+            counters = sorted(self._counters.items())
+
+        seen = set()
+        for (name, labels), value in counters:
+            if name not in seen:
+                lines.append(f"# TYPE {name} counter")
+                seen.add(name)
+            lines.append(f"{name}{_format_labels(labels)} {value}")
+
+        for name, callback in sorted(self._gauges.items()):
+            lines.append(f"# TYPE {name} gauge")
+            lines.append(f"{name} {callback()}")
+
+        for (name, labels), histogram in histograms:
+            if name not in seen:
+                lines.append(f"# TYPE {name} histogram")
+                seen.add(name)
+            cumulative = 0
+            for bound, count in zip(histogram.buckets + (float("inf"),), histogram.counts):
+                cumulative += count
+                le = "+Inf" if bound == float("inf") else repr(bound)
+                lines.append(f"{name}_bucket{_format_labels(labels + (('le', le),))} {cumulative}")
+            lines.append(f"{name}_sum{_format_labels(labels)} {histogram.sum}")
+            lines.append(f"{name}_count{_format_labels(labels)} {histogram.count}")
+        return "\n".join(lines) + "\n"
+
+    def summary(self) -> str:
+        """
+        コマンドで表示するための簡易サマリー。
+        """
+        if not self.enabled:
+            return "Metrics are disabled."
+        lines = []
+        with self._lock:
+            for (name, labels), histogram in sorted(self._histograms.items()):
+                label = ",".join(str(value) for _, value in labels) or name
+                mean = histogram.sum / histogram.count if histogram.count else 0.0
+                lines.append(
+                    f"{label:<10} n={histogram.count:<6} mean={mean * 1000:8.1f}ms "
+                    f"p50<={histogram.quantile(0.5) * 1000:.0f}ms p95<={histogram.quantile(0.95) * 1000:.0f}ms"
+                )
+            for (name, labels), value in sorted(self._counters.items()):
+                lines.append(f"{name}{_format_labels(labels)} {value}")
+        for name, callback in sorted(self._gauges.items()):
+            lines.append(f"{name} {callback()}")
+        return "\n".join(lines) or "No metrics recorded yet."
+
+    async def _handle_http(self, reader, writer):
+        try:
+            request_line = await reader.readline()
+            # リクエストヘッダーは読み捨てる
+            while (await reader.readline()).strip():
+                pass
+            parts = request_line.decode("latin-1").split()
+            if len(parts) >= 2 and parts[0] == "GET" and parts[1] in ("/", "/metrics"):
+                body = self.render_prometheus().encode()
+                status = "200 OK"
+            else:
+                body = b"Not Found\n"
+                status = "404 Not Found"
+            writer.write(
+                f"HTTP/1.1 {status}\r\nContent-Type: text/plain; version=0.0.4\r\n"
+                f"Content-Length: {len(body)}\r\nConnection: close\r\n\r\n".encode() + body
+            )
+            await writer.drain()
+        finally:
+            writer.close()
+
+    async def start_http_server(self, host="127.0.0.1", port=9108):
+        """
+        /metricsを返すHTTPサーバーを起動する（既に起動済みなら何もしない）。
+        """
+        if not self.enabled or self._server is not None:
+            return
+        self._server = await asyncio.start_server(self._handle_http, host, port)
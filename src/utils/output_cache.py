@@ -0,0 +1,126 @@
+import hashlib
+import os
+import threading
+import uuid
+from pathlib import Path
+
+# ファイル内容のハッシュを計算する関数
+def content_hash(data) -> str:
+    return hashlib.sha256(data).hexdigest()
+
+class OutputCache:
+    """
+    処理済み画像をディスクに保存するキャッシュ。
+    キーは入力画像・ウォーターマークの内容ハッシュ、透過度、出力形式から作る。
+    合計サイズがmax_bytesを超えた場合は、最終アクセスが古いものから削除する。
+    """
+    def __init__(self, cache_dir: Path, max_bytes=512 * 1024 * 1024):
+        self.cache_dir = Path(cache_dir)
+        self.cache_dir.mkdir(parents=True, exist_ok=True)
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._lock = threading.Lock()
+        self._watermark_hashes = {}
+        # 起動時に既存のエントリを最終アクセス順で読み込む
+        self._entries = {}
+        self._current_bytes = 0
+        for entry in sorted(os.scandir(self.cache_dir), key=lambda e: e.stat().st_atime):
+            if entry.is_file() and not entry.name.endswith(".tmp"):
+                size = entry.stat().st_size
+                self._entries[entry.name] = size
+                self._current_bytes += size
+
+    def watermark_hash(self, overlay_image_path: Path) -> str:
+        """
+        ウォーターマークの内容ハッシュ。パスと更新時刻が同じ間は再計算しない。
+        """
+        stat = os.stat(overlay_image_path)
+        identity = (str(overlay_image_path), stat.st_mtime_ns, stat.st_size)
+        digest = self._watermark_hashes.get(identity)
+        if digest is None:
+            digest = content_hash(Path(overlay_image_path).read_bytes())
+            self._watermark_hashes[identity] = digest
+        return digest
+
+    def make_key(self, image_data: bytes, overlay_image_path: Path, transparency: float, output_format: str, options=()) -> str:
+        """
+        optionsには出力に影響するその他の設定（最大サイズなど）を渡す。
+        """
+        parts = [
+            content_hash(image_data),
+            self.watermark_hash(overlay_image_path),
+            f"{float(transparency):.4f}",
+            output_format.lower(),
+            *[str(option) for option in options],
+        ]
+        return content_hash("|".join(parts).encode())
+
+    def get(self, key: str):
+        """
+        キャッシュ済みの出力を返す。無い場合はNone。
+        """
+        path = self.cache_dir / key
+        with self._lock:
+            if key not in self._entries:
+                self.misses += 1
+                return None
+            try:
+                data = path.read_bytes()
+            except FileNotFoundError:
+                self._current_bytes -= self._entries.pop(key)
+                self.misses += 1
+                return None
+            # 最終アクセス順を更新（dictの末尾へ移動）
+            self._entries[key] = self._entries.pop(key)
+            self.hits += 1
+        try:
+            os.utime(path)
+        except FileNotFoundError:
+            # ロックの解放後に追い出し・掃除で削除された場合（読み込んだデータはそのまま返す）
+            pass
+        return data
+
+    def put(self, key: str, data: bytes):
+        if len(data) > self.max_bytes:
+            return
+        path = self.cache_dir / key
+        # 同じキーの書き込みが並行しても衝突しないよう、一時ファイル名は毎回変える
+        temp_path = self.cache_dir / f"{key}.{uuid.uuid4().hex}.tmp"
+        temp_path.write_bytes(data)
+        os.replace(temp_path, path)
+        with self._lock:
+            self._current_bytes -= self._entries.pop(key, 0)
+            self._entries[key] = len(data)
+            self._current_bytes += len(data)
+            self._evict()
+
+    def _evict(self):
+        while self._current_bytes > self.max_bytes and self._entries:
+            key = next(iter(self._entries))
+            self._current_bytes -= self._entries.pop(key)
+            (self.cache_dir / key).unlink(missing_ok=True)
+
+    def trim(self, bytes_to_free: int) -> int:
+        """
+        最終アクセスが古いものからbytes_to_free以上を削除し、削除したバイト数を返す（ディスク容量の上限用）。
+        """
+        freed = 0
+        with self._lock:
+            while freed < bytes_to_free and self._entries:
+                key = next(iter(self._entries))
+                size = self._entries.pop(key)
+                self._current_bytes -= size
+                (self.cache_dir / key).unlink(missing_ok=True)
+                freed += size
+        return freed
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": len(self._entries),
+                "bytes": self._current_bytes,
+                "max_bytes": self.max_bytes,
+            }
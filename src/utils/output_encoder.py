@@ -0,0 +1,180 @@
+from io import BytesIO
+from PIL import Image  # type: ignore
+
+# エンコードのプロファイル（"fast"はサイズより速度を優先する）
+ENCODE_PROFILES = ("balanced", "fast")
+
+# サイズ調整時に下げるJPEG/WebP品質の下限
+MIN_QUALITY = 30
+
+# 品質の探索で行うエンコードの最大回数（初回を含む）
+MAX_QUALITY_ATTEMPTS = 5
+
+# 可逆形式で最大圧縮・減色を試す、初回の容量と予算の比率の上限
+# （最大圧縮で減る容量は通常2割程度、256色への減色は数分の1程度のため、見込みが無ければ省略する）
+MAX_RECOMPRESS_RATIO = 1.25
+MAX_QUANTIZE_RATIO = 4.0
+
+# 縮小して再エンコードする最大回数
+MAX_DOWNSCALE_ATTEMPTS = 3
+
+# 品質で容量を調整できる形式
+LOSSY_FORMATS = ("JPEG", "WEBP")
+
+# プロファイルごとのエンコードパラメータ
+def encoder_params(image_format: str, profile="balanced") -> dict:
+    """
+    balancedはPillowの既定値と同じ出力になるパラメータを返す。
+    """
+    if profile not in ENCODE_PROFILES:
+        raise ValueError(f"Unknown encode profile: {profile}")
+    fast = profile == "fast"
+    if image_format == "JPEG":
+        return {"quality": 75, "subsampling": 2}
+    if image_format == "PNG":
+        return {"compress_level": 1 if fast else 6}
+    if image_format == "WEBP":
+        return {"quality": 80, "method": 0 if fast else 4}
+    return {}
+
+class EncodeResult:
+    """
+    エンコード結果。budgetに収まらなかった場合も最小の結果を保持する。
+    """
+    def __init__(self, data: bytes, image_format: str, attempts: int):
+        self.data = data
+        self.image_format = image_format
+        self.attempts = attempts
+
+    @property
+    def size(self) -> int:
+        return len(self.data)
+
+class BudgetEncoder:
+    """
+    静止画をbyte_budget以下に収まるようにエンコードする。
+    - まず元の形式・プロファイルの既定値で1回エンコードし、収まればそれを使う。
+    - JPEG/WebPは品質を、前回の結果から補間して探索する。
+    - PNGなどの可逆形式は最大圧縮、減色、非可逆形式への変換の順に試す（allow_convert=Trueの場合）。
+    - それでも収まらない場合は縮小して再エンコードする。
+    byte_budgetが0の場合は1回だけエンコードする。
+    """
+    def __init__(self, byte_budget=0, profile="balanced", allow_convert=True):
+        if profile not in ENCODE_PROFILES:
+            raise ValueError(f"Unknown encode profile: {profile}")
+        self.byte_budget = byte_budget
+        self.profile = profile
+        self.allow_convert = allow_convert
+        self.attempts = 0
+
+    def _encode(self, image: Image.Image, image_format: str, **params) -> bytes:
+        self.attempts += 1
+        output = BytesIO()
+        image.save(output, format=image_format, **params)
+        return output.getvalue()
+
+    def _fits(self, data: bytes) -> bool:
+        return not self.byte_budget or len(data) <= self.byte_budget
+
+    def encode(self, image: Image.Image, image_format: str) -> EncodeResult:
+        self.attempts = 0
+        data = self._encode(image, image_format, **encoder_params(image_format, self.profile))
+        if self._fits(data):
+            return EncodeResult(data, image_format, self.attempts)
+
+        best = (data, image_format)
+        candidates = self._candidates(image, image_format, data)
+        for candidate_data, candidate_format in candidates:
+            if len(candidate_data) < len(best[0]):
+                best = (candidate_data, candidate_format)
+            if self._fits(candidate_data):
+                return EncodeResult(candidate_data, candidate_format, self.attempts)
+
+        # 縮小して再エンコードする
+        data, image_format = best
+        if image_format == "JPEG" and image.mode != "RGB":
+            image = image.convert("RGB")
+        for _ in range(MAX_DOWNSCALE_ATTEMPTS):
+            scale = min(0.9, (self.byte_budget / len(data)) ** 0.5 * 0.95)
+            width, height = image.size
+            image = image.resize(
+                (max(1, int(width * scale)), max(1, int(height * scale))), Image.Resampling.LANCZOS
+            )
+            data = self._encode(image, image_format, **self._smallest_params(image_format))
+            if self._fits(data):
+                break
+        return EncodeResult(data, image_format, self.attempts)
+
+    def _smallest_params(self, image_format: str) -> dict:
+        params = encoder_params(image_format, self.profile)
+        if image_format in LOSSY_FORMATS:
+            params["quality"] = MIN_QUALITY
+        elif image_format == "PNG":
+            params["compress_level"] = 9
+        return params
+
+    def _candidates(self, image: Image.Image, image_format: str, first_data: bytes):
+        """
+        予算に収まる可能性が高くなる順にエンコード結果を返すジェネレーター。
+        """
+        if image_format in LOSSY_FORMATS:
+            yield self._search_quality(image, image_format, first_data)
+            return
+
+        ratio = len(first_data) / self.byte_budget
+        # 可逆のまま最大圧縮（PNG以外の形式はPNGへ変換）
+        if (image_format == "PNG" or self.allow_convert) and ratio <= MAX_RECOMPRESS_RATIO:
+            yield self._encode(image, "PNG", compress_level=9), "PNG"
+        if not self.allow_convert:
+            return
+
+        has_alpha = image.mode in ("RGBA", "LA", "PA") and image.getchannel("A").getextrema()[0] < 255
+        if has_alpha:
+            # 透過を保ったまま256色に減色し、それでも大きければWebPへ変換
+            if ratio <= MAX_QUANTIZE_RATIO:
+                quantized = image.convert("RGBA").quantize(256, method=Image.Quantize.FASTOCTREE)
+                yield self._encode(quantized, "PNG", compress_level=9), "PNG"
+            yield self._search_quality(image, "WEBP")
+        else:
+            yield self._search_quality(image.convert("RGB"), "JPEG")
+
+    def _search_quality(self, image: Image.Image, image_format: str, first_data=None) -> tuple[bytes, str]:
+        """
+        予算に収まる最も高い品質を探す。品質と容量がほぼ単調な関係にあることを利用し、
+        既知の2点から補間して次の品質を決める。収まらない場合は最小の結果を返す。
+        """
+        params = encoder_params(image_format, self.profile)
+        high_quality = params["quality"]
+        if first_data is None:
+            first_data = self._encode(image, image_format, **params)
+            if self._fits(first_data):
+                return first_data, image_format
+        high_size = len(first_data)
+        best_fit = None
+        smallest = first_data
+        low_quality, low_size = None, None
+
+        for _ in range(MAX_QUALITY_ATTEMPTS - 1):
+            if low_quality is None:
+                # 下限が未知の場合は容量が品質に比例すると仮定して推定する
+                quality = int(high_quality * self.byte_budget / high_size)
+            else:
+                ratio = (self.byte_budget - low_size) / max(1, high_size - low_size)
+                quality = low_quality + int((high_quality - low_quality) * ratio)
+            quality = max(MIN_QUALITY, min(quality, high_quality - 1))
+            if low_quality is not None and quality <= low_quality:
+                break
+
+            data = self._encode(image, image_format, **dict(params, quality=quality))
+            if len(data) < len(smallest):
+                smallest = data
+            if len(data) > self.byte_budget:
+                if quality == MIN_QUALITY:
+                    break
+                high_quality, high_size = quality, len(data)
+            else:
+                best_fit = data
+                low_quality, low_size = quality, len(data)
+                if high_quality - low_quality <= 2:
+                    break
+        return (best_fit if best_fit is not None else smallest), image_format
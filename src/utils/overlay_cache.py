@@ -0,0 +1,85 @@
+from collections import OrderedDict
+from pathlib import Path
+import threading
+
+# ウォーターマークファイルを識別するキーを作成する関数
+def watermark_identity(overlay_image_path: Path) -> tuple:
+    """
+    パス・更新時刻・サイズからウォーターマークの識別子を作る。
+    同じパスに上書き保存された場合も別物として扱われる。
+    """
+    path = Path(overlay_image_path)
+    stat = path.stat()
+    return (str(path.resolve()), stat.st_mtime_ns, stat.st_size)
+
+class OverlayCache:
+    """
+    リサイズ・透過度適用済みのウォーターマークを保持するLRUキャッシュ。
+    上限はバイト数で指定する。
+    キーにファイルの更新時刻・サイズを含むため、ウォーターマークが書き換えられると別のエントリになる
+    （明示的な破棄は不要で、古いエントリはLRUで追い出される）。
+    """
+    def __init__(self, max_bytes=64 * 1024 * 1024):
+        self.max_bytes = max_bytes
+        self.hits = 0
+        self.misses = 0
+        self._entries = OrderedDict()
+        self._current_bytes = 0
+        self._lock = threading.Lock()
+
+    @staticmethod
+    def _entry_size(entry) -> int:
+        if hasattr(entry, "nbytes"):
+            return entry.nbytes
+        return entry.width * entry.height * len(entry.getbands())
+
+    def get_or_create(self, overlay_image_path: Path, size: tuple, transparency: float, factory, counts=None):
+        """
+        キャッシュ済みのオーバーレイを返す。無ければfactory()で作成して登録する。
+        countsにdictを渡すと、ヒット・ミスの回数（"hits"・"misses"）が加算される。
+        """
+        key = (watermark_identity(overlay_image_path), tuple(size), round(float(transparency), 4))
+        with self._lock:
+            entry = self._entries.get(key)
+            if entry is not None:
+                self._entries.move_to_end(key)
+                self.hits += 1
+                if counts is not None:
+                    counts["hits"] = counts.get("hits", 0) + 1
+                return entry
+            self.misses += 1
+            if counts is not None:
+                counts["misses"] = counts.get("misses", 0) + 1
+
+        entry = factory()
+        entry_size = self._entry_size(entry)
+
+        with self._lock:
+            # 上限を超える単体エントリはキャッシュしない
+            if entry_size > self.max_bytes:
+                return entry
+            if key not in self._entries:
+                self._entries[key] = entry
+                self._current_bytes += entry_size
+            self._evict()
+        return entry
+
+    def _evict(self):
+        while self._current_bytes > self.max_bytes and self._entries:
+            _, evicted = self._entries.popitem(last=False)
+            self._current_bytes -= self._entry_size(evicted)
+
+    def set_max_bytes(self, max_bytes: int):
+        with self._lock:
+            self.max_bytes = max_bytes
+            self._evict()
+
+    def stats(self) -> dict:
+        with self._lock:
+            return {
+                "hits": self.hits,
+                "misses": self.misses,
+                "entries": len(self._entries),
+                "bytes": self._current_bytes,
+                "max_bytes": self.max_bytes,
+            }
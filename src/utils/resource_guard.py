@@ -0,0 +1,199 @@
+import math
+from io import BytesIO
+from pathlib import Path
+
+# 処理に必要なメモリの見積もりに使う係数（バイト/画素、ベンチマークのピークRSSから求めた値）
+# 静止画: 出力サイズの画素あたり（RGBA変換・合成・ウォーターマーク・出力形式への変換・エンコード）
+STILL_BYTES_PER_PIXEL = 16
+# アニメーション: 1フレームの画素あたり（FRAME_BATCH_SIZE枚分のフレームと合成用の配列）
+ANIMATION_BYTES_PER_PIXEL = 140
+# アニメーション: 入力データ1バイトあたり（エンコード済みの出力は入力と同程度の大きさでメモリ上に溜まる）
+ANIMATION_BYTES_PER_INPUT_BYTE = 2
+# 画像の大きさに依存しない分
+BASE_MEMORY_BYTES = 8 * 1024 * 1024
+
+# 透過情報を持つ画像を縮小する際、Pillowが作るアルファ乗算済みのコピーの分（デコードサイズに対する倍率）
+ALPHA_RESIZE_FACTOR = 2
+
+# Pillowが画素を保持する際の1画素あたりのバイト数（ここに無いモードは4バイト）
+MODE_BYTES = {"1": 1, "L": 1, "P": 1, "I;16": 2, "I;16B": 2, "I;16L": 2}
+
+# メモリの上限に合わせて縮小する際の、長辺の下限と1回あたりの縮小率
+MIN_DOWNSCALE_DIMENSION = 256
+DOWNSCALE_STEP = 0.8
+
+# JPEGの縮小デコード（draft）で選ばれる縮小率
+JPEG_DRAFT_SCALES = (8, 4, 2, 1)
+
+class ResourceLimitExceeded(ValueError):
+    """
+    画像の処理に必要なメモリや処理量が上限を超える場合の例外（メッセージはユーザーに表示する）。
+    """
+
+class ImageHeader:
+    """
+    デコード前にヘッダーから読み取った画像の情報。
+    """
+    def __init__(self, size: tuple, mode: str, frames: int, image_format: str, animated: bool, data_size=0):
+        self.size = size
+        self.mode = mode
+        self.frames = frames
+        self.image_format = image_format
+        self.animated = animated
+        self.data_size = data_size
+
+class JobEstimate:
+    """
+    ジョブのピークメモリ（バイト）と処理量（全フレームの合計画素数）の見積もり。
+    max_dimensionは処理に使う長辺の上限（メモリの上限に合わせて縮小する場合は元の値より小さくなる）。
+    """
+    def __init__(self, header: ImageHeader, memory_bytes: int, pixels: int, output_size: tuple, max_dimension: int):
+        self.header = header
+        self.memory_bytes = memory_bytes
+        self.pixels = pixels
+        self.output_size = output_size
+        self.max_dimension = max_dimension
+
+    @property
+    def downscaled(self) -> bool:
+        return self.output_size != self.header.size
+
+# 画像データを開く関数（画素はデコードしない）
+def open_image(image_data: bytes):
+    """
+    PillowのDecompressionBombErrorはResourceLimitExceededとして送出する。
+    """
+    from PIL import Image  # type: ignore
+    try:
+        return Image.open(BytesIO(image_data))
+    except Image.DecompressionBombError as e:
+        raise ResourceLimitExceeded(f"Image has too many pixels to process: {e}")
+
+# 開いた画像のヘッダー情報を読み取る関数
+def read_header(image, extension: str, data_size=0) -> ImageHeader:
+    """
+    アニメーションとして処理するのはGIF・PNGのみ（watermark_processorと同じ判定）。
+    フレーム数はフレームをデコードせずに数える。
+    """
+    animated = extension in [".gif", ".png"] and getattr(image, "is_animated", False)
+    frames = image.n_frames if animated else 1
+    return ImageHeader(image.size, image.mode, frames, image.format, animated, data_size)
+
+# 画像データのヘッダー情報を読み取る関数
+def inspect_image(image_data: bytes, extension: str) -> ImageHeader:
+    with open_image(image_data) as image:
+        return read_header(image, extension, len(image_data))
+
+# 長辺の上限を適用した出力サイズを求める関数（Image.thumbnailと同じ計算）
+def output_size(size: tuple, max_dimension: int) -> tuple:
+    width, height = size
+    if not max_dimension or max(width, height) <= max_dimension:
+        return size
+    scale = max_dimension / max(width, height)
+    return (max(1, round(width * scale)), max(1, round(height * scale)))
+
+# 実際にデコードされるサイズを求める関数
+def decoded_size(header: ImageHeader, target: tuple) -> tuple:
+    """
+    JPEGは縮小時に出力サイズの2倍（reducing_gap）以上を保つ範囲で縮小デコードされる。
+    """
+    width, height = header.size
+    if header.image_format != "JPEG" or target == header.size:
+        return header.size
+    for scale in JPEG_DRAFT_SCALES:
+        if width // scale >= target[0] * 2 and height // scale >= target[1] * 2:
+            return (-(-width // scale), -(-height // scale))
+    return header.size
+
+# ジョブのピークメモリと処理量を見積もる関数
+def estimate_job(header: ImageHeader, max_dimension=0) -> JobEstimate:
+    if header.animated:
+        width, height = header.size
+        frame_pixels = width * height
+        memory = (
+            BASE_MEMORY_BYTES
+            + frame_pixels * ANIMATION_BYTES_PER_PIXEL
+            + header.data_size * ANIMATION_BYTES_PER_INPUT_BYTE
+        )
+        return JobEstimate(header, int(memory), frame_pixels * header.frames, header.size, max_dimension)
+
+    target = output_size(header.size, max_dimension)
+    decoded_width, decoded_height = decoded_size(header, target)
+    decoded = decoded_width * decoded_height
+    pixels = target[0] * target[1]
+    decode_bytes = decoded * MODE_BYTES.get(header.mode, 4)
+    if target != header.size and "A" in header.mode:
+        decode_bytes *= ALPHA_RESIZE_FACTOR
+    memory = BASE_MEMORY_BYTES + decode_bytes + pixels * STILL_BYTES_PER_PIXEL
+    return JobEstimate(header, int(memory), max(decoded, pixels), target, max_dimension)
+
+# 上限に収まるように処理方法を決める関数
+def plan_job(header: ImageHeader, memory_budget=0, pixel_budget=0, max_dimension=0) -> JobEstimate:
+    """
+    見積もりがメモリの上限（memory_budget、バイト）または処理量の上限（pixel_budget、画素数）を超える場合:
+    - 静止画は長辺の上限を下げて、収まるサイズまで縮小して処理する。
+    - アニメーション、または縮小しても収まらない静止画はResourceLimitExceeded。
+    上限が0の場合はその項目を確認しない。
+    """
+    def fits(estimate: JobEstimate) -> bool:
+        return (not memory_budget or estimate.memory_bytes <= memory_budget) and (
+            not pixel_budget or estimate.pixels <= pixel_budget
+        )
+
+    estimate = estimate_job(header, max_dimension)
+    if fits(estimate):
+        return estimate
+
+    if not header.animated:
+        dimension = max(estimate.output_size)
+        while dimension > MIN_DOWNSCALE_DIMENSION:
+            dimension = max(MIN_DOWNSCALE_DIMENSION, int(dimension * DOWNSCALE_STEP))
+            candidate = estimate_job(header, dimension)
+            if fits(candidate):
+                return candidate
+            estimate = candidate
+
+    width, height = header.size
+    if memory_budget and estimate.memory_bytes > memory_budget:
+        raise ResourceLimitExceeded(
+            f"Image is too large to process ({width}x{height}, {header.frames} frame(s)): needs about "
+            f"{estimate.memory_bytes / 1024 / 1024:.0f} MB of memory, limit is {memory_budget / 1024 / 1024:.0f} MB."
+        )
+    raise ResourceLimitExceeded(
+        f"Image is too large to process ({width}x{height}, {header.frames} frame(s)): "
+        f"{estimate.pixels / 1e6:.0f} megapixels in total, limit is {pixel_budget / 1e6:.0f}."
+    )
+
+# ウォーターマークとして保存できる大きさか確認する関数
+def check_watermark(header: ImageHeader, memory_budget=0, max_pixels=0):
+    """
+    ウォーターマークは縮小せずにRGBAの画素として保存するため、上限を超える場合はResourceLimitExceeded。
+    上限が0の場合はその項目を確認しない。
+    """
+    width, height = header.size
+    if max_pixels and width * height > max_pixels:
+        raise ResourceLimitExceeded(
+            f"Watermark image is too large ({width}x{height}): limit is {max_pixels / 1e6:.0f} megapixels."
+        )
+    estimate = estimate_job(header)
+    if memory_budget and estimate.memory_bytes > memory_budget:
+        raise ResourceLimitExceeded(
+            f"Watermark image is too large ({width}x{height}): needs about "
+            f"{estimate.memory_bytes / 1024 / 1024:.0f} MB of memory, limit is {memory_budget / 1024 / 1024:.0f} MB."
+        )
+
+# 画像データのヘッダーを読み取り、処理方法を決める関数（Bot側でジョブを投入する前に使う）
+def plan_image_bytes(image_data: bytes, file_name: str, memory_budget=0, pixel_budget=0, max_dimension=0) -> JobEstimate:
+    header = inspect_image(image_data, Path(file_name).suffix.lower())
+    return plan_job(header, memory_budget, pixel_budget, max_dimension)
+
+# 見積もりメモリをスケジューラーのコストに換算する関数
+def slot_cost(memory_bytes: int, total_budget: int, capacity: int) -> int:
+    """
+    全体のメモリの上限（total_budget）を実行枠の数（capacity）で等分し、
+    ジョブが何枠分のメモリを使うかを返す（1〜capacity）。total_budgetが0の場合は常に1。
+    """
+    if not total_budget or capacity <= 1:
+        return 1
+    per_slot = total_budget / capacity
+    return max(1, min(capacity, math.ceil(memory_bytes / per_slot)))
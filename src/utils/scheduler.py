@@ -0,0 +1,213 @@
+import asyncio
+import collections
+import contextlib
+import time
+
+class SchedulerBusy(Exception):
+    """
+    キューの上限超過や待ち時間の超過でジョブを受け付けなかった場合の例外。
+    reasonは"queue_full"または"timeout"。
+    """
+    def __init__(self, reason: str, key=None):
+        super().__init__(f"Scheduler is busy ({reason})")
+        self.reason = reason
+        self.key = key
+
+class _GuildQueue:
+    def __init__(self, key, weight: int, queue_cap: int):
+        self.key = key
+        self.weight = weight
+        self.queue_cap = queue_cap
+        self.admitted = 0
+        self.running = 0
+        self.waiters = collections.deque()
+        self.current_weight = 0
+        self.completed = 0
+        self.shed = 0
+
+class Admission:
+    """
+    受け付け済みのジョブ（1メッセージ分）。slot()で実行枠を取得する。
+    """
+    def __init__(self, scheduler, queue: _GuildQueue, jobs: int):
+        self.scheduler = scheduler
+        self.queue = queue
+        self.jobs = jobs
+        self.admitted_at = time.monotonic()
+        self.deadline = self.admitted_at + scheduler.max_wait
+
+    @contextlib.asynccontextmanager
+    async def slot(self, cost=1):
+        """
+        実行枠を取得する。受け付けからmax_waitを過ぎても取得できない場合はSchedulerBusy。
+        """
+        await self.scheduler._acquire(self, cost)
+        try:
+            yield
+        finally:
+            self.scheduler._release(self.queue, cost)
+
+class FairScheduler:
+    """
+    サーバー（ギルド）ごとのキューから重み付きラウンドロビンで画像処理ジョブを実行する。
+    - 同時に実行するジョブのコストの合計はcapacity以下（1ジョブのコストが上限を超える場合は単独で実行）。
+    - サーバーごとに受け付け済みのジョブ数がqueue_capを超える場合は受け付けない。
+    - 受け付けからmax_wait秒以内に実行できないジョブは取り消す。
+    limitsにはサーバーのキーから(重み, キュー上限)を返す関数を渡す（Noneの場合は既定値）。
+    """
+    def __init__(self, capacity: int, queue_cap=32, max_wait=60.0, default_weight=1, limits=None):
+        self.capacity = capacity
+        self.queue_cap = queue_cap
+        self.max_wait = max_wait
+        self.default_weight = default_weight
+        self.limits = limits
+        self.running_cost = 0
+        self.shed_total = 0
+        self._queues = {}
+
+    def _queue(self, key) -> _GuildQueue:
+        queue = self._queues.get(key)
+        if queue is None:
+            weight, queue_cap = self.default_weight, self.queue_cap
+            if self.limits is not None:
+                custom_weight, custom_cap = self.limits(key)
+                weight = custom_weight or weight
+                queue_cap = custom_cap or queue_cap
+            queue = self._queues[key] = _GuildQueue(key, max(1, int(weight)), int(queue_cap))
+        return queue
+
+    def _discard_if_idle(self, queue: _GuildQueue):
+        if queue.admitted == 0 and queue.running == 0 and not queue.waiters:
+            self._queues.pop(queue.key, None)
+
+    @contextlib.contextmanager
+    def admit(self, key, jobs=1):
+        """
+        ジョブを受け付ける。キューが上限に達している場合はSchedulerBusy("queue_full")。
+        """
+        queue = self._queue(key)
+        if queue.admitted + jobs > queue.queue_cap:
+            queue.shed += jobs
+            self.shed_total += jobs
+            self._discard_if_idle(queue)
+            raise SchedulerBusy("queue_full", key)
+        queue.admitted += jobs
+        try:
+            yield Admission(self, queue, jobs)
+        finally:
+            queue.admitted -= jobs
+            self._discard_if_idle(queue)
+
+    def reload_limits(self, key=None):
+        """
+        サーバーの重み・キュー上限の設定変更を反映する（次回の受け付けから）。
+        """
+        for queue in [self._queues.get(key)] if key is not None else list(self._queues.values()):
+            if queue is not None and self.limits is not None:
+                weight, queue_cap = self.limits(queue.key)
+                queue.weight = max(1, int(weight or self.default_weight))
+                queue.queue_cap = int(queue_cap or self.queue_cap)
+
+    def _can_start(self, cost: int) -> bool:
+        return self.running_cost == 0 or self.running_cost + cost <= self.capacity
+
+    async def _acquire(self, admission: Admission, cost: int):
+        queue = admission.queue
+        if not queue.waiters and self._can_start(cost) and not self._has_waiters():
+            self._start(queue, cost)
+            return
+
+        loop = asyncio.get_running_loop()
+        future = loop.create_future()
+        entry = (future, cost)
+        queue.waiters.append(entry)
+        timeout = admission.deadline - time.monotonic()
+        try:
+            await asyncio.wait_for(asyncio.shield(future), max(0.0, timeout))
+        except asyncio.TimeoutError:
+            if future.done() and not future.cancelled():
+                # 取得と同時にタイムアウトした場合は実行を続ける
+                return
+            future.cancel()
+            self._remove_waiter(queue, entry)
+            queue.shed += 1
+            self.shed_total += 1
+            raise SchedulerBusy("timeout", queue.key)
+        except asyncio.CancelledError:
+            if future.done() and not future.cancelled():
+                self._release(queue, cost)
+            else:
+                future.cancel()
+                self._remove_waiter(queue, entry)
+            raise
+
+    def _remove_waiter(self, queue: _GuildQueue, entry):
+        try:
+            queue.waiters.remove(entry)
+        except ValueError:
+            pass
+        self._dispatch()
+
+    def _has_waiters(self) -> bool:
+        return any(queue.waiters for queue in self._queues.values())
+
+    def _start(self, queue: _GuildQueue, cost: int):
+        queue.running += 1
+        self.running_cost += cost
+
+    def _release(self, queue: _GuildQueue, cost: int):
+        queue.running -= 1
+        queue.completed += 1
+        self.running_cost -= cost
+        self._dispatch()
+        self._discard_if_idle(queue)
+
+    def _dispatch(self):
+        """
+        空いた実行枠を、待機中のサーバーに重み付きラウンドロビン（smooth weighted round-robin）で割り当てる。
+        """
+        while True:
+            active = [queue for queue in self._queues.values() if queue.waiters]
+            if not active:
+                return
+            total = 0
+            for queue in active:
+                queue.current_weight += queue.weight
+                total += queue.weight
+            chosen = max(active, key=lambda q: q.current_weight)
+            future, cost = chosen.waiters[0]
+            if not self._can_start(cost):
+                # 選ばれたサーバーの先頭ジョブが入るまで待つ（順番は次回に持ち越す）
+                for queue in active:
+                    queue.current_weight -= queue.weight
+                return
+            chosen.current_weight -= total
+            chosen.waiters.popleft()
+            if future.cancelled():
+                continue
+            self._start(chosen, cost)
+            future.set_result(None)
+
+    def stats(self) -> dict:
+        """
+        全体とサーバーごとの待機数・実行数を返す。
+        """
+        guilds = {
+            str(queue.key): {
+                "weight": queue.weight,
+                "queue_cap": queue.queue_cap,
+                "admitted": queue.admitted,
+                "waiting": len(queue.waiters),
+                "running": queue.running,
+                "shed": queue.shed,
+            }
+            for queue in self._queues.values()
+        }
+        return {
+            "capacity": self.capacity,
+            "running_cost": self.running_cost,
+            "waiting": sum(len(queue.waiters) for queue in self._queues.values()),
+            "admitted": sum(queue.admitted for queue in self._queues.values()),
+            "shed_total": self.shed_total,
+            "guilds": guilds,
+        }
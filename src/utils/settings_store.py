@@ -0,0 +1,180 @@
+import json
+import sqlite3
+import threading
+from pathlib import Path
+
+class SQLiteSettingsStore:
+    """
+    チャンネル設定をSQLite（WALモード）に保存する。
+    - 読み込みはメモリ上のキャッシュから行い、ファイルアクセスは発生しない。
+    - 更新は1行単位のトランザクションで行う。
+    """
+    def __init__(self, db_path: Path):
+        self.db_path = Path(db_path)
+        self._lock = threading.Lock()
+        self._cache = {}
+        self._server_cache = {}
+        self._conn = sqlite3.connect(str(self.db_path), check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        self._conn.execute("PRAGMA synchronous=NORMAL")
+        with self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS channel_settings ("
+                " server_id TEXT NOT NULL,"
+                " channel_id TEXT NOT NULL,"
+                " settings TEXT NOT NULL,"
+                " PRIMARY KEY (server_id, channel_id))"
+            )
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS server_settings ("
+                " server_id TEXT PRIMARY KEY,"
+                " settings TEXT NOT NULL)"
+            )
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS meta (key TEXT PRIMARY KEY, value TEXT NOT NULL)"
+            )
+
+    @staticmethod
+    def _key(server_id, channel_id) -> tuple:
+        return (str(server_id), str(channel_id))
+
+    def _load_row(self, key) -> dict:
+        row = self._conn.execute(
+            "SELECT settings FROM channel_settings WHERE server_id = ? AND channel_id = ?", key
+        ).fetchone()
+        return json.loads(row[0]) if row else {}
+
+    def get_channel(self, server_id, channel_id) -> dict:
+        key = self._key(server_id, channel_id)
+        with self._lock:
+            settings = self._cache.get(key)
+            if settings is None:
+                # 未登録のチャンネルも空の設定としてキャッシュする
+                settings = self._cache[key] = self._load_row(key)
+            return dict(settings)
+
+    def get_server(self, server_id) -> dict:
+        with self._lock:
+            rows = self._conn.execute(
+                "SELECT channel_id, settings FROM channel_settings WHERE server_id = ?", (str(server_id),)
+            ).fetchall()
+        return {"channels": {channel_id: json.loads(settings) for channel_id, settings in rows}}
+
+    def iter_channels(self) -> list:
+        """
+        全チャンネルの(server_id, channel_id, 設定)の一覧。
+        """
+        with self._lock:
+            rows = self._conn.execute("SELECT server_id, channel_id, settings FROM channel_settings").fetchall()
+        return [(server_id, channel_id, json.loads(settings)) for server_id, channel_id, settings in rows]
+
+    def update_channel(self, server_id, channel_id, updates: dict) -> dict:
+        """
+        既存の設定にupdatesをマージして保存し、更新後の設定を返す。
+        """
+        key = self._key(server_id, channel_id)
+        with self._lock, self._conn:
+            self._conn.execute("BEGIN IMMEDIATE")
+            settings = self._load_row(key)
+            settings.update(updates)
+            self._conn.execute(
+                "INSERT INTO channel_settings (server_id, channel_id, settings) VALUES (?, ?, ?)"
+                " ON CONFLICT (server_id, channel_id) DO UPDATE SET settings = excluded.settings",
+                key + (json.dumps(settings),),
+            )
+            self._cache[key] = settings
+            return dict(settings)
+
+    def get_guild(self, server_id) -> dict:
+        """
+        サーバー単位の設定（アップロード容量の上限など）を返す。
+        """
+        key = str(server_id)
+        with self._lock:
+            settings = self._server_cache.get(key)
+            if settings is None:
+                row = self._conn.execute(
+                    "SELECT settings FROM server_settings WHERE server_id = ?", (key,)
+                ).fetchone()
+                settings = self._server_cache[key] = json.loads(row[0]) if row else {}
+            return dict(settings)
+
+    def update_guild(self, server_id, updates: dict) -> dict:
+        """
+        サーバー単位の設定にupdatesをマージして保存する。値がNoneのキーは削除する。
+        """
+        key = str(server_id)
+        with self._lock, self._conn:
+            self._conn.execute("BEGIN IMMEDIATE")
+            row = self._conn.execute(
+                "SELECT settings FROM server_settings WHERE server_id = ?", (key,)
+            ).fetchone()
+            settings = json.loads(row[0]) if row else {}
+            settings.update(updates)
+            settings = {name: value for name, value in settings.items() if value is not None}
+            self._conn.execute(
+                "INSERT INTO server_settings (server_id, settings) VALUES (?, ?)"
+                " ON CONFLICT (server_id) DO UPDATE SET settings = excluded.settings",
+                (key, json.dumps(settings)),
+            )
+            self._server_cache[key] = settings
+            return dict(settings)
+
+    def replace_server(self, server_id, server_settings: dict):
+        """
+        サーバー全体のチャンネル設定を置き換える（save_server_settings互換）。
+        """
+        rows = [
+            (str(server_id), str(channel_id), json.dumps(settings))
+            for channel_id, settings in server_settings.get("channels", {}).items()
+        ]
+        with self._lock, self._conn:
+            self._conn.execute("DELETE FROM channel_settings WHERE server_id = ?", (str(server_id),))
+            self._conn.executemany(
+                "INSERT INTO channel_settings (server_id, channel_id, settings) VALUES (?, ?, ?)", rows
+            )
+            for key in [k for k in self._cache if k[0] == str(server_id)]:
+                del self._cache[key]
+
+    def delete_channel(self, server_id, channel_id):
+        key = self._key(server_id, channel_id)
+        with self._lock, self._conn:
+            self._conn.execute(
+                "DELETE FROM channel_settings WHERE server_id = ? AND channel_id = ?", key
+            )
+            self._cache[key] = {}
+
+    def migrate_json_tree(self, base_dir: Path) -> int:
+        """
+        <base_dir>/<server>/settings.json の既存設定を一度だけ取り込む。
+        取り込んだチャンネル数を返す。
+        """
+        with self._lock:
+            done = self._conn.execute("SELECT value FROM meta WHERE key = 'json_migrated'").fetchone()
+        if done:
+            return 0
+
+        rows = []
+        for settings_file in Path(base_dir).glob("*/settings.json"):
+            try:
+                with open(settings_file, "r") as f:
+                    server_settings = json.load(f)
+            except (OSError, ValueError) as e:
+                print(f"Skipping unreadable settings file {settings_file}: {e}")
+                continue
+            server_id = settings_file.parent.name
+            for channel_id, settings in server_settings.get("channels", {}).items():
+                rows.append((server_id, str(channel_id), json.dumps(settings)))
+
+        with self._lock, self._conn:
+            # 既に登録済みの行は上書きしない
+            self._conn.executemany(
+                "INSERT OR IGNORE INTO channel_settings (server_id, channel_id, settings) VALUES (?, ?, ?)", rows
+            )
+            self._conn.execute("INSERT OR REPLACE INTO meta (key, value) VALUES ('json_migrated', '1')")
+            self._cache.clear()
+        return len(rows)
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
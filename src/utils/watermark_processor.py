@@ -1,38 +1,100 @@
 from PIL import Image  # type: ignore
-import imageio.v3 as iio  # type: ignore
 from pathlib import Path
+from io import BytesIO
 import numpy as np  # type: ignore
+from utils.overlay_cache import OverlayCache
+from utils.animation_encoder import GifStreamWriter, ApngStreamWriter
+from utils.compositor import NumpyCompositor, OpaqueCompositor, PreparedOverlay, as_prepared
+from utils.output_encoder import BudgetEncoder, ENCODE_PROFILES
+from utils.image_formats import format_for_extension, get_output_file_name
+from utils.watermark_store import load_watermark
+from utils.resource_guard import open_image, read_header, plan_job
+from utils.metrics import timed
+
+# 準備済みオーバーレイのキャッシュ（プロセス内で共有）
+# キーにファイルの更新時刻・サイズを含むため、ウォーターマークの変更・削除時に破棄する必要はない
+# （使われなくなったエントリはLRUで追い出される）
+overlay_cache = OverlayCache()
+
+# 合成処理の実装（"numpy"はフレームをまとめて合成、"pillow"は従来の1枚ずつの合成）
+COMPOSITORS = ("numpy", "pillow")
+
+# numpy合成でまとめて処理するフレーム数
+FRAME_BATCH_SIZE = 8
+
+# 分割合成で一度に処理する行数
+TILE_ROWS = 512
+
+# ワーカープロセスの初期化関数
+def init_worker(overlay_cache_bytes: int):
+    overlay_cache.set_max_bytes(overlay_cache_bytes)
 
 # ファイル拡張子を判定する関数
 def get_file_extension(file_path: Path) -> str:
     return file_path.suffix.lower()
 
-# オーバーレイ処理を行う関数
-def overlay_images(base_frame: Image.Image, overlay_image: Image.Image, transparency: float) -> Image.Image:
+# ウォーターマークのアルファに透過度を掛ける関数
+def apply_transparency(overlay_image: Image.Image, transparency: float) -> Image.Image:
+    overlay_with_alpha = overlay_image.copy()
+    lut = [int(p * transparency) for p in range(256)]
+    alpha = overlay_with_alpha.getchannel("A").point(lut)
+    overlay_with_alpha.putalpha(alpha)
+    return overlay_with_alpha
+
+# リサイズと透過度適用を済ませたウォーターマークを取得する関数
+def prepare_overlay(overlay_image_path: Path, size: tuple, transparency: float, cache_counts=None) -> PreparedOverlay:
+    """
+    ウォーターマークを読み込み、指定サイズへのリサイズと透過度の適用を行う。
+    結果はoverlay_cacheに保持されるため、呼び出し側で変更してはいけない。
+    cache_countsにdictを渡すと、キャッシュのヒット・ミスの回数が記録される。
+    """
+    def build():
+        # ストアに保存されたウォーターマークはデコード済みの画素を読み込む
+        overlay_image = load_watermark(overlay_image_path)
+        overlay_image = overlay_image.resize(size, Image.Resampling.LANCZOS)
+        return PreparedOverlay.from_image(apply_transparency(overlay_image, transparency))
+
+    return overlay_cache.get_or_create(overlay_image_path, size, transparency, build, cache_counts)
+
+# 準備済みのウォーターマークを重ねる関数
+def composite_overlay(base_frame: Image.Image, prepared_overlay, in_place=False) -> Image.Image:
     """
     透過情報を考慮しながらウォーターマークを重ねる。
     - 元の透過部分にはウォーターマークを適用しない。
+    - ウォーターマークの空でない領域だけを合成し、それ以外の画素には触れない。
+    in_place=Trueの場合はbase_frameを直接書き換える。
     """
-    if "A" in base_frame.mode:
-        base_alpha = base_frame.split()[3]
-        base_alpha_np = np.array(base_alpha)
-        mask = base_alpha_np == 0  # 完全に透過している部分をマスク
-    else:
-        base_alpha = None
-        mask = None
+    overlay = as_prepared(prepared_overlay)
+    result = base_frame if in_place else base_frame.copy()
+    if overlay.bbox is None:
+        return result
 
-    overlay_with_alpha = overlay_image.copy()
-    alpha = overlay_with_alpha.split()[3].point(lambda p: int(p * transparency))
-    overlay_with_alpha.putalpha(alpha)
+    bbox_left, bbox_top = overlay.bbox[:2]
+    base_alpha_np = None
+    if "A" in result.mode:
+        base_alpha_np = np.array(result.crop(overlay.bbox).getchannel("A"))
 
-    if mask is not None:
-        overlay_with_alpha_np = np.array(overlay_with_alpha)
-        overlay_with_alpha_np[mask] = [0, 0, 0, 0]
-        overlay_with_alpha = Image.fromarray(overlay_with_alpha_np, "RGBA")
+    for box in overlay.regions:
+        left, top, right, bottom = box
+        region = overlay.region_image(box)
+        if base_alpha_np is not None:
+            # 完全に透過している部分をマスク
+            mask = base_alpha_np[top - bbox_top:bottom - bbox_top, left - bbox_left:right - bbox_left] == 0
+            if mask.any():
+                region_np = np.array(region)
+                region_np[mask] = [0, 0, 0, 0]
+                region = Image.fromarray(region_np, "RGBA")
+        result.alpha_composite(region, dest=(left, top))
 
-    combined = Image.alpha_composite(base_frame, overlay_with_alpha)
+    return result
 
-    return combined
+# オーバーレイ処理を行う関数
+def overlay_images(base_frame: Image.Image, overlay_image: Image.Image, transparency: float) -> Image.Image:
+    """
+    透過情報を考慮しながらウォーターマークを重ねる。
+    - 元の透過部分にはウォーターマークを適用しない。
+    """
+    return composite_overlay(base_frame, apply_transparency(overlay_image, transparency))
 
 # gifのフレーム数を正確に判定し、各フレームを返す関数
 def get_gif_frames(image: Image.Image) -> list[Image.Image]:
@@ -45,56 +107,251 @@ def get_gif_frames(image: Image.Image) -> list[Image.Image]:
         pass
     return frames
 
-# メイン処理
-def process_images(base_image_path: Path, overlay_image_path: Path, output_folder: Path, transparency=0.15):
+# アニメーションのフレームを1枚ずつ返すジェネレーター
+def iter_frames(image: Image.Image, timings=None):
     """
-    入力画像にウォーターマークを適用し、指定されたフォルダに保存する。
+    各フレームをRGBAに変換し、(フレーム, 表示時間ms, disposal)の組で順に返す。
+    フレームを溜め込まないため、メモリ使用量はフレーム数に依存しない。
     """
-    if not base_image_path.exists():
-        raise FileNotFoundError(f"Base image not found: {base_image_path.resolve()}")
+    for index in range(getattr(image, "n_frames", 1)):
+        with timed(timings, "decode"):
+            image.seek(index)
+            duration = image.info.get("duration") or 100
+            disposal = getattr(image, "disposal_method", None)
+            frame = image.convert("RGBA")
+        yield frame, duration, disposal
+
+# 合成済みのフレームを順に返すジェネレーター
+def iter_composited_frames(image: Image.Image, prepared_overlay: PreparedOverlay, compositor="numpy", timings=None):
+    """
+    iter_framesの各フレームにウォーターマークを合成して返す。
+    numpyの場合はFRAME_BATCH_SIZE枚ずつまとめて合成する。
+    """
+    if compositor == "pillow":
+        for base_frame, duration, disposal in iter_frames(image, timings):
+            with timed(timings, "composite"):
+                combined_frame = composite_overlay(base_frame, prepared_overlay, in_place=True)
+            yield combined_frame, duration, disposal
+        return
+
+    engine = NumpyCompositor(prepared_overlay)
+    batch = []
+
+    def flush():
+        with timed(timings, "composite"):
+            stack = engine.composite(np.stack([np.asarray(frame) for frame, _, _ in batch]))
+        for index, (_, duration, disposal) in enumerate(batch):
+            yield Image.fromarray(stack[index], "RGBA"), duration, disposal
+        batch.clear()
+
+    for item in iter_frames(image, timings):
+        batch.append(item)
+        if len(batch) >= FRAME_BATCH_SIZE:
+            yield from flush()
+    if batch:
+        yield from flush()
+
+# 静止画にウォーターマークを合成する関数
+def composite_still(base_frame: Image.Image, prepared_overlay, compositor="numpy") -> Image.Image:
+    """
+    base_frame（RGBA）を直接書き換えて返す。合成するのはウォーターマークの空でない領域のみ。
+    """
+    overlay = as_prepared(prepared_overlay)
+    if compositor == "pillow":
+        return composite_overlay(base_frame, overlay, in_place=True)
+
+    for box in overlay.regions:
+        region_np = np.array(base_frame.crop(box))
+        NumpyCompositor(overlay.crop(box)).composite(region_np)
+        base_frame.paste(Image.fromarray(region_np, "RGBA"), box[:2])
+    return base_frame
+
+# 不透明な静止画を合成するモードを決める関数
+def opaque_mode(image: Image.Image, prepared_overlay) -> str | None:
+    """
+    透過情報を持たない画像なら直接合成に使うモード、それ以外はNoneを返す。
+    - RGBはそのまま、透過色の無いパレット画像はRGBに変換して合成する。
+    - Lはウォーターマークが無彩色ならLのまま、それ以外はRGBに変換して合成する。
+    透過色（tRNS）を持つ画像はモードに関わらず対象外（RGBAに変換して合成する）。
+    """
+    if "transparency" in image.info:
+        return None
+    if image.mode == "RGB":
+        return "RGB"
+    if image.mode == "L":
+        return "L" if as_prepared(prepared_overlay).is_grayscale else "RGB"
+    if image.mode == "P":
+        return "RGB"
+    return None
+
+# 不透明な静止画にウォーターマークを直接合成する関数
+def composite_opaque_still(base_image: Image.Image, prepared_overlay, mode: str) -> Image.Image:
+    """
+    RGBAへの変換・アルファのマスク処理・出力形式への再変換を行わず、
+    modeの画像を直接書き換えて返す（base_imageがmodeでない場合は変換した画像）。
+    ウォーターマークの空でない領域だけを取り出して合成し、書き戻す。
+    """
+    overlay = as_prepared(prepared_overlay)
+    canvas = base_image if base_image.mode == mode else base_image.convert(mode)
+    engine = OpaqueCompositor(overlay)
+    for box in overlay.regions:
+        block = engine.composite(np.array(canvas.crop(box)), box)
+        canvas.paste(Image.fromarray(block, mode), box[:2])
+    return canvas
+
+# 大きな静止画を帯状に分割して合成する関数
+def composite_still_tiled(base_image: Image.Image, prepared_overlay, output_mode: str, compositor="numpy", tile_rows=TILE_ROWS) -> Image.Image:
+    """
+    画像全体をRGBAに変換せず、tile_rows行ずつ合成して出力画像に書き戻す。
+    各帯ではウォーターマークのbboxの範囲だけを処理し、空の帯は読み飛ばす。
+    ピークメモリは元画像と出力画像に1帯分を加えた程度に抑えられる。
+    """
+    overlay = as_prepared(prepared_overlay)
+    width, height = base_image.size
+    canvas = base_image if base_image.mode == output_mode else base_image.convert(output_mode)
+    for top in range(0, height, tile_rows):
+        strip_overlay = overlay.crop((0, top, width, min(top + tile_rows, height)))
+        if strip_overlay.bbox is None:
+            continue
+        left, strip_top, right, strip_bottom = strip_overlay.bbox
+        box = (left, top + strip_top, right, top + strip_bottom)
+        piece = base_image.crop(box).convert("RGBA")
+        combined = composite_still(piece, strip_overlay.crop(strip_overlay.bbox), compositor)
+        if output_mode != "RGBA":
+            combined = combined.convert(output_mode)
+        canvas.paste(combined, box[:2])
+    return canvas
+
+# メモリ上で処理を行う関数
+def process_image_bytes(image_data: bytes, file_name: str, overlay_image_path: Path, transparency=0.15, compositor="numpy", timings=None, max_dimension=0, tile_pixels=0, byte_budget=0, encode_profile="balanced", memory_budget=0, pixel_budget=0, cache_counts=None) -> tuple[BytesIO, str]:
+    """
+    画像データにウォーターマークを適用し、エンコード済みのBytesIOと出力ファイル名を返す。
+    compositorには"numpy"または"pillow"を指定する。
+    timingsにdictを渡すと、段階ごとの処理時間（秒）が記録される。
+    cache_countsにdictを渡すと、オーバーレイキャッシュのヒット・ミスの回数が記録される。
+    静止画の場合:
+    - max_dimensionを指定すると長辺がその値以下になるよう縮小してから処理する（JPEGは縮小デコード）。
+    - 透過情報の無いRGB・L・パレット画像（compositor="numpy"の場合）はRGBAに変換せず、そのモードのまま合成する。
+    - tile_pixelsを超える画素数の画像は帯状に分割して合成する。
+    - byte_budgetを指定すると、その容量に収まるようエンコード設定を調整する（形式を変換する場合がある）。
+    encode_profileに"fast"を指定すると、容量よりエンコード速度を優先する。
+    デコード前にヘッダーから必要なメモリ・処理量を見積もり、memory_budget（バイト）・pixel_budget（画素数）を
+    超える静止画は縮小し、アニメーションはResourceLimitExceededとする（resource_guard.plan_job）。
+    """
+    if compositor not in COMPOSITORS:
+        raise ValueError(f"Unknown compositor: {compositor}")
+    if encode_profile not in ENCODE_PROFILES:
+        raise ValueError(f"Unknown encode profile: {encode_profile}")
     if not overlay_image_path.exists():
         raise FileNotFoundError(f"Overlay image not found: {overlay_image_path.resolve()}")
 
-    output_folder.mkdir(parents=True, exist_ok=True)
+    ext = get_file_extension(Path(file_name))
+    output_file_name = get_output_file_name(file_name, transparency)
+    output = BytesIO()
+
+    with timed(timings, "decode"):
+        base_image = open_image(image_data)
+        header = read_header(base_image, ext, len(image_data))
+        is_animated = header.animated
+        max_dimension = plan_job(header, memory_budget, pixel_budget, max_dimension).max_dimension
+        # 出力サイズの上限を超える静止画は、デコード時点で縮小する
+        if not is_animated and max_dimension and max(base_image.size) > max_dimension:
+            base_image.thumbnail((max_dimension, max_dimension), Image.Resampling.LANCZOS, reducing_gap=2.0)
+    with timed(timings, "overlay"):
+        overlay_image = prepare_overlay(overlay_image_path, base_image.size, transparency, cache_counts)
+
+    if is_animated:
+        # アニメーションGIFまたはPNGの場合（1フレームずつ合成・エンコード）
+        loop = base_image.info.get("loop")
+        if ext == ".gif":
+            writer = GifStreamWriter(output, base_image.size, loop=loop)
+        else:
+            writer = ApngStreamWriter(
+                output, base_image.size, base_image.n_frames, loop=loop,
+                compress_level=1 if encode_profile == "fast" else 6,
+            )
 
-    base_name = base_image_path.stem
-    ext = base_image_path.suffix.lower()
-    base_image = Image.open(base_image_path)
-    overlay_image = Image.open(overlay_image_path).convert("RGBA")
-    overlay_image = overlay_image.resize(base_image.size, Image.Resampling.LANCZOS)
-
-    if ext in [".gif", ".png"] and getattr(base_image, "is_animated", False):
-        # アニメーションGIFまたはPNGの場合
-        frames = get_gif_frames(base_image)
-        processed_frames = []
-
-        for frame in frames:
-            base_frame = frame.convert("RGBA")
-            combined_frame = overlay_images(base_frame, overlay_image, transparency)
-            processed_frames.append(np.array(combined_frame))
-
-        output_file_path = output_folder / f"{base_name}_{int(transparency * 100)}％{ext}"
-        iio.imwrite(
-            str(output_file_path),
-            processed_frames,
-            duration=base_image.info.get("duration", 100),
-            loop=base_image.info.get("loop", 0),
-            plugin="pillow" if ext == ".png" else None
-        )
+        for combined_frame, duration, disposal in iter_composited_frames(base_image, overlay_image, compositor, timings):
+            with timed(timings, "encode"):
+                writer.write_frame(combined_frame, duration, disposal)
+        with timed(timings, "encode"):
+            writer.close()
     else:
-        # 静止画像の場合
-        base_frame = base_image.convert("RGBA")
-        combined_image = overlay_images(base_frame, overlay_image, transparency)
+        # 静止画像の場合（非透過形式はRGBで保存）
+        output_mode = "RGB" if ext in [".jpg", ".jpeg", ".bmp"] else "RGBA"
+        width, height = base_image.size
+        direct_mode = opaque_mode(base_image, overlay_image) if compositor == "numpy" else None
 
-        # 保存前に非透過形式の場合はRGBに変換
-        if ext in [".jpg", ".jpeg", ".bmp"]:
-            print(f"Converting image to RGB for format: {ext}")
-            combined_image = combined_image.convert("RGB")
+        if direct_mode is not None:
+            # 透過情報の無い画像は元のモードのまま合成する（大きな画像でも全体のコピーを作らない）
+            with timed(timings, "decode"):
+                base_image.load()
+            with timed(timings, "composite"):
+                combined_image = composite_opaque_still(base_image, overlay_image, direct_mode)
+            # GIFは保存時の減色の結果が画像のモードで変わるため、他の経路と同じRGBAから減色する
+            if output_mode == "RGBA" and format_for_extension(ext) == "GIF":
+                combined_image = combined_image.convert("RGBA")
+        elif tile_pixels and width * height > tile_pixels:
+            with timed(timings, "decode"):
+                base_image.load()
+            with timed(timings, "composite"):
+                combined_image = composite_still_tiled(base_image, overlay_image, output_mode, compositor)
+        else:
+            with timed(timings, "decode"):
+                base_frame = base_image.convert("RGBA")
+            with timed(timings, "composite"):
+                combined_image = composite_still(base_frame, overlay_image, compositor)
 
-        # 出力ファイルを保存
-        output_image_path = output_folder / f"{base_name}_{int(transparency * 100)}％{ext}"
+            # 保存前に非透過形式の場合はRGBに変換
+            if output_mode == "RGB":
+                combined_image = combined_image.convert("RGB")
+
+        image_format = format_for_extension(ext)
+        if image_format is None:
+            raise ValueError(f"Unsupported file type: {file_name}")
         try:
-            print(f"Saving image to: {output_image_path}")
-            combined_image.save(output_image_path)
+            with timed(timings, "encode"):
+                encoded = BudgetEncoder(byte_budget, encode_profile).encode(combined_image, image_format)
         except Exception as e:
-            raise IOError(f"Failed to save image: {output_image_path}. Error: {e}")
+            raise IOError(f"Failed to encode image: {output_file_name}. Error: {e}")
+        output.write(encoded.data)
+        output_file_name = get_output_file_name(file_name, transparency, encoded.image_format)
+
+    output.seek(0)
+    return output, output_file_name
+
+# 処理時間の計測付きでprocess_image_bytesを実行する関数（ワーカーから結果を返すため）
+def process_image_bytes_timed(*args, **kwargs) -> tuple[BytesIO, str, dict, dict]:
+    """
+    (BytesIO, 出力ファイル名, 処理時間, オーバーレイキャッシュのヒット・ミスの回数)を返す。
+    キャッシュはワーカーごとに持つため、回数は呼び出し側で集計する。
+    """
+    timings = {}
+    cache_counts = {}
+    output, output_file_name = process_image_bytes(*args, timings=timings, cache_counts=cache_counts, **kwargs)
+    return output, output_file_name, timings, cache_counts
+
+# メイン処理
+def process_images(base_image_path: Path, overlay_image_path: Path, output_folder: Path, transparency=0.15, compositor="numpy", max_dimension=0, tile_pixels=0, byte_budget=0, encode_profile="balanced", memory_budget=0, pixel_budget=0) -> Path:
+    """
+    入力画像にウォーターマークを適用し、指定されたフォルダに保存する。
+    process_image_bytesのファイル版。
+    """
+    if not base_image_path.exists():
+        raise FileNotFoundError(f"Base image not found: {base_image_path.resolve()}")
+
+    output_folder.mkdir(parents=True, exist_ok=True)
+
+    output, output_file_name = process_image_bytes(
+        base_image_path.read_bytes(), base_image_path.name, overlay_image_path, transparency, compositor,
+        max_dimension=max_dimension, tile_pixels=tile_pixels, byte_budget=byte_budget, encode_profile=encode_profile,
+        memory_budget=memory_budget, pixel_budget=pixel_budget,
+    )
+
+    # 出力ファイルを保存
+    output_image_path = output_folder / output_file_name
+    try:
+        output_image_path.write_bytes(output.getbuffer())
+    except Exception as e:
+        raise IOError(f"Failed to save image: {output_image_path}. Error: {e}")
+    return output_image_path
@@ -0,0 +1,177 @@
+import hashlib
+import os
+import sqlite3
+import threading
+import time
+from pathlib import Path
+from utils.resource_guard import check_watermark, open_image, read_header
+
+# 事前にデコードしたRGBA画素（NumPyの.npy形式）の拡張子
+RASTER_SUFFIX = ".npy"
+
+# ウォーターマークファイルに対応するデコード済み画素のパス
+def raster_path(overlay_image_path: Path) -> Path:
+    return Path(overlay_image_path).with_suffix(RASTER_SUFFIX)
+
+# ウォーターマークをRGBA画像として読み込む関数
+def load_watermark(overlay_image_path: Path):
+    """
+    デコード済みの画素（.npy）があればメモリマップで読み込み、無ければ画像ファイルをデコードする。
+    """
+    from PIL import Image  # type: ignore
+
+    decoded = raster_path(overlay_image_path)
+    if decoded.exists() and decoded != Path(overlay_image_path):
+        import numpy as np  # type: ignore
+        return Image.fromarray(np.load(decoded, mmap_mode="r"), "RGBA")
+    with Image.open(overlay_image_path) as source:
+        return source.convert("RGBA")
+
+class WatermarkStore:
+    """
+    アップロードされたウォーターマークを内容のハッシュで保存する。
+    - 同じ画像は全サーバー・チャンネルで1つのファイルを共有し、参照数を記録する。
+    - 保存時にRGBAへデコードした画素を<ハッシュ>.npyとして保存し、処理時のデコードを省く。
+    - 参照数が0になったファイルは削除する。
+    - デコードする前にヘッダーを確認し、memory_budget（バイト）・max_pixels（画素数）を超える画像は保存しない。
+    """
+    def __init__(self, root: Path, memory_budget=0, max_pixels=0):
+        self.root = Path(root)
+        self.memory_budget = memory_budget
+        self.max_pixels = max_pixels
+        self.root.mkdir(parents=True, exist_ok=True)
+        self._lock = threading.Lock()
+        # 追加と削除が並行してファイルを消してしまわないよう、更新処理は直列化する
+        self._update_lock = threading.Lock()
+        self._conn = sqlite3.connect(str(self.root / "watermarks.db"), check_same_thread=False)
+        self._conn.execute("PRAGMA journal_mode=WAL")
+        with self._conn:
+            self._conn.execute(
+                "CREATE TABLE IF NOT EXISTS watermarks ("
+                " digest TEXT PRIMARY KEY,"
+                " file_name TEXT NOT NULL,"
+                " ref_count INTEGER NOT NULL,"
+                " size INTEGER NOT NULL,"
+                " created_at REAL NOT NULL)"
+            )
+
+    def _write_atomic(self, path: Path, write):
+        temp_path = path.with_name(f".{path.name}.{os.getpid()}.{threading.get_ident()}.tmp")
+        with open(temp_path, "wb") as f:
+            write(f)
+        os.replace(temp_path, path)
+
+    def contains(self, overlay_image_path: Path) -> bool:
+        """
+        パスがこのストアで管理しているファイルかどうか。
+        """
+        return Path(overlay_image_path).resolve().parent == self.root.resolve()
+
+    def add(self, data: bytes, file_name: str) -> Path:
+        """
+        ウォーターマークを保存して参照数を1増やし、保存先のパスを返す。
+        同じ内容のファイルが既にあれば、それを共有する。
+        """
+        digest = hashlib.sha256(data).hexdigest()
+        ext = Path(file_name).suffix.lower() or ".png"
+        with self._update_lock:
+            return self._add(data, digest, ext)
+
+    def _add(self, data: bytes, digest: str, ext: str) -> Path:
+        with self._lock:
+            row = self._conn.execute("SELECT file_name FROM watermarks WHERE digest = ?", (digest,)).fetchone()
+        if row is not None:
+            path = self.root / row[0]
+        else:
+            path = self.root / f"{digest}{ext}"
+            # 先にデコードし、画像として読めないデータは保存しない
+            self._write_raster(data, raster_path(path))
+            self._write_atomic(path, lambda f: f.write(data))
+
+        with self._lock, self._conn:
+            self._conn.execute(
+                "INSERT INTO watermarks (digest, file_name, ref_count, size, created_at) VALUES (?, ?, 1, ?, ?)"
+                " ON CONFLICT (digest) DO UPDATE SET ref_count = ref_count + 1",
+                (digest, path.name, len(data), time.time()),
+            )
+        return path
+
+    def _write_raster(self, data: bytes, path: Path):
+        import numpy as np  # type: ignore
+
+        with open_image(data) as source:
+            # 処理に使うのは最初のフレームだけのため、静止画として確認する
+            check_watermark(read_header(source, "", len(data)), self.memory_budget, self.max_pixels)
+            pixels = np.asarray(source.convert("RGBA"))
+        self._write_atomic(path, lambda f: np.save(f, pixels))
+
+    def release(self, overlay_image_path: Path) -> bool:
+        """
+        参照数を1減らし、0になった場合はファイルを削除する。削除した場合はTrueを返す。
+        """
+        path = Path(overlay_image_path)
+        digest = path.stem
+        with self._update_lock:
+            if not self._remove_reference(digest):
+                return False
+            path.unlink(missing_ok=True)
+            raster_path(path).unlink(missing_ok=True)
+        return True
+
+    def _remove_reference(self, digest: str) -> bool:
+        with self._lock, self._conn:
+            self._conn.execute("BEGIN IMMEDIATE")
+            row = self._conn.execute("SELECT ref_count FROM watermarks WHERE digest = ?", (digest,)).fetchone()
+            if row is None:
+                return False
+            if row[0] > 1:
+                self._conn.execute("UPDATE watermarks SET ref_count = ref_count - 1 WHERE digest = ?", (digest,))
+                return False
+            self._conn.execute("DELETE FROM watermarks WHERE digest = ?", (digest,))
+            return True
+
+    def remove_orphan(self, file_name: str, min_age: float) -> int:
+        """
+        インデックスに登録されていないファイル（保存の途中で終了した場合など）を削除し、削除したバイト数を返す。
+        min_age秒以内に更新されたファイルは保存中の可能性があるため削除しない。
+        """
+        path = self.root / file_name
+        digest = file_name.split(".")[0]
+        if len(digest) != 64 or not all(c in "0123456789abcdef" for c in digest):
+            return 0
+        with self._update_lock:
+            with self._lock:
+                row = self._conn.execute("SELECT file_name FROM watermarks WHERE digest = ?", (digest,)).fetchone()
+            if row is not None and file_name in (row[0], raster_path(Path(row[0])).name):
+                return 0
+            try:
+                stat = path.stat()
+            except FileNotFoundError:
+                return 0
+            if time.time() - stat.st_mtime < min_age:
+                return 0
+            path.unlink(missing_ok=True)
+        return stat.st_size
+
+    def referenced_files(self) -> set:
+        """
+        参照されているファイル名（元画像と.npy）の一覧。
+        """
+        with self._lock:
+            rows = self._conn.execute("SELECT file_name FROM watermarks").fetchall()
+        names = set()
+        for (file_name,) in rows:
+            names.add(file_name)
+            names.add(raster_path(Path(file_name)).name)
+        return names
+
+    def stats(self) -> dict:
+        with self._lock:
+            count, refs, size = self._conn.execute(
+                "SELECT COUNT(*), COALESCE(SUM(ref_count), 0), COALESCE(SUM(size), 0) FROM watermarks"
+            ).fetchone()
+        return {"watermarks": count, "references": refs, "bytes": size}
+
+    def close(self):
+        with self._lock:
+            self._conn.close()
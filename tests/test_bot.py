@@ -0,0 +1,97 @@
+import asyncio
+import sys
+from io import BytesIO
+from pathlib import Path
+
+import pytest
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "src"))
+
+
+# bot.pyを一時ディレクトリの設定で読み込むフィクスチャ（モジュールの読み込み時に設定・ストアを初期化するため）
+@pytest.fixture(scope="module")
+def bot_module(tmp_path_factory):
+    base_dir = tmp_path_factory.mktemp("bot")
+    with pytest.MonkeyPatch.context() as patch:
+        for name, value in {
+            "DISCORD_TOKEN": "test", "BASE_DIR": str(base_dir), "RENDER_MODE": "local",
+            "WORKER_MODE": "thread", "OUTPUT_CACHE_MB": "0", "METRICS_ENABLED": "false",
+        }.items():
+            patch.setenv(name, value)
+        import bot
+    yield bot
+    bot.job_runner.shutdown()
+
+# アップロード用の(BytesIO, ファイル名)を作る関数
+def upload_file(name: str, size: int) -> tuple:
+    return BytesIO(b"\0" * size), name
+
+
+def test_split_upload_batches_respects_limits(bot_module):
+    files = [upload_file(f"{index}.png", 100) for index in range(12)]
+    batches = bot_module.split_upload_batches(files, 10, 10_000)
+    assert [len(batch) for batch in batches] == [10, 2]
+
+    batches = bot_module.split_upload_batches(files[:5], 10, 250)
+    assert [[name for _, name in batch] for batch in batches] == [["0.png", "1.png"], ["2.png", "3.png"], ["4.png"]]
+
+    # 単体で上限を超えるファイルはそのファイルだけで送る
+    files = [upload_file("small.png", 100), upload_file("large.png", 1000), upload_file("last.png", 100)]
+    batches = bot_module.split_upload_batches(files, 10, 500)
+    assert [[name for _, name in batch] for batch in batches] == [["small.png"], ["large.png"], ["last.png"]]
+
+    assert bot_module.split_upload_batches([], 10, 500) == []
+
+
+def test_process_message_attachments_reports_errors_together(bot_module, tmp_path, monkeypatch):
+    class Attachment:
+        def __init__(self, filename):
+            self.filename = filename
+
+    class Channel:
+        def __init__(self):
+            self.sent = []
+
+        async def send(self, content=None, files=None):
+            if files and any(file.filename == "upload-fails.png" for file in files):
+                raise RuntimeError("upload rejected")
+            self.sent.append((content, [file.filename for file in files or []]))
+
+    class Guild:
+        id = 1
+        filesize_limit = 1000
+
+    class Message:
+        guild = Guild()
+        channel = Channel()
+
+    async def fake_process_attachment(attachment, admission, active_watermark, transparency, byte_budget=0):
+        if attachment.filename == "huge.png":
+            raise bot_module.ResourceLimitExceeded("image is too large")
+        if attachment.filename == "broken.png":
+            raise ValueError("cannot identify image file")
+        size = 900 if attachment.filename == "upload-fails.png" else 100
+        return upload_file(attachment.filename, size)
+
+    monkeypatch.setattr(bot_module, "process_attachment", fake_process_attachment)
+    monkeypatch.setattr(bot_module, "ERROR_FILES_DIR", tmp_path / "errors")
+    message = Message()
+    names = ["a.png", "huge.png", "b.png", "broken.png", "upload-fails.png"]
+    asyncio.run(bot_module.process_message_attachments(
+        message, [Attachment(name) for name in names], ["Unsupported file type: c.txt"], None, "wm.png", 0.5,
+    ))
+
+    # 成功した画像は上限に合わせてまとめて送信し、エラーは最後に1つのメッセージで報告する
+    assert message.channel.sent[0] == (None, ["a.png", "b.png"])
+    assert len(message.channel.sent) == 2
+    report = message.channel.sent[1][0].splitlines()
+    assert report == [
+        "Unsupported file type: c.txt",
+        "Skipped huge.png: image is too large",
+        "An error occurred (broken.png): cannot identify image file",
+        "An error occurred (upload-fails.png): upload rejected",
+    ]
+    # 大きすぎる画像はエラーログに記録しない
+    log = (tmp_path / "errors" / "error_log.txt").read_text()
+    assert "broken.png" not in log and "cannot identify image file" in log
+    assert "image is too large" not in log
@@ -0,0 +1,922 @@
+import asyncio
+import json
+import multiprocessing
+import os
+import sys
+import threading
+import time
+from io import BytesIO
+from pathlib import Path
+
+import numpy as np  # type: ignore
+import pytest
+from PIL import Image, ImageFile  # type: ignore
+
+sys.path.insert(0, str(Path(__file__).resolve().parent.parent / "src"))
+
+import render_worker
+from utils.animation_encoder import ApngStreamWriter, GifStreamWriter
+from utils.compositor import PreparedOverlay
+from utils.config_loader import ConfigLoader
+from utils.janitor import Janitor, watermark_bytes
+from utils.job_queue import SQLiteJobQueue
+from utils.job_runner import QueueJobRunner
+from utils.output_cache import OutputCache
+from utils.output_encoder import MAX_DOWNSCALE_ATTEMPTS, MAX_QUALITY_ATTEMPTS, MIN_QUALITY, BudgetEncoder
+from utils.overlay_cache import OverlayCache
+from utils.resource_guard import (
+    BASE_MEMORY_BYTES, DOWNSCALE_STEP, STILL_BYTES_PER_PIXEL, ImageHeader, ResourceLimitExceeded, plan_job, slot_cost,
+)
+from utils.scheduler import FairScheduler, SchedulerBusy
+from utils.settings_store import SQLiteSettingsStore
+from utils.watermark_store import WatermarkStore, raster_path
+from utils.watermark_processor import (
+    apply_transparency, composite_overlay, composite_still_tiled, opaque_mode, process_image_bytes,
+    process_image_bytes_timed,
+)
+
+# テスト画像の大きさ（ウォーターマークの領域が複数のタイルにまたがる）
+SIZE = (150, 90)
+
+
+# テスト用のウォーターマーク（アルファが0・中間・255の領域を持つ）を保存する関数
+def make_overlay(path: Path, grayscale=False) -> Path:
+    rng = np.random.default_rng(1)
+    overlay = rng.integers(0, 256, (48, 80, 4), dtype=np.uint8)
+    if grayscale:
+        overlay[..., 1] = overlay[..., 2] = overlay[..., 0]
+    overlay[:8, :, 3] = 0
+    overlay[20:30, 10:70, 3] = 255
+    Image.fromarray(overlay, "RGBA").save(path)
+    return path
+
+# モードごとのテスト画像を作成する関数（keyedは透過色tRNSを持つ画像）
+def make_base(kind: str) -> Image.Image:
+    rng = np.random.default_rng(2)
+    width, height = SIZE
+    pixels = rng.integers(0, 256, (height, width, 4), dtype=np.uint8)
+    pixels[: height // 3, : width // 3] = 0
+    pixels[height // 2:, width // 2:, 3] = 0
+    rgb = Image.fromarray(pixels[..., :3], "RGB")
+    if kind == "rgba":
+        return Image.fromarray(pixels, "RGBA")
+    if kind == "rgb":
+        return rgb
+    if kind == "rgb-keyed":
+        rgb.info["transparency"] = (0, 0, 0)
+        return rgb
+    if kind in ("l", "l-keyed"):
+        image = rgb.convert("L")
+        if kind == "l-keyed":
+            image.info["transparency"] = 0
+        return image
+    image = rgb.quantize(64)
+    if kind == "p-keyed":
+        image.info["transparency"] = image.getpixel((0, 0))
+    return image
+
+# 画像をPNGのバイト列に変換する関数
+def png_bytes(image: Image.Image, **params) -> bytes:
+    buffer = BytesIO()
+    image.save(buffer, "PNG", **params)
+    return buffer.getvalue()
+
+# 出力をデコードしてRGBAの配列で返す関数
+def render(image_data: bytes, overlay_path: Path, compositor: str, file_name="image.png", **kwargs) -> np.ndarray:
+    output, _ = process_image_bytes(image_data, file_name, overlay_path, 0.5, compositor, **kwargs)
+    return np.array(Image.open(output).convert("RGBA"))
+
+
+def test_colour_keyed_rgb_keeps_transparency(tmp_path):
+    overlay_path = make_overlay(tmp_path / "overlay.png")
+    pixels = np.full((32, 32, 3), 120, dtype=np.uint8)
+    pixels[:16] = 0
+    image_data = png_bytes(Image.fromarray(pixels, "RGB"), transparency=(0, 0, 0))
+
+    expected = render(image_data, overlay_path, "pillow")
+    result = render(image_data, overlay_path, "numpy")
+
+    assert (expected[:16, :, 3] == 0).all()
+    np.testing.assert_array_equal(result, expected)
+
+
+BASE_KINDS = ["rgba", "rgb", "l", "p", "rgb-keyed", "l-keyed", "p-keyed"]
+
+
+@pytest.mark.parametrize("grayscale", [False, True])
+@pytest.mark.parametrize("kind", BASE_KINDS + ["p.gif", "p-keyed.gif"])
+def test_numpy_compositor_matches_pillow(tmp_path, kind, grayscale):
+    overlay_path = make_overlay(tmp_path / "overlay.png", grayscale)
+    if kind.endswith(".gif"):
+        # GIFの入出力（出力時の減色の結果も一致すること）
+        buffer = BytesIO()
+        make_base(kind[:-4]).save(buffer, "GIF")
+        image_data, file_name = buffer.getvalue(), "image.gif"
+    else:
+        image_data, file_name = png_bytes(make_base(kind)), "image.png"
+
+    expected = render(image_data, overlay_path, "pillow", file_name)
+    np.testing.assert_array_equal(render(image_data, overlay_path, "numpy", file_name), expected)
+    # 分割合成（透過情報を持つ画像のみ、それ以外は直接合成が優先される）
+    np.testing.assert_array_equal(render(image_data, overlay_path, "numpy", file_name, tile_pixels=1), expected)
+
+
+@pytest.mark.parametrize("compositor", ["numpy", "pillow"])
+@pytest.mark.parametrize("kind", BASE_KINDS)
+def test_tiled_composite_matches_whole_image(tmp_path, kind, compositor):
+    base_image = make_base(kind)
+    overlay = Image.open(make_overlay(tmp_path / "overlay.png")).resize(SIZE)
+    prepared = PreparedOverlay.from_image(apply_transparency(overlay, 0.5))
+
+    expected = np.array(composite_overlay(base_image.convert("RGBA"), prepared))
+    result = composite_still_tiled(base_image, prepared, "RGBA", compositor, tile_rows=7)
+    np.testing.assert_array_equal(np.array(result), expected)
+
+
+@pytest.mark.parametrize("kind, grayscale, expected", [
+    ("rgb", False, "RGB"),
+    ("l", True, "L"),
+    ("l", False, "RGB"),
+    ("p", False, "RGB"),
+    ("rgba", False, None),
+    ("rgb-keyed", False, None),
+    ("l-keyed", True, None),
+    ("p-keyed", False, None),
+])
+def test_opaque_mode(tmp_path, kind, grayscale, expected):
+    overlay = Image.open(make_overlay(tmp_path / "overlay.png", grayscale)).resize(SIZE)
+    assert opaque_mode(make_base(kind), PreparedOverlay.from_image(overlay)) == expected
+
+
+# 実行枠を取得した順にキーを記録するジョブ
+async def record_slot(scheduler, key, order, cost=1):
+    with scheduler.admit(key) as admission:
+        async with admission.slot(cost):
+            order.append(key)
+            await asyncio.sleep(0)
+
+# 実行枠を埋めた状態でジョブを待機させ、解放後に実行された順を返す関数
+async def drain_in_order(scheduler, jobs, blocker_cost=1):
+    order = []
+    release = asyncio.Event()
+
+    async def blocker():
+        with scheduler.admit("blocker") as admission:
+            async with admission.slot(blocker_cost):
+                await release.wait()
+
+    blocker_task = asyncio.create_task(blocker())
+    await asyncio.sleep(0)
+    tasks = []
+    for key, cost in jobs:
+        tasks.append(asyncio.create_task(record_slot(scheduler, key, order, cost)))
+        await asyncio.sleep(0)
+    assert order == []
+    release.set()
+    await asyncio.gather(blocker_task, *tasks)
+    return order
+
+
+def test_scheduler_weighted_round_robin():
+    weights = {"a": 2, "b": 1}
+    scheduler = FairScheduler(capacity=1, limits=lambda key: (weights.get(key), None))
+    jobs = [("a", 1)] * 6 + [("b", 1)] * 3
+
+    order = asyncio.run(drain_in_order(scheduler, jobs))
+
+    assert order == ["a", "b", "a", "a", "b", "a", "a", "b", "a"]
+    assert scheduler.stats()["running_cost"] == 0
+    assert scheduler.stats()["guilds"] == {}
+
+
+def test_scheduler_keeps_cost_within_capacity():
+    scheduler = FairScheduler(capacity=4)
+    peaks = []
+
+    async def job(key, cost):
+        with scheduler.admit(key) as admission:
+            async with admission.slot(cost):
+                peaks.append(scheduler.running_cost)
+                await asyncio.sleep(0.01)
+
+    async def main():
+        await asyncio.gather(*(job(key, cost) for key, cost in [("a", 3), ("b", 2), ("a", 1), ("b", 1), ("c", 6)]))
+
+    asyncio.run(main())
+    # 上限を超えるコストのジョブ（6）は単独で実行される
+    assert max(peaks) == 6
+    assert all(peak <= 4 for peak in peaks if peak != 6)
+    assert scheduler.running_cost == 0
+
+
+def test_scheduler_sheds_when_queue_full():
+    scheduler = FairScheduler(capacity=1, queue_cap=2, limits=lambda key: (None, 3 if key == "big" else None))
+
+    with scheduler.admit("a", 2):
+        with pytest.raises(SchedulerBusy) as busy:
+            with scheduler.admit("a", 1):
+                pass
+        assert busy.value.reason == "queue_full"
+        assert busy.value.key == "a"
+        # 他のサーバーは影響を受けない
+        with scheduler.admit("b", 2), scheduler.admit("big", 3):
+            pass
+
+    stats = scheduler.stats()
+    assert stats["shed_total"] == 1
+    assert stats["admitted"] == 0
+    with scheduler.admit("a", 2):
+        pass
+
+
+def test_scheduler_expires_waiting_jobs():
+    scheduler = FairScheduler(capacity=1, max_wait=0.05)
+
+    async def main():
+        release = asyncio.Event()
+
+        async def blocker():
+            with scheduler.admit("a") as admission:
+                async with admission.slot():
+                    await release.wait()
+
+        blocker_task = asyncio.create_task(blocker())
+        await asyncio.sleep(0)
+        with scheduler.admit("b") as admission:
+            with pytest.raises(SchedulerBusy) as busy:
+                async with admission.slot():
+                    pass
+        assert busy.value.reason == "timeout"
+        assert scheduler.stats()["waiting"] == 0
+        release.set()
+        await blocker_task
+
+        # 待ち時間を過ぎる前に枠が空けば実行される
+        order = await drain_in_order(scheduler, [("b", 1)])
+        assert order == ["b"]
+
+    asyncio.run(main())
+    assert scheduler.shed_total == 1
+    assert scheduler.running_cost == 0
+
+
+# ファイルの更新時刻を古くする関数
+def make_old(path: Path, seconds=7200) -> Path:
+    old = time.time() - seconds
+    os.utime(path, (old, old))
+    return path
+
+# テスト用のウォーターマークのPNGデータ
+def watermark_png(color: tuple) -> bytes:
+    return png_bytes(Image.new("RGBA", (64, 32), color))
+
+
+def test_janitor_removes_only_unreferenced_files(tmp_path):
+    data_dir, temp_dir, log_dir = tmp_path / "data", tmp_path / "temp", tmp_path / "logs"
+    temp_dir.mkdir()
+    log_dir.mkdir()
+    store = WatermarkStore(data_dir / "watermarks")
+
+    referenced = store.add(watermark_png((255, 0, 0, 128)), "a.png")
+    make_old(referenced)
+    make_old(raster_path(referenced))
+    orphan = data_dir / "watermarks" / ("ab" * 32 + ".png")
+    orphan.write_bytes(b"x" * 1000)
+    make_old(orphan)
+    young_orphan = data_dir / "watermarks" / ("cd" * 32 + ".png")
+    young_orphan.write_bytes(b"y" * 1000)
+
+    legacy_dir = data_dir / "2" / "20"
+    legacy_dir.mkdir(parents=True)
+    legacy_unused = legacy_dir / "old.png"
+    legacy_unused.write_bytes(b"z" * 500)
+    make_old(legacy_unused)
+    legacy_used = legacy_dir / "kept.png"
+    legacy_used.write_bytes(b"k" * 700)
+    make_old(legacy_used)
+    settings = data_dir / "2" / "settings.json"
+    settings.write_text("{}")
+    make_old(settings)
+
+    old_tmp = data_dir / "cache" / "k9.abc.tmp"
+    old_tmp.parent.mkdir(parents=True)
+    old_tmp.write_bytes(b"t" * 300)
+    make_old(old_tmp)
+    young_tmp = data_dir / "cache" / "k8.abc.tmp"
+    young_tmp.write_bytes(b"t" * 300)
+    legacy_temp = temp_dir / "input.jpg"
+    legacy_temp.write_bytes(b"i" * 400)
+    make_old(legacy_temp)
+
+    log = log_dir / "error_log.txt"
+    log.write_bytes(b"e" * 3000)
+    (log_dir / "error_log.txt.1").write_bytes(b"o" * 2000)
+
+    channels = [(1, 10, {"active_watermark": str(referenced)}), (2, 21, {"active_watermark": str(legacy_used)})]
+    janitor = Janitor(
+        [data_dir], [temp_dir], [log_dir], store, lambda: channels,
+        temp_max_age=3600, log_max_bytes=1024, guild_quota_bytes=1000, batch_size=3,
+    )
+    report = asyncio.run(janitor.run_pass(pause=0))
+
+    for path in (referenced, raster_path(referenced), young_orphan, legacy_used, settings, young_tmp):
+        assert path.exists(), path
+    for path in (orphan, legacy_unused, old_tmp, legacy_temp, log):
+        assert not path.exists(), path
+    # ログは1世代だけ残す
+    assert (log_dir / "error_log.txt.1").read_bytes() == b"e" * 3000
+
+    assert report.removed == {"watermarks": 2, "temp": 2, "logs": 1}
+    assert report.reclaimed == {"watermarks": 1500, "temp": 700, "logs": 2000}
+    assert report.guild_usage["1"] == watermark_bytes(referenced)
+    assert report.guild_usage["2"] == 700
+    assert report.guilds_over_quota == [("1", watermark_bytes(referenced))]
+    assert janitor.last_report is report
+    store.close()
+
+
+def test_janitor_quota_trims_least_recently_used_outputs(tmp_path):
+    data_dir = tmp_path / "data"
+    cache = OutputCache(data_dir / "cache", max_bytes=10 ** 9)
+    for index in range(5):
+        cache.put(f"k{index}", b"c" * 100_000)
+    # 最近使われたエントリは残る
+    assert cache.get("k0") is not None
+
+    janitor = Janitor([data_dir], output_cache=cache, quota_bytes=350_000)
+    report = asyncio.run(janitor.run_pass(pause=0))
+
+    assert sorted(path.name for path in (data_dir / "cache").iterdir()) == ["k0", "k3", "k4"]
+    assert cache.stats()["entries"] == 3
+    assert report.removed == {"quota": 2}
+    assert report.reclaimed == {"quota": 200_000}
+    assert report.total_bytes == 300_000
+
+
+def test_overlay_cache_misses_rewritten_watermark(tmp_path):
+    cache = OverlayCache()
+    path = tmp_path / "overlay.png"
+    path.write_bytes(watermark_png((255, 0, 0, 128)))
+    built = []
+
+    def build():
+        built.append(path.read_bytes())
+        return PreparedOverlay.from_image(Image.open(path))
+
+    counts = {}
+    first = cache.get_or_create(path, (64, 32), 0.5, build, counts)
+    assert cache.get_or_create(path, (64, 32), 0.5, build, counts) is first
+    assert counts == {"misses": 1, "hits": 1}
+
+    # 同じパスに別の画像を上書きすると、新しいエントリとして作り直される
+    path.write_bytes(watermark_png((0, 0, 255, 255)) + b"\0")
+    os.utime(path, ns=(time.time_ns() + 10 ** 9,) * 2)
+    second = cache.get_or_create(path, (64, 32), 0.5, build, counts)
+    assert second is not first
+    assert counts == {"misses": 2, "hits": 1}
+    assert len(built) == 2
+    assert tuple(second.pixels[0, 0]) == (0, 0, 255, 255)
+
+
+# 旧形式のsettings.jsonを作成する関数
+def write_legacy_settings(base_dir: Path, server_id, channels: dict):
+    server_dir = base_dir / str(server_id)
+    server_dir.mkdir(parents=True, exist_ok=True)
+    (server_dir / "settings.json").write_text(json.dumps({"channels": channels}))
+
+
+def test_settings_migrate_json_once(tmp_path):
+    write_legacy_settings(tmp_path, 1, {"10": {"transparency": 30, "active_watermark": "a.png"}, "11": {}})
+    write_legacy_settings(tmp_path, 2, {"20": {"transparency": 50}})
+
+    loader = ConfigLoader(tmp_path)
+    assert loader.get_channel_settings(1, 10) == {"transparency": 30, "active_watermark": "a.png"}
+    assert loader.get_channel_settings("2", "20") == {"transparency": 50}
+    assert sorted((server, channel) for server, channel, _ in loader.iter_channel_settings()) == [
+        ("1", "10"), ("1", "11"), ("2", "20"),
+    ]
+    loader.set_channel_settings(1, 10, {"transparency": 40})
+    loader.store.close()
+
+    # 取り込み済みのフラグがあれば、settings.jsonが変わっても再度取り込まない
+    write_legacy_settings(tmp_path, 1, {"10": {"transparency": 99}, "12": {"transparency": 5}})
+    reopened = ConfigLoader(tmp_path)
+    assert reopened.store.migrate_json_tree(tmp_path) == 0
+    assert reopened.get_channel_settings(1, 10)["transparency"] == 40
+    assert reopened.get_channel_settings(1, 12) == {}
+    reopened.store.close()
+
+
+def test_settings_migration_skips_missing_and_corrupt_files(tmp_path):
+    write_legacy_settings(tmp_path, 1, {"10": {"transparency": 30}})
+    (tmp_path / "2").mkdir()
+    (tmp_path / "2" / "settings.json").write_text("{not json")
+    (tmp_path / "3").mkdir()
+
+    store = SQLiteSettingsStore(tmp_path / "settings.db")
+    assert store.migrate_json_tree(tmp_path) == 1
+    assert store.get_channel(1, 10) == {"transparency": 30}
+    assert store.get_server(2) == {"channels": {}}
+    assert store.get_server(3) == {"channels": {}}
+    assert store.migrate_json_tree(tmp_path) == 0
+    store.close()
+
+    # settings.jsonが無いサーバーは空の設定として扱う（jsonバックエンド）
+    assert ConfigLoader(tmp_path / "json", backend="json").get_channel_settings(4, 40) == {}
+
+
+def test_settings_cache_returns_updated_values(tmp_path):
+    store = SQLiteSettingsStore(tmp_path / "settings.db")
+    assert store.get_channel(1, 10) == {}
+
+    store.update_channel(1, 10, {"transparency": 20})
+    assert store.get_channel(1, 10) == {"transparency": 20}
+    # 返した設定を書き換えてもキャッシュには影響しない
+    store.get_channel(1, 10)["transparency"] = 99
+    assert store.get_channel(1, 10) == {"transparency": 20}
+
+    store.update_channel(1, 10, {"active_watermark": "a.png"})
+    assert store.get_channel(1, 10) == {"transparency": 20, "active_watermark": "a.png"}
+    store.replace_server(1, {"channels": {"10": {"transparency": 70}}})
+    assert store.get_channel(1, 10) == {"transparency": 70}
+    store.delete_channel(1, 10)
+    assert store.get_channel(1, 10) == {}
+
+    store.update_guild(1, {"upload_budget_mb": 8})
+    assert store.get_guild(1) == {"upload_budget_mb": 8}
+    store.update_guild(1, {"upload_budget_mb": None})
+    assert store.get_guild(1) == {}
+    store.close()
+
+    # 保存した値は開き直しても読み込める
+    reopened = SQLiteSettingsStore(tmp_path / "settings.db")
+    assert reopened.get_channel(1, 10) == {}
+    reopened.close()
+
+
+def test_settings_concurrent_reads_and_writes(tmp_path):
+    loader = ConfigLoader(tmp_path)
+    errors = []
+
+    def writer(index):
+        try:
+            for step in range(50):
+                # 同じチャンネルへの更新は互いに上書きせずマージされる
+                loader.set_channel_settings(1, 10, {f"writer{index}": step})
+                loader.set_channel_settings(1, 100 + index, {"transparency": step + 1})
+        except Exception as e:
+            errors.append(e)
+
+    def reader():
+        try:
+            for _ in range(200):
+                loader.get_channel_settings(1, 10)
+                loader.iter_channel_settings()
+        except Exception as e:
+            errors.append(e)
+
+    threads = [threading.Thread(target=writer, args=(index,)) for index in range(4)]
+    threads += [threading.Thread(target=reader) for _ in range(2)]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    assert errors == []
+    assert loader.get_channel_settings(1, 10) == {f"writer{index}": 49 for index in range(4)}
+    for index in range(4):
+        assert loader.get_channel_settings(1, 100 + index) == {"transparency": 50}
+    loader.store.close()
+
+    reopened = ConfigLoader(tmp_path)
+    assert reopened.get_channel_settings(1, 10) == {f"writer{index}": 49 for index in range(4)}
+    reopened.store.close()
+
+
+def test_output_cache_hit_miss_and_eviction(tmp_path):
+    cache = OutputCache(tmp_path / "outputs", max_bytes=250)
+    assert cache.get("a") is None
+
+    cache.put("a", b"a" * 100)
+    cache.put("b", b"b" * 100)
+    assert cache.get("a") == b"a" * 100
+    # 最終アクセスが古いbが追い出される
+    cache.put("c", b"c" * 100)
+    assert cache.get("b") is None
+    assert cache.get("c") == b"c" * 100
+    assert sorted(path.name for path in (tmp_path / "outputs").iterdir()) == ["a", "c"]
+    # 上限より大きいデータは保存しない
+    cache.put("d", b"d" * 300)
+    assert cache.get("d") is None
+
+    stats = cache.stats()
+    assert (stats["hits"], stats["misses"], stats["entries"], stats["bytes"]) == (2, 3, 2, 200)
+
+    # 起動時に既存のエントリを読み込む
+    reopened = OutputCache(tmp_path / "outputs", max_bytes=250)
+    assert reopened.stats()["entries"] == 2
+    assert reopened.get("c") == b"c" * 100
+
+
+def test_output_cache_tolerates_removed_files(tmp_path, monkeypatch):
+    cache = OutputCache(tmp_path / "outputs")
+    cache.put("a", b"a" * 100)
+    cache.put("b", b"b" * 100)
+
+    # 読み込み前に削除された場合はミス
+    (tmp_path / "outputs" / "a").unlink()
+    assert cache.get("a") is None
+    assert cache.stats()["entries"] == 1
+
+    # 読み込み後、アクセス時刻の更新前に削除された場合もデータを返す
+    def removed(path, *args, **kwargs):
+        raise FileNotFoundError(path)
+
+    monkeypatch.setattr("utils.output_cache.os.utime", removed)
+    assert cache.get("b") == b"b" * 100
+
+
+# アニメーションのテスト用フレーム（背景の上を不透明な四角と透過した穴が移動する）
+def make_animation_frames(count=5, size=(40, 24)) -> list:
+    width, height = size
+    frames = []
+    for index in range(count):
+        pixels = np.zeros((height, width, 4), np.uint8)
+        pixels[...] = [30, 60, 90, 255]
+        pixels[4:12, index * 5:index * 5 + 8] = [250, 200, 0, 255]
+        pixels[14:20, 30 - index * 5:36 - index * 5, 3] = 0
+        frames.append(pixels)
+    # 変化の無いフレーム
+    frames.append(frames[-1].copy())
+    # 共有パレットに無い色を多数含むフレーム（ローカルパレットを使う）
+    gradient = frames[-1].copy()
+    gradient[..., 0] = np.arange(width * height).reshape(height, width) % 200
+    gradient[..., 1] = 255
+    gradient[..., 3] = 255
+    frames.append(gradient)
+    return frames
+
+# 透過した画素の色を0にそろえる関数（比較用）
+def normalize_rgba(pixels: np.ndarray) -> np.ndarray:
+    pixels = pixels.copy()
+    pixels[pixels[..., 3] == 0] = 0
+    return pixels
+
+# アニメーションをデコードし、(フレームの画素, 表示時間)の一覧とloopを返す関数
+def decode_animation(data: bytes):
+    decoded = []
+    with Image.open(BytesIO(data)) as image:
+        loop = image.info.get("loop")
+        for index in range(image.n_frames):
+            image.seek(index)
+            decoded.append((normalize_rgba(np.array(image.convert("RGBA"))), image.info.get("duration")))
+    return decoded, loop
+
+
+@pytest.mark.parametrize("writer_class", [GifStreamWriter, ApngStreamWriter])
+def test_animation_writer_round_trip(writer_class):
+    frames = make_animation_frames()
+    durations = [40 + index * 10 for index in range(len(frames))]
+    output = BytesIO()
+    size = (frames[0].shape[1], frames[0].shape[0])
+    if writer_class is GifStreamWriter:
+        writer = GifStreamWriter(output, size, loop=2)
+    else:
+        writer = ApngStreamWriter(output, size, len(frames), loop=2)
+    for pixels, duration in zip(frames, durations):
+        writer.write_frame(Image.fromarray(pixels, "RGBA"), duration)
+    writer.close()
+
+    decoded, loop = decode_animation(output.getvalue())
+    assert loop == 2
+    assert len(decoded) == len(frames)
+    for index, ((pixels, duration), expected) in enumerate(zip(decoded, frames)):
+        np.testing.assert_array_equal(pixels, normalize_rgba(expected), err_msg=f"frame {index}")
+        assert duration == durations[index]
+    if writer_class is GifStreamWriter:
+        assert writer.local_palette_frames == 1
+
+
+def test_gif_writer_uses_delta_rectangles():
+    frames = make_animation_frames()
+    size = (frames[0].shape[1], frames[0].shape[0])
+    output = BytesIO()
+    writer = GifStreamWriter(output, size, loop=0)
+    for pixels in frames:
+        writer.write_frame(Image.fromarray(pixels, "RGBA"), 50)
+    writer.close()
+
+    boxes = []
+    disposals = []
+    with Image.open(BytesIO(output.getvalue())) as image:
+        for index in range(image.n_frames):
+            image.seek(index)
+            boxes.append(image.dispose_extent)
+            disposals.append(image.disposal_method)
+    width, height = size
+    assert boxes[0] == (0, 0, width, height)
+    # 穴が移動するフレームの直前は全体を出力して背景に戻す（disposal 2）
+    assert disposals[:4] == [2, 2, 2, 2]
+    # 変化の無いフレームは1画素だけ出力する
+    assert boxes[5] == (0, 0, 1, 1)
+    assert disposals[5] == 1
+
+
+# エンコードの呼び出し（形式・画像サイズ・パラメータ）を記録するBudgetEncoder
+class RecordingEncoder(BudgetEncoder):
+    def __init__(self, *args, **kwargs):
+        super().__init__(*args, **kwargs)
+        self.calls = []
+
+    def _encode(self, image, image_format, **params):
+        self.calls.append((image_format, image.size, params))
+        return super()._encode(image, image_format, **params)
+
+# 圧縮しにくいノイズ画像
+def noise_image(mode="RGB", size=(160, 120)) -> Image.Image:
+    rng = np.random.default_rng(7)
+    channels = len(mode)
+    pixels = rng.integers(0, 256, (size[1], size[0], channels), dtype=np.uint8)
+    if mode == "RGBA":
+        pixels[:20, :, 3] = 0
+    return Image.fromarray(pixels, mode)
+
+
+def test_budget_encoder_without_budget_matches_pillow_default():
+    image = noise_image()
+    expected = BytesIO()
+    image.save(expected, format="JPEG")
+    result = RecordingEncoder().encode(image, "JPEG")
+    assert result.data == expected.getvalue()
+    assert result.attempts == 1
+
+
+def test_budget_encoder_lowers_quality_before_dimensions():
+    image = noise_image()
+    first = len(RecordingEncoder().encode(image, "JPEG").data)
+    encoder = RecordingEncoder(byte_budget=first // 2)
+    result = encoder.encode(image, "JPEG")
+
+    assert result.size <= first // 2
+    assert result.image_format == "JPEG"
+    assert Image.open(BytesIO(result.data)).size == image.size
+    qualities = [params["quality"] for _, size, params in encoder.calls]
+    assert qualities[0] == 75 and all(MIN_QUALITY <= quality < 75 for quality in qualities[1:])
+    assert all(size == image.size for _, size, _ in encoder.calls)
+    assert result.attempts == len(encoder.calls) <= MAX_QUALITY_ATTEMPTS
+
+
+def test_budget_encoder_lossless_steps():
+    image = noise_image()
+    first = len(RecordingEncoder().encode(image, "PNG").data)
+
+    # 最大圧縮で収まらなければJPEGへ変換する（縮小はしない）
+    encoder = RecordingEncoder(byte_budget=int(first * 0.9))
+    result = encoder.encode(image, "PNG")
+    steps = [(image_format, params.get("compress_level")) for image_format, _, params in encoder.calls]
+    assert steps[:2] == [("PNG", 6), ("PNG", 9)]
+    assert {image_format for image_format, _ in steps[2:]} == {"JPEG"}
+    assert result.image_format == "JPEG" and result.size <= encoder.byte_budget
+    assert all(size == image.size for _, size, _ in encoder.calls)
+
+    # 透過がある場合は減色したPNG、WebPの順に試す
+    image = noise_image("RGBA")
+    first = len(RecordingEncoder().encode(image, "PNG").data)
+    encoder = RecordingEncoder(byte_budget=first // 2)
+    result = encoder.encode(image, "PNG")
+    formats = [image_format for image_format, _, _ in encoder.calls]
+    assert formats[:2] == ["PNG", "PNG"]
+    assert encoder.calls[1][2] == {"compress_level": 9}
+    assert result.size <= encoder.byte_budget
+    assert Image.open(BytesIO(result.data)).mode in ("P", "RGBA")
+
+    # 変換しない場合は最大圧縮のあと縮小する
+    image = noise_image()
+    first = len(RecordingEncoder().encode(image, "PNG").data)
+    encoder = RecordingEncoder(byte_budget=int(first * 0.9), allow_convert=False)
+    result = encoder.encode(image, "PNG")
+    assert [image_format for image_format, _, _ in encoder.calls] == ["PNG"] * len(encoder.calls)
+    assert encoder.calls[1] == ("PNG", image.size, {"compress_level": 9})
+    assert result.size <= encoder.byte_budget
+    width, height = Image.open(BytesIO(result.data)).size
+    assert width < image.width and height < image.height
+
+
+def test_budget_encoder_returns_smallest_result_when_budget_cannot_be_met():
+    image = noise_image()
+    encoder = RecordingEncoder(byte_budget=1)
+    result = encoder.encode(image, "JPEG")
+
+    assert result.size > 1
+    assert result.image_format == "JPEG"
+    assert result.attempts == len(encoder.calls) <= MAX_QUALITY_ATTEMPTS + MAX_DOWNSCALE_ATTEMPTS
+    # 最小品質で探索を終え、縮小を上限回数まで試す
+    resized = [size for _, size, _ in encoder.calls if size != image.size]
+    assert len(resized) == MAX_DOWNSCALE_ATTEMPTS
+    assert encoder.calls[-1][2]["quality"] == MIN_QUALITY
+    assert Image.open(BytesIO(result.data)).size == resized[-1]
+
+
+def test_job_queue_redelivers_after_lease_expiry(tmp_path):
+    queue = SQLiteJobQueue(tmp_path / "queue", lease_seconds=0.05, max_attempts=2)
+    job_id = queue.enqueue({"kwargs": {}}, b"input")
+
+    first = queue.claim("worker-a")
+    assert first.id == job_id and first.attempts == 1 and first.read_input() == b"input"
+    assert queue.claim("worker-b") is None
+    assert queue.heartbeat(job_id, "worker-a")
+
+    # worker-aがハートビートを止めると、リースの期限切れ後に他のワーカーへ再配信される
+    time.sleep(0.1)
+    second = queue.claim("worker-b")
+    assert second.id == job_id and second.attempts == 2
+    assert not queue.heartbeat(job_id, "worker-a")
+
+    # 上限回数まで配信して完了しないジョブは失敗になる
+    time.sleep(0.1)
+    assert queue.claim("worker-c") is None
+    status, output_data, result, error = queue.poll(job_id)
+    assert status == "failed" and output_data is None and "abandoned after 2 attempts" in error
+    queue.close()
+
+
+def test_job_queue_delivers_result_once(tmp_path):
+    queue = SQLiteJobQueue(tmp_path / "queue", lease_seconds=0.05)
+    job_id = queue.enqueue({"kwargs": {}}, b"input")
+    queue.claim("worker-a")
+    time.sleep(0.1)
+    queue.claim("worker-b")
+
+    # 先に完了したワーカーの結果だけを残し、遅れて完了した結果は破棄する
+    assert queue.complete(job_id, "worker-b", b"output-b", {"file_name": "b.png"})
+    assert not queue.complete(job_id, "worker-a", b"output-a", {"file_name": "a.png"})
+    queue.fail(job_id, "worker-a", "RuntimeError: too late")
+    assert queue.poll(job_id) == ("done", b"output-b", {"file_name": "b.png"}, None)
+    assert sorted(path.suffix for path in (tmp_path / "queue" / "spool").iterdir()) == [".in", ".out"]
+
+    queue.ack(job_id)
+    with pytest.raises(KeyError):
+        queue.poll(job_id)
+    assert list((tmp_path / "queue" / "spool").iterdir()) == []
+    queue.close()
+
+
+def test_job_queue_purge_removes_stale_jobs(tmp_path):
+    queue = SQLiteJobQueue(tmp_path / "queue")
+    stale_id = queue.enqueue({"kwargs": {}}, b"stale")
+    queue.claim("worker-a")
+    queue.complete(stale_id, "worker-a", b"output", {})
+    fresh_id = queue.enqueue({"kwargs": {}}, b"fresh")
+    with queue._conn:
+        queue._conn.execute("UPDATE jobs SET created_at = created_at - 600 WHERE id = ?", (stale_id,))
+
+    assert queue.purge(300) == 1
+    with pytest.raises(KeyError):
+        queue.poll(stale_id)
+    assert queue.poll(fresh_id)[0] == "queued"
+    assert [path.read_bytes() for path in (tmp_path / "queue" / "spool").iterdir()] == [b"fresh"]
+    queue.close()
+
+
+def test_render_worker_processes_queued_jobs(tmp_path):
+    overlay_path = make_overlay(tmp_path / "overlay.png")
+    image_data = png_bytes(make_base("rgb"))
+    queue_dir = tmp_path / "queue"
+    queue = SQLiteJobQueue(queue_dir, lease_seconds=5)
+    runner = QueueJobRunner(queue, result_timeout=60)
+    worker = multiprocessing.get_context("spawn").Process(
+        target=render_worker.worker_main, args=(str(queue_dir), 5, 3, 0),
+    )
+    worker.start()
+    try:
+        output, output_file_name, timings, cache_counts = asyncio.run(runner.run(
+            process_image_bytes_timed, image_data, file_name="photo.png", overlay_image_path=overlay_path,
+        ))
+        expected, expected_name = process_image_bytes(image_data, "photo.png", overlay_path)
+        assert output.getvalue() == expected.getvalue() and output_file_name == expected_name
+        assert "composite" in timings and cache_counts == {"misses": 1}
+
+        # ワーカーで発生したResourceLimitExceededはローカル実行時と同じ型で送出する
+        with pytest.raises(ResourceLimitExceeded) as error:
+            asyncio.run(runner.run(
+                process_image_bytes, image_data, file_name="photo.png", overlay_image_path=overlay_path, pixel_budget=1,
+            ))
+        local_error = None
+        try:
+            process_image_bytes(image_data, "photo.png", overlay_path, pixel_budget=1)
+        except ResourceLimitExceeded as e:
+            local_error = e
+        assert str(error.value) == str(local_error)
+        assert queue.stats() == {"queued": 0, "leased": 0, "done": 0, "failed": 0}
+    finally:
+        worker.terminate()
+        worker.join(10)
+        runner.shutdown()
+    assert worker.exitcode == 0
+
+
+def test_watermark_store_dedupes_and_counts_references(tmp_path):
+    store = WatermarkStore(tmp_path / "watermarks")
+    red = watermark_png((255, 0, 0, 128))
+
+    first = store.add(red, "red.png")
+    second = store.add(red, "copy.PNG")
+    other = store.add(watermark_png((0, 0, 255, 255)), "blue.png")
+    # 同じ内容のアップロードは1つのファイルを共有する
+    assert first == second and first != other
+    assert first.read_bytes() == red
+    np.testing.assert_array_equal(np.load(raster_path(first)), np.array(Image.open(BytesIO(red)).convert("RGBA")))
+    assert store.stats() == {"watermarks": 2, "references": 3, "bytes": len(red) + other.stat().st_size}
+
+    # 参照数が0になったときだけファイルを削除する
+    assert not store.release(first)
+    assert first.exists() and raster_path(first).exists()
+    assert store.release(second)
+    assert not first.exists() and not raster_path(first).exists()
+    assert not store.release(first)
+    assert store.stats()["references"] == 1
+
+    # 削除後に同じ画像をアップロードした場合は保存し直す
+    assert store.add(red, "red.png") == first and raster_path(first).exists()
+    store.close()
+
+
+def test_watermark_store_rejects_oversize_images_before_decoding(tmp_path, monkeypatch):
+    store = WatermarkStore(tmp_path / "watermarks", memory_budget=64 * 1024 * 1024, max_pixels=1000 * 1000)
+    large = png_bytes(Image.new("1", (2000, 1000)))
+
+    def fail_load(self):
+        raise AssertionError("image was decoded")
+
+    with monkeypatch.context() as patch:
+        patch.setattr(ImageFile.ImageFile, "load", fail_load)
+        with pytest.raises(ResourceLimitExceeded, match="2000x1000"):
+            store.add(large, "large.png")
+    # メモリの見積もりが上限を超える画像も拒否する
+    store.memory_budget = 1
+    with pytest.raises(ResourceLimitExceeded, match="MB of memory"):
+        store.add(watermark_png((255, 0, 0, 128)), "small.png")
+    assert store.stats()["watermarks"] == 0
+    assert sorted(path.name for path in store.root.iterdir() if not path.name.startswith("watermarks.db")) == []
+
+    store.memory_budget = 0
+    assert store.add(watermark_png((255, 0, 0, 128)), "small.png").exists()
+    store.close()
+
+
+def test_plan_job_within_limits_and_downscale():
+    header = ImageHeader((4000, 3000), "RGB", 1, "PNG", False, 1_000_000)
+    estimate = plan_job(header, memory_budget=1024 * 1024 * 1024, pixel_budget=100_000_000)
+    assert not estimate.downscaled and estimate.output_size == (4000, 3000)
+    assert estimate.pixels == 12_000_000
+    assert estimate.memory_bytes == BASE_MEMORY_BYTES + 12_000_000 * (4 + STILL_BYTES_PER_PIXEL)
+
+    # 上限を超える静止画は収まる大きさまで縮小する
+    budget = 64 * 1024 * 1024
+    estimate = plan_job(header, memory_budget=budget)
+    assert estimate.downscaled and estimate.memory_bytes <= budget
+    assert estimate.max_dimension == max(estimate.output_size) < 4000
+    assert estimate.output_size[0] * 3 == pytest.approx(estimate.output_size[1] * 4, abs=4)
+    # 1段階大きいサイズでは上限を超える
+    larger = plan_job(header, max_dimension=int(estimate.max_dimension / DOWNSCALE_STEP) + 1)
+    assert larger.memory_bytes > budget
+
+    # 処理量の上限で縮小できるのは縮小デコードできるJPEGだけ（PNGはデコードする画素数が変わらない）
+    jpeg = ImageHeader((4000, 3000), "RGB", 1, "JPEG", False, 1_000_000)
+    estimate = plan_job(jpeg, pixel_budget=4_000_000)
+    assert estimate.downscaled and estimate.pixels <= 4_000_000
+    with pytest.raises(ResourceLimitExceeded, match="12 megapixels in total, limit is 4"):
+        plan_job(header, pixel_budget=4_000_000)
+    # MAX_OUTPUT_DIMENSIONで上限に収まる場合はそのまま使う
+    estimate = plan_job(header, memory_budget=2 * budget, max_dimension=1000)
+    assert estimate.output_size == (1000, 750) and estimate.max_dimension == 1000
+
+
+def test_plan_job_rejects_over_limit_jobs():
+    # アニメーションは縮小せずに拒否する
+    animation = ImageHeader((1000, 1000), "P", 500, "GIF", True, 5_000_000)
+    with pytest.raises(ResourceLimitExceeded, match=r"1000x1000, 500 frame\(s\).*500 megapixels in total, limit is 100"):
+        plan_job(animation, pixel_budget=100_000_000)
+    with pytest.raises(ResourceLimitExceeded, match="MB of memory"):
+        plan_job(animation, memory_budget=64 * 1024 * 1024)
+
+    # 長辺の下限まで縮小しても収まらない静止画も拒否する
+    still = ImageHeader((20000, 20000), "RGBA", 1, "PNG", False, 1_000_000)
+    with pytest.raises(ResourceLimitExceeded, match="20000x20000"):
+        plan_job(still, memory_budget=BASE_MEMORY_BYTES + 1024)
+
+    # 上限が0の場合は確認しない
+    assert plan_job(animation).pixels == 500_000_000
+
+
+@pytest.mark.parametrize("memory_bytes, total_budget, capacity, expected", [
+    (100, 0, 4, 1),
+    (10 * 1024 ** 3, 1024 ** 3, 1, 1),
+    (1, 1024 ** 3, 4, 1),
+    (256 * 1024 ** 2, 1024 ** 3, 4, 1),
+    (256 * 1024 ** 2 + 1, 1024 ** 3, 4, 2),
+    (700 * 1024 ** 2, 1024 ** 3, 4, 3),
+    (10 * 1024 ** 3, 1024 ** 3, 4, 4),
+])
+def test_slot_cost(memory_bytes, total_budget, capacity, expected):
+    assert slot_cost(memory_bytes, total_budget, capacity) == expected